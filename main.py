@@ -1,22 +1,83 @@
 import os
+import sys
 import json
 import asyncio
 import uuid
 import calendar
 import traceback
 import time
-from datetime import datetime, date
-import pytz
-
-# Сторонние библиотеки
-import ydb
-import ydb.iam
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import CommandStart
-from aiogram.types import WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.utils.web_app import safe_parse_webapp_init_data
+import re
+import zlib
+import heapq
+import hashlib
+import base64
+import gzip
+import csv
+import io
+import hmac
+import contextlib
+from urllib.parse import parse_qs, parse_qsl, quote, unquote, urlsplit
+from bisect import bisect_left
+import contextvars
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+
+STARTUP_T0 = time.perf_counter()
+
+# --- ЛЕНИВЫЕ ИМПОРТЫ И ПРОГРЕВ ---
+# Тяжелые библиотеки (ydb, googleapiclient, aiogram, numpy) импортируются при первом
+# обращении, а не при загрузке модуля: действию веб-приложения aiogram не нужен вовсе.
+# STARTUP_MODE=prewarm загружает все сразу (для подготовленных экземпляров функции).
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")
+STARTUP_TIMINGS = {}  # этап -> секунды
+_STARTUP_REPORTED = False
+
+@contextlib.contextmanager
+def startup_timer(stage):
+    start = time.perf_counter()
+    try: yield
+    finally: STARTUP_TIMINGS[stage] = STARTUP_TIMINGS.get(stage, 0.0) + time.perf_counter() - start
+
+ydb = None
+service_account = build = build_from_document = httplib2 = google_auth_httplib2 = None
+np = None
+_NUMPY_CHECKED = False
+
+def load_ydb():
+    global ydb
+    if ydb is None:
+        with startup_timer('import ydb'):
+            import ydb.aio.iam
+    return ydb
+
+def load_google():
+    global service_account, build, build_from_document, httplib2, google_auth_httplib2
+    if build is None:
+        with startup_timer('import googleapiclient'):
+            from google.oauth2 import service_account
+            from googleapiclient.discovery import build, build_from_document
+            import httplib2
+            import google_auth_httplib2
+
+def load_numpy():
+    """numpy или None: она необязательна, без нее сценарии долгов считаются чистым Python."""
+    global np, _NUMPY_CHECKED
+    if not _NUMPY_CHECKED:
+        _NUMPY_CHECKED = True
+        with startup_timer('import numpy'):
+            try: import numpy as np
+            except ImportError: np = None
+    return np
+
+try:
+    from zoneinfo import ZoneInfo
+    MOSCOW_TIMEZONE = ZoneInfo('Europe/Moscow')
+except Exception:  # Нет базы часовых поясов в образе
+    import pytz
+    MOSCOW_TIMEZONE = pytz.timezone('Europe/Moscow')
 
 # --- КОНФИГУРАЦИЯ ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -30,132 +91,346 @@ BUDGET_SHEET_NAME = "Бюджет"
 SUBSCRIPTIONS_SHEET_NAME = "Подписки"
 DEBTS_SHEET_NAME = "Долги"
 WALLETS_SHEET_NAME = "Кошельки" 
-MOSCOW_TIMEZONE = pytz.timezone('Europe/Moscow')
+SHEETS_DISCOVERY_DOC = os.getenv("SHEETS_DISCOVERY_DOC", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sheets.v4.json"))
 
 # --- ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ---
 YDB_DRIVER = None
 YDB_POOL = None
 SHEETS_SERVICE = None
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+bot = None  # get_bot()
+dp = None   # get_dispatcher()
 
 # Кэш в оперативной памяти (живет пока контейнер функции "горячий")
-RAM_CACHE = {}
 CACHE_TTL = 60  # Время жизни кэша в секундах
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "2000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
 
 # --- УТИЛИТЫ КЭШИРОВАНИЯ ---
 
-def get_cache_key(spreadsheet_id, action, payload):
+class RamCache:
+    """LRU-кэш с TTL и ограничением по числу записей и (оценочному) объему.
+
+    Инвалидация таблицы — это увеличение ее поколения: ключи из get_cache_key
+    включают поколение, поэтому старые записи просто перестают находиться и
+    вытесняются LRU или истекают. Истекшие записи удаляются по куче сроков
+    при каждой записи, а не только при чтении того же ключа.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expire, size, data)
+        self.expiry_heap = []
+        self._seq = 0
+        self.generations = {}
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def generation(self, spreadsheet_id):
+        return self.generations.get(spreadsheet_id, 0)
+
+    def invalidate(self, spreadsheet_id):
+        self.generations[spreadsheet_id] = self.generations.get(spreadsheet_id, 0) + 1
+        self.stats['invalidations'] += 1
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        if time.time() >= entry[0]:
+            self._remove(key)
+            self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return entry[2]
+
+    def set(self, key, data, ttl):
+        now = time.time()
+        self.purge_expired(now)
+        size = _estimate_size(data)
+        if size > self.max_bytes: return
+        if key in self.entries: self._remove(key)
+        expire = now + ttl
+        self.entries[key] = (expire, size, data)
+        self.bytes += size
+        self._seq += 1
+        heapq.heappush(self.expiry_heap, (expire, self._seq, key))
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, old_size, _) = self.entries.popitem(last=False)
+            self.bytes -= old_size
+            self.stats['evictions'] += 1
+
+    def purge_expired(self, now=None):
+        now = now or time.time()
+        heap = self.expiry_heap
+        while heap and heap[0][0] <= now:
+            expire, _, key = heapq.heappop(heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == expire:
+                self._remove(key)
+                self.stats['expired'] += 1
+        # Куча может накопить ссылки на перезаписанные ключи — периодически пересобираем
+        if len(heap) > 4 * max(len(self.entries), 64):
+            self.expiry_heap = [(e[0], i, k) for i, (k, e) in enumerate(self.entries.items())]
+            self._seq = len(self.expiry_heap)
+            heapq.heapify(self.expiry_heap)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.bytes -= entry[1]
+
+    def snapshot_stats(self):
+        return dict(self.stats, entries=len(self.entries), bytes=self.bytes, spreadsheets=len(self.generations))
+
+def _estimate_size(data):
+    try: return len(json.dumps(data, ensure_ascii=False)) + 64
+    except (TypeError, ValueError): return 1024
+
+RAM_CACHE = RamCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+
+def get_cache_key(spreadsheet_id, action, payload, revision=None):
+    # revision — ревизия данных (для действий с ETag): запись из другого контейнера меняет ключ
     payload_str = json.dumps(payload, sort_keys=True)
-    return f"{spreadsheet_id}:{action}:{payload_str}"
+    return (spreadsheet_id, RAM_CACHE.generation(spreadsheet_id), revision, action, payload_str)
 
 def get_from_cache(key):
-    if key in RAM_CACHE:
-        entry = RAM_CACHE[key]
-        if time.time() < entry['expire']:
-            print(f"[LOG] Cache HIT for key: {key}")
-            return entry['data']
-        else:
-            print(f"[LOG] Cache EXPIRED for key: {key}")
-            del RAM_CACHE[key]
-    return None
+    return RAM_CACHE.get(key)
 
 def save_to_cache(key, data, ttl=None):
-    RAM_CACHE[key] = {
-        'data': data,
-        'expire': time.time() + (ttl if ttl is not None else CACHE_TTL)
-    }
+    RAM_CACHE.set(key, data, ttl if ttl is not None else CACHE_TTL)
 
 def clear_user_cache(spreadsheet_id):
     print(f"[LOG] Clearing cache for spreadsheet: {spreadsheet_id}")
-    keys_to_delete = [k for k in RAM_CACHE if k.startswith(spreadsheet_id)]
-    for k in keys_to_delete:
-        del RAM_CACHE[k]
+    RAM_CACHE.invalidate(spreadsheet_id)
+
+def cache_stats():
+    return RAM_CACHE.snapshot_stats()
 
 # --- РАБОТА С YDB (БАЗА ДАННЫХ) ---
 
-def get_ydb_driver():
+YDB_ID_TYPE = os.getenv("YDB_ID_TYPE", "Int64")      # тип telegram_id / owner_id в таблицах
+YDB_TEXT_TYPE = os.getenv("YDB_TEXT_TYPE", "String")  # тип строковых колонок
+
+# Все запросы к YDB — с объявленными параметрами: текст запроса один на форму,
+# поэтому сессия компилирует его один раз (session.prepare кэширует по тексту).
+YQL_QUERIES = {
+    'get_user': """
+        DECLARE $telegram_id AS {ID};
+        SELECT spreadsheet_id, owner_id, first_name FROM `users` WHERE telegram_id = $telegram_id;
+    """,
+    'upsert_user': """
+        DECLARE $telegram_id AS {ID}; DECLARE $spreadsheet_id AS {TEXT};
+        DECLARE $owner_id AS {ID}; DECLARE $first_name AS {TEXT};
+        UPSERT INTO `users` (telegram_id, refresh_token, spreadsheet_id, owner_id, first_name)
+        VALUES ($telegram_id, "sa_mode", $spreadsheet_id, $owner_id, $first_name);
+    """,
+    'delete_user': """
+        DECLARE $telegram_id AS {ID};
+        DELETE FROM `users` WHERE telegram_id = $telegram_id;
+    """,
+    'get_family': """
+        DECLARE $owner_id AS {ID};
+        SELECT telegram_id, first_name FROM `users` WHERE owner_id = $owner_id;
+    """,
+    'count_categories': """
+        DECLARE $telegram_id AS {ID};
+        SELECT COUNT(*) AS cnt FROM `categories` WHERE telegram_id = $telegram_id;
+    """,
+    'get_categories': """
+        DECLARE $telegram_id AS {ID};
+        SELECT category_id, category_name, category_type FROM `categories` WHERE telegram_id = $telegram_id;
+    """,
+    'upsert_categories': """
+        DECLARE $rows AS List<Struct<telegram_id: {ID}, category_id: {TEXT}, category_name: {TEXT}, category_type: {TEXT}>>;
+        UPSERT INTO `categories` SELECT * FROM AS_TABLE($rows);
+    """,
+    'rename_category': """
+        DECLARE $telegram_id AS {ID}; DECLARE $category_id AS {TEXT}; DECLARE $category_name AS {TEXT};
+        UPDATE `categories` SET category_name = $category_name
+        WHERE telegram_id = $telegram_id AND category_id = $category_id;
+    """,
+    'delete_category': """
+        DECLARE $telegram_id AS {ID}; DECLARE $category_id AS {TEXT};
+        DELETE FROM `categories` WHERE telegram_id = $telegram_id AND category_id = $category_id;
+    """,
+    # subscription_due (spreadsheet_id, subscription_id, next_due 'YYYY-MM-DD'), PRIMARY KEY (spreadsheet_id, subscription_id).
+    # Пустой subscription_id — отметка "таблица просмотрена, подписок нет".
+    'due_spreadsheets': """
+        DECLARE $today AS {TEXT};
+        SELECT DISTINCT spreadsheet_id FROM `subscription_due` WHERE next_due <= $today;
+        SELECT DISTINCT u.spreadsheet_id AS spreadsheet_id FROM `users` AS u
+        LEFT ONLY JOIN `subscription_due` AS d ON u.spreadsheet_id = d.spreadsheet_id;
+    """,
+    'clear_subscription_due': """
+        DECLARE $spreadsheet_id AS {TEXT};
+        DELETE FROM `subscription_due` WHERE spreadsheet_id = $spreadsheet_id;
+    """,
+    'upsert_subscription_due': """
+        DECLARE $rows AS List<Struct<spreadsheet_id: {TEXT}, subscription_id: {TEXT}, next_due: {TEXT}>>;
+        UPSERT INTO `subscription_due` SELECT * FROM AS_TABLE($rows);
+    """,
+    # alert_queue (spreadsheet_id, category, month 'YYYY-MM', user_id) — все четыре в ключе, повторные расходы схлопываются.
+    # budget_alerts (spreadsheet_id, category, month, threshold) — отправленные уведомления.
+    'enqueue_alert_checks': """
+        DECLARE $rows AS List<Struct<spreadsheet_id: {TEXT}, category: {TEXT}, month: {TEXT}, user_id: {ID}>>;
+        UPSERT INTO `alert_queue` SELECT * FROM AS_TABLE($rows);
+    """,
+    'pending_alert_checks': """
+        DECLARE $limit AS Uint64;
+        SELECT spreadsheet_id, category, month, user_id FROM `alert_queue` LIMIT $limit;
+    """,
+    'delete_alert_checks': """
+        DECLARE $rows AS List<Struct<spreadsheet_id: {TEXT}, category: {TEXT}, month: {TEXT}, user_id: {ID}>>;
+        DELETE FROM `alert_queue` ON SELECT * FROM AS_TABLE($rows);
+    """,
+    # Все уведомления прохода воркера одним запросом: sent — уже отправленный максимум (NULL, если не было)
+    'claim_budget_alerts': """
+        DECLARE $rows AS List<Struct<spreadsheet_id: {TEXT}, category: {TEXT}, month: {TEXT}, threshold: Int32>>;
+        SELECT r.spreadsheet_id AS spreadsheet_id, r.category AS category, r.month AS month, MAX(a.threshold) AS sent
+        FROM AS_TABLE($rows) AS r
+        LEFT JOIN `budget_alerts` AS a ON a.spreadsheet_id = r.spreadsheet_id AND a.category = r.category AND a.month = r.month
+        GROUP BY r.spreadsheet_id, r.category, r.month;
+        UPSERT INTO `budget_alerts` SELECT * FROM AS_TABLE($rows);
+    """,
+    'get_snapshot': """
+        DECLARE $spreadsheet_id AS {TEXT};
+        SELECT verified_at, payload FROM `sheet_snapshots` WHERE spreadsheet_id = $spreadsheet_id;
+    """,
+    'upsert_snapshot': """
+        DECLARE $spreadsheet_id AS {TEXT}; DECLARE $verified_at AS Double; DECLARE $payload AS String;
+        UPSERT INTO `sheet_snapshots` (spreadsheet_id, verified_at, saved_at, payload)
+        VALUES ($spreadsheet_id, $verified_at, CurrentUtcTimestamp(), $payload);
+    """,
+    'delete_snapshot': """
+        DECLARE $spreadsheet_id AS {TEXT};
+        DELETE FROM `sheet_snapshots` WHERE spreadsheet_id = $spreadsheet_id;
+    """,
+    'get_revision': """
+        DECLARE $spreadsheet_id AS {TEXT};
+        SELECT revision FROM `sheet_revisions` WHERE spreadsheet_id = $spreadsheet_id;
+    """,
+    'bump_revision': """
+        DECLARE $spreadsheet_id AS {TEXT};
+        $next = SELECT COALESCE(MAX(revision), 0ul) + 1ul FROM `sheet_revisions` WHERE spreadsheet_id = $spreadsheet_id;
+        SELECT $next AS revision;
+        UPSERT INTO `sheet_revisions` (spreadsheet_id, revision, updated_at) VALUES ($spreadsheet_id, $next, CurrentUtcTimestamp());
+    """,
+    'delete_subscription_due': """
+        DECLARE $spreadsheet_id AS {TEXT}; DECLARE $subscription_id AS {TEXT};
+        DELETE FROM `subscription_due` WHERE spreadsheet_id = $spreadsheet_id AND subscription_id = $subscription_id;
+    """,
+}
+YQL_QUERIES = {name: q.replace('{ID}', YDB_ID_TYPE).replace('{TEXT}', YDB_TEXT_TYPE) for name, q in YQL_QUERIES.items()}
+
+async def get_ydb_driver():
     global YDB_DRIVER
     if YDB_DRIVER is None:
         try:
             print("[LOG] Initializing YDB Driver...")
-            credentials = ydb.iam.MetadataUrlCredentials()
+            load_ydb()
+            start = time.perf_counter()
+            credentials = ydb.aio.iam.MetadataUrlCredentials()
             driver_config = ydb.DriverConfig(
                 endpoint=YDB_ENDPOINT, 
                 database=YDB_DATABASE, 
                 credentials=credentials
             )
-            YDB_DRIVER = ydb.Driver(driver_config)
-            YDB_DRIVER.wait(timeout=5, fail_fast=True)
+            driver = ydb.aio.Driver(driver_config)
+            await driver.wait(timeout=5, fail_fast=True)
+            YDB_DRIVER = driver
+            STARTUP_TIMINGS['ydb driver'] = time.perf_counter() - start
             print("[LOG] YDB Driver connected.")
         except Exception as e:
             print(f"[ERROR] YDB Connection Error: {e}")
             raise e
     return YDB_DRIVER
 
-def get_ydb_pool():
+async def get_ydb_pool():
     global YDB_POOL
     if YDB_POOL is None:
-        driver = get_ydb_driver()
-        YDB_POOL = ydb.SessionPool(driver)
+        driver = await get_ydb_driver()
+        if YDB_POOL is None: YDB_POOL = ydb.aio.SessionPool(driver, size=10)
     return YDB_POOL
 
-def execute_query(query):
-    def callee(session):
-        session.transaction().execute(query, commit_tx=True)
-    pool = get_ydb_pool()
-    pool.retry_operation_sync(callee)
+def ydb_text(value):
+    value = "" if value is None else str(value)
+    return value.encode('utf-8') if YDB_TEXT_TYPE == "String" else value
 
-def get_safe_str(text):
-    if text is None:
-        return ""
-    return str(text).replace('"', '').replace("'", "").replace("\\", "")
+def ydb_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
 
-def save_user_data(telegram_id, spreadsheet_id, owner_id, first_name="User"):
+async def ydb_query(name, params=None):
+    """Выполняет именованный запрос из YQL_QUERIES с параметрами ($name -> value)."""
+    text = YQL_QUERIES[name]
+    load_ydb()
+
+    async def callee(session):
+        prepared = await session.prepare(text)
+        return await session.transaction(ydb.SerializableReadWrite()).execute(prepared, params or {}, commit_tx=True)
+
+    pool = await get_ydb_pool()
+    return await pool.retry_operation(callee)
+
+# Кэш принципалов: telegram_id -> (expire, {'spreadsheet_id', 'owner_id', 'first_name'}).
+# Отсутствующих пользователей не кэшируем, чтобы регистрация была видна сразу.
+# invalidate_principal чистит только свой контейнер: в остальных исключенный участник
+# читает до PRINCIPAL_TTL, а пишущие действия членство всегда перепроверяют (fresh=True).
+PRINCIPAL_CACHE = {}
+PRINCIPAL_TTL = int(os.getenv("PRINCIPAL_TTL", "30"))
+
+def invalidate_principal(telegram_id):
+    PRINCIPAL_CACHE.pop(int(telegram_id), None)
+
+async def save_user_data(telegram_id, spreadsheet_id, owner_id, first_name="User"):
     print(f"[LOG] Saving user data: {telegram_id}, Owner: {owner_id}")
+    invalidate_principal(telegram_id)
+    await ydb_query('upsert_user', {
+        '$telegram_id': int(telegram_id), '$spreadsheet_id': ydb_text(spreadsheet_id),
+        '$owner_id': int(owner_id), '$first_name': ydb_text(first_name),
+    })
+    PRINCIPAL_CACHE[int(telegram_id)] = (time.time() + PRINCIPAL_TTL, {
+        'spreadsheet_id': spreadsheet_id, 'owner_id': int(owner_id), 'first_name': first_name,
+    })
+
+async def get_user_data(telegram_id, fresh=False):
     tid = int(telegram_id)
-    oid = int(owner_id)
-    sid = get_safe_str(spreadsheet_id)
-    fname = get_safe_str(first_name)
-    
-    query = f"""
-        UPSERT INTO `users` (telegram_id, refresh_token, spreadsheet_id, owner_id, first_name)
-        VALUES ({tid}, "sa_mode", "{sid}", {oid}, "{fname}");
-    """
-    execute_query(query)
+    entry = None if fresh else PRINCIPAL_CACHE.get(tid)
+    if entry is not None:
+        if time.time() < entry[0]: return entry[1]
+        del PRINCIPAL_CACHE[tid]
 
-def get_user_data(telegram_id):
-    tid = int(telegram_id)
-    query = f"SELECT spreadsheet_id, owner_id FROM `users` WHERE telegram_id = {tid};"
-    
-    def callee(session):
-        return session.transaction().execute(query, commit_tx=True)
-        
-    pool = get_ydb_pool()
-    result_sets = pool.retry_operation_sync(callee)
+    result_sets = await ydb_query('get_user', {'$telegram_id': tid})
         
     if result_sets and result_sets[0].rows:
         row = result_sets[0].rows[0]
         o_id = row.owner_id if row.owner_id else tid
-        try:
-            s_id = row.spreadsheet_id.decode('utf-8') if isinstance(row.spreadsheet_id, bytes) else row.spreadsheet_id
-        except:
-            s_id = row.spreadsheet_id
+        s_id = ydb_str(row.spreadsheet_id)
         print(f"[LOG] User found. Spreadsheet: {s_id}")
-        return {'spreadsheet_id': s_id, 'owner_id': int(o_id)}
+        user = {'spreadsheet_id': s_id, 'owner_id': int(o_id), 'first_name': ydb_str(row.first_name)}
+        PRINCIPAL_CACHE[tid] = (time.time() + PRINCIPAL_TTL, user)
+        return user
     
     print(f"[LOG] User {tid} not found in YDB.")
+    PRINCIPAL_CACHE.pop(tid, None)  # После fresh-чтения: исключенный не читает и из кэша
     return None
 
-def create_default_categories(telegram_id):
+async def get_categories(owner_id):
+    res = await ydb_query('get_categories', {'$telegram_id': int(owner_id)})
+    cats = []
+    if res and res[0].rows:
+        for row in res[0].rows:
+            cats.append({"id": ydb_str(row.category_id), "name": ydb_str(row.category_name), "type": ydb_str(row.category_type)})
+    return cats
+
+async def create_default_categories(telegram_id):
     tid = int(telegram_id)
-    check_q = f"SELECT COUNT(*) as cnt FROM `categories` WHERE telegram_id = {tid};"
-    
-    def check_callee(session):
-        return session.transaction().execute(check_q, commit_tx=True)
-    
-    pool = get_ydb_pool()
-    res = pool.retry_operation_sync(check_callee)
+    res = await ydb_query('count_categories', {'$telegram_id': tid})
         
     if res[0].rows[0].cnt > 0:
         return 
@@ -175,66 +450,1185 @@ def create_default_categories(telegram_id):
         ("Другое", "expense")
     ]
     
-    values_list = []
-    for name, c_type in defaults:
-        cid = str(uuid.uuid4())
-        values_list.append(f'({tid}, "{cid}", "{name}", "{c_type}")')
-    
-    values_str = ", ".join(values_list)
-    query = f"UPSERT INTO `categories` (telegram_id, category_id, category_name, category_type) VALUES {values_str};"
-    execute_query(query)
+    rows = [{'telegram_id': tid, 'category_id': ydb_text(uuid.uuid4()), 'category_name': ydb_text(name), 'category_type': ydb_text(c_type)}
+            for name, c_type in defaults]
+    await ydb_query('upsert_categories', {'$rows': rows})
+
+async def get_due_spreadsheets(today):
+    """Таблицы, где сегодня есть что списать, плюс еще ни разу не просмотренные планировщиком."""
+    res = await ydb_query('due_spreadsheets', {'$today': ydb_text(today.isoformat())})
+    return list(dict.fromkeys(ydb_str(row.spreadsheet_id) for rs in res for row in rs.rows if row.spreadsheet_id))
+
+async def save_subscription_schedule(spreadsheet_id, schedule):
+    """Перезаписывает даты списаний таблицы: schedule — {subscription_id: date}."""
+    rows = [{'spreadsheet_id': ydb_text(spreadsheet_id), 'subscription_id': ydb_text(sub_id), 'next_due': ydb_text(due.isoformat())}
+            for sub_id, due in (schedule or {'': date.max}).items()]
+    await ydb_query('clear_subscription_due', {'$spreadsheet_id': ydb_text(spreadsheet_id)})
+    await ydb_query('upsert_subscription_due', {'$rows': rows})
 
 # --- GOOGLE SHEETS HELPERS ---
 
+SHEETS_CREDS = None
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "8"))
+SHEETS_EXECUTOR = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+SHEETS_HTTP_TIMEOUT = float(os.getenv("SHEETS_HTTP_TIMEOUT", "30"))
+_SHEETS_THREAD = threading.local()
+_SHEETS_TRANSPORTS = []  # все созданные транспорты (по одному на поток пула)
+_SHEETS_CREDS_LOCK = threading.Lock()
+SHEETS_CALLS = contextvars.ContextVar('sheets_calls', default=None)  # [n] — счетчик вызовов текущего действия
+SHEETS_COALESCER = contextvars.ContextVar('sheets_coalescer', default=None)  # ReadCoalescer действия batch
+BATCH_COALESCE_DELAY = float(os.getenv("BATCH_COALESCE_MS", "15")) / 1000  # Окно сбора чтений в один batchGet
+
 def get_creds():
-    return service_account.Credentials.from_service_account_file("key.json")
+    global SHEETS_CREDS
+    if SHEETS_CREDS is None:
+        load_google()
+        with startup_timer('sheets credentials'):
+            SHEETS_CREDS = service_account.Credentials.from_service_account_file("key.json")
+    return SHEETS_CREDS
 
 def get_sheets_service():
+    """Клиент Sheets из локального документа обнаружения (SHEETS_DISCOVERY_DOC), если он
+    лежит рядом, иначе из копии, встроенной в googleapiclient, — без запроса в сеть."""
     global SHEETS_SERVICE
     if SHEETS_SERVICE is None:
         creds = get_creds()
-        SHEETS_SERVICE = build('sheets', 'v4', credentials=creds)
+        with startup_timer('sheets discovery'):
+            if os.path.exists(SHEETS_DISCOVERY_DOC):
+                with open(SHEETS_DISCOVERY_DOC, encoding='utf-8') as f:
+                    SHEETS_SERVICE = build_from_document(f.read(), credentials=creds)
+            else:
+                SHEETS_SERVICE = build('sheets', 'v4', credentials=creds, cache_discovery=False, static_discovery=True)
     return SHEETS_SERVICE
 
-async def setup_sheet(spreadsheet_id):
-    print(f"[LOG] Setting up sheet structure for {spreadsheet_id}")
-    def run():
-        service = get_sheets_service()
-        try:
-            meta = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-        except Exception: 
-            raise Exception("Нет доступа к таблице. Проверьте email бота.")
-        
-        titles = [s['properties']['title'] for s in meta.get('sheets', [])]
-        requests = []
-        
-        if TRANSACTIONS_SHEET_NAME not in titles:
-            requests.append({"addSheet": {"properties": {"title": TRANSACTIONS_SHEET_NAME}}})
-        if BUDGET_SHEET_NAME not in titles:
-            requests.append({"addSheet": {"properties": {"title": BUDGET_SHEET_NAME}}})
-        if SUBSCRIPTIONS_SHEET_NAME not in titles:
-            requests.append({"addSheet": {"properties": {"title": SUBSCRIPTIONS_SHEET_NAME}}})
-        if DEBTS_SHEET_NAME not in titles:
-            requests.append({"addSheet": {"properties": {"title": DEBTS_SHEET_NAME}}})
-        if WALLETS_SHEET_NAME not in titles:
-            requests.append({"addSheet": {"properties": {"title": WALLETS_SHEET_NAME}}})
-            
-        if requests:
-            service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': requests}).execute()
-        
-        data = [
-            {'range': f"'{TRANSACTIONS_SHEET_NAME}'!A1", 'values': [["Дата", "Сумма", "Категория", "Тип", "Комментарий", "Автор", "ID", "Wallet_UUID"]]},
-            {'range': f"'{BUDGET_SHEET_NAME}'!A1", 'values': [["Категория", "Лимит", "Обновлено", "Setting_Key", "Setting_Value"]]},
-            {'range': f"'{SUBSCRIPTIONS_SHEET_NAME}'!A1", 'values': [["Название", "Сумма", "Категория", "День", "Последняя_оплата", "ID"]]},
-            {'range': f"'{DEBTS_SHEET_NAME}'!A1", 'values': [["Название", "Тип", "Остаток", "Ставка%", "ID", "Мин.Платеж"]]},
-            {'range': f"'{WALLETS_SHEET_NAME}'!A1", 'values': [["Название", "Баланс", "Тип", "is_default", "UUID"]]}
-        ]
-        service.spreadsheets().values().batchUpdate(
-            spreadsheetId=spreadsheet_id, body={'valueInputOption': 'USER_ENTERED', 'data': data}
-        ).execute()
-    
+# Маски полей ответа по methodId: Sheets отдает только то, что код действительно читает.
+# Если запрос уже задал fields= (spreadsheets.get в setup_sheet), он не трогается.
+SHEETS_FIELD_MASKS = {
+    'sheets.spreadsheets.values.get': 'values',
+    'sheets.spreadsheets.values.batchGet': 'valueRanges(values)',
+    'sheets.spreadsheets.values.append': 'updates(updatedRange)',
+    'sheets.spreadsheets.values.update': 'updatedCells',
+    'sheets.spreadsheets.values.batchUpdate': 'totalUpdatedCells',
+    'sheets.spreadsheets.values.batchClear': 'clearedRanges',
+    'sheets.spreadsheets.batchUpdate': 'replies(addSheet(properties(sheetId,title)))',
+    'sheets.spreadsheets.developerMetadata.search': 'matchedDeveloperMetadata(developerMetadata(metadataValue))',
+}
+
+def _thread_http():
+    """Транспорт текущего потока пула SHEETS_EXECUTOR.
+
+    httplib2.Http не потокобезопасен, поэтому у каждого потока свой экземпляр; внутри
+    он держит keep-alive соединение к sheets.googleapis.com, и повторные вызовы из того
+    же потока идут по уже установленному TLS. Общий у всех только токен (get_creds).
+    """
+    http = getattr(_SHEETS_THREAD, 'http', None)
+    if http is None:
+        http = _SHEETS_THREAD.http = google_auth_httplib2.AuthorizedHttp(get_creds(), http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT))
+        _SHEETS_TRANSPORTS.append(http)
+        print(f"[LOG] Sheets transport #{len(_SHEETS_TRANSPORTS)} for {threading.current_thread().name}")
+    creds = http.credentials
+    if not creds.valid:
+        # Обновляем токен один раз под замком, а не параллельно из каждого потока
+        with _SHEETS_CREDS_LOCK:
+            if not creds.valid: creds.refresh(google_auth_httplib2.Request(http.http))
+    return http
+
+def _prepare_request(request):
+    mask = SHEETS_FIELD_MASKS.get(request.methodId)
+    if mask and 'fields=' not in request.uri:
+        request.uri += ('&' if '?' in request.uri else '?') + 'fields=' + quote(mask)
+    # httplib2 сам шлет Accept-Encoding: gzip; "(gzip)" в User-Agent Google просит для сжатых ответов
+    ua = request.headers.get('user-agent', '')
+    if '(gzip)' not in ua: request.headers['user-agent'] = (ua + ' (gzip)').strip()
+    return request
+
+async def sheets_execute(request):
+    """Выполняет запрос Sheets API в пуле потоков, не блокируя event loop.
+
+    Запрос строится как обычно (service.spreadsheets()...), но вместо .execute()
+    передается сюда. Независимые вызовы можно запускать через asyncio.gather.
+    """
+    coalescer = SHEETS_COALESCER.get()
+    if coalescer is not None and not coalescer.closed:
+        read = parse_read_request(request)
+        if read is not None: return await coalescer.read(*read)
+    counter = SHEETS_CALLS.get()
+    if counter is not None: counter[0] += 1
+    _prepare_request(request)
     loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, run)
+    return await loop.run_in_executor(SHEETS_EXECUTOR, lambda: request.execute(http=_thread_http()))
+
+async def sheets_batch_get(service, spreadsheet_id, ranges):
+    """Читает несколько диапазонов одним batchGet, возвращает список values по порядку ranges."""
+    resp = await sheets_execute(service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=list(ranges)))
+    value_ranges = [vr.get('values', []) for vr in resp.get('valueRanges', [])]
+    return value_ranges + [[] for _ in range(len(ranges) - len(value_ranges))]
+
+_READ_PATH_RE = re.compile(r'/spreadsheets/([^/]+)/values(?:/([^/]+)|:batchGet)$')
+
+def parse_read_request(request):
+    """(spreadsheet_id, ranges, single) для простого values.get / values.batchGet, иначе None.
+
+    Запросы с параметрами рендеринга (valueRenderOption и т.п.) не объединяются.
+    """
+    if request.methodId not in ('sheets.spreadsheets.values.get', 'sheets.spreadsheets.values.batchGet'): return None
+    parts = urlsplit(request.uri)
+    query = parse_qs(parts.query)
+    m = _READ_PATH_RE.search(parts.path)
+    if m is None or set(query) - {'alt', 'ranges'}: return None
+    if m.group(2) is not None: return unquote(m.group(1)), [unquote(m.group(2))], True
+    return unquote(m.group(1)), query.get('ranges', []), False
+
+class ReadCoalescer:
+    """Объединяет чтения параллельных под-действий batch в один values.batchGet на таблицу.
+
+    Чтение ждет, пока все еще работающие под-действия тоже не встанут на чтение, но не
+    дольше BATCH_COALESCE_DELAY: под-действие может ждать другое (общий индекс), и
+    ожидание всех сразу тогда бы зависло. Одинаковые диапазоны читаются один раз.
+    """
+
+    def __init__(self, active):
+        self.active = active  # Под-действий, которые еще выполняются
+        self.pending = {}     # spreadsheet_id -> [(ranges, future, single)]
+        self.waiting = 0
+        self.timer = None
+        self.closed = False
+        self.reads = 0
+        self.flushes = 0
+
+    async def read(self, spreadsheet_id, ranges, single):
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(spreadsheet_id, []).append((ranges, fut, single))
+        self.reads += 1; self.waiting += 1
+        if self.waiting >= self.active: self._fire()
+        elif self.timer is None: self.timer = asyncio.get_running_loop().call_later(BATCH_COALESCE_DELAY, self._fire)
+        return await fut
+
+    def finish(self):
+        self.active -= 1
+        if self.waiting and self.waiting >= self.active: self._fire()
+
+    def _fire(self):
+        if self.timer is not None: self.timer.cancel(); self.timer = None
+        pending, self.pending, self.waiting = self.pending, {}, 0
+        for spreadsheet_id, items in pending.items(): asyncio.ensure_future(self._flush(spreadsheet_id, items))
+
+    async def _flush(self, spreadsheet_id, items):
+        SHEETS_COALESCER.set(None)  # Контекст задачи свой: сам batchGet идет мимо объединения
+        ranges = list(dict.fromkeys(r for rs, _, _ in items for r in rs))
+        self.flushes += 1
+        try: by_range = dict(zip(ranges, await sheets_batch_get(get_sheets_service(), spreadsheet_id, ranges)))
+        except Exception as e:
+            for _, fut, _ in items:
+                if not fut.done(): fut.set_exception(e)
+            return
+        for rs, fut, single in items:
+            if fut.done(): continue
+            value_ranges = [{'range': r, 'values': by_range[r]} for r in rs]
+            fut.set_result(value_ranges[0] if single else {'valueRanges': value_ranges})
+
+# --- СХЕМА ТАБЛИЦЫ ---
+
+SHEET_HEADERS = {
+    TRANSACTIONS_SHEET_NAME: ["Дата", "Сумма", "Категория", "Тип", "Комментарий", "Автор", "ID", "Wallet_UUID"],
+    BUDGET_SHEET_NAME: ["Категория", "Лимит", "Обновлено", "Setting_Key", "Setting_Value"],
+    SUBSCRIPTIONS_SHEET_NAME: ["Название", "Сумма", "Категория", "День", "Последняя_оплата", "ID"],
+    DEBTS_SHEET_NAME: ["Название", "Тип", "Остаток", "Ставка%", "ID", "Мин.Платеж"],
+    WALLETS_SHEET_NAME: ["Название", "Баланс", "Тип", "is_default", "UUID"],
+}
+SHEET_SCHEMA_VERSION = 1  # Поднять при изменении SHEET_HEADERS — setup_sheet перепишет заголовки
+SHEET_SCHEMA_KEY = 'sheet_schema_version'
+SHEET_SCHEMA_FIELDS = 'sheets.properties(sheetId,title),developerMetadata(metadataKey,metadataValue)'
+
+class SheetSchema:
+    """Листы таблицы (название -> sheetId) и версия заголовков из метаданных таблицы."""
+
+    def __init__(self, meta):
+        self.sheet_ids = {s['properties']['title']: s['properties']['sheetId'] for s in meta.get('sheets', [])}
+        self.version = 0
+        for m in meta.get('developerMetadata', []):
+            if m.get('metadataKey') == SHEET_SCHEMA_KEY:
+                try: self.version = int(m.get('metadataValue', 0))
+                except ValueError: pass
+
+    def ready(self):
+        return self.version == SHEET_SCHEMA_VERSION and all(t in self.sheet_ids for t in SHEET_HEADERS)
+
+SHEET_SCHEMAS = {}  # sid -> SheetSchema
+
+async def get_sheet_schema(service, spreadsheet_id, refresh=False):
+    schema = SHEET_SCHEMAS.get(spreadsheet_id)
+    if schema is None or refresh:
+        meta = await sheets_execute(service.spreadsheets().get(spreadsheetId=spreadsheet_id, fields=SHEET_SCHEMA_FIELDS))
+        schema = SHEET_SCHEMAS[spreadsheet_id] = SheetSchema(meta)
+    return schema
+
+async def get_sheet_id(service, spreadsheet_id, title):
+    """sheetId для deleteDimension; метаданные перечитываются, только если листа нет в кэше."""
+    schema = await get_sheet_schema(service, spreadsheet_id)
+    if title not in schema.sheet_ids: schema = await get_sheet_schema(service, spreadsheet_id, refresh=True)
+    return schema.sheet_ids[title]
+
+async def get_sheet_row_count(service, spreadsheet_id, title):
+    """Число строк сетки листа (вместе с пустыми в конце) — граница для чтения окнами."""
+    meta = await sheets_execute(service.spreadsheets().get(spreadsheetId=spreadsheet_id, ranges=[f"'{title}'"], fields='sheets.properties.gridProperties.rowCount'))
+    return meta['sheets'][0]['properties']['gridProperties']['rowCount']
+
+async def setup_sheet(spreadsheet_id, refresh=False):
+    """Создает недостающие листы и пишет заголовки, если версия схемы в таблице устарела.
+
+    refresh=True перечитывает метаданные (с маской полей) вместо кэша — для вызовов
+    после ошибки чтения, когда кэш мог разойтись с таблицей.
+    """
+    service = get_sheets_service()
+    try:
+        schema = await get_sheet_schema(service, spreadsheet_id, refresh)
+    except Exception: 
+        raise Exception("Нет доступа к таблице. Проверьте email бота.")
+    if schema.ready(): return
+    print(f"[LOG] Setting up sheet structure for {spreadsheet_id} (schema v{schema.version} -> v{SHEET_SCHEMA_VERSION})")
+    
+    requests = [{"addSheet": {"properties": {"title": t}}} for t in SHEET_HEADERS if t not in schema.sheet_ids]
+    if requests:
+        resp = await sheets_execute(service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': requests}))
+        for reply in resp.get('replies', []):
+            props = reply.get('addSheet', {}).get('properties')
+            if props: schema.sheet_ids[props['title']] = props['sheetId']
+    
+    data = [{'range': f"'{t}'!A1", 'values': [header]} for t, header in SHEET_HEADERS.items()]
+    await sheets_execute(service.spreadsheets().values().batchUpdate(
+        spreadsheetId=spreadsheet_id, body={'valueInputOption': 'USER_ENTERED', 'data': data}
+    ))
+    # Версия пишется последней: если заголовки не записались, следующий вызов повторит
+    await sheets_execute(service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': [
+        {'deleteDeveloperMetadata': {'dataFilter': {'developerMetadataLookup': {'metadataKey': SHEET_SCHEMA_KEY}}}},
+        {'createDeveloperMetadata': {'developerMetadata': {
+            'metadataKey': SHEET_SCHEMA_KEY, 'metadataValue': str(SHEET_SCHEMA_VERSION),
+            'location': {'spreadsheet': True}, 'visibility': 'DOCUMENT'}}},
+    ]}))
+    schema.version = SHEET_SCHEMA_VERSION
+
+# --- КОДЕК СТРОК ТАБЛИЦЫ ---
+
+TX_DATE_FORMAT = '%d.%m.%Y %H:%M:%S'
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_DATE = _EPOCH.date()
+_TX_DAY_RE = re.compile(r"[0-9]{2}\.[0-9]{2}\.[0-9]{4}")
+_TX_DAYS = {}  # 'dd.mm.YYYY' -> (дней от эпохи, year * 12 + month - 1); дат в таблице сотни
+
+def parse_amount(value):
+    """Единственный разбор суммы из ячейки: '1 234,50 ₽' -> 1234.5. Бросает ValueError, как float()."""
+    if type(value) is float or type(value) is int: return float(value)
+    return float(str(value).replace(',', '.').replace(' ', '').replace('\xa0', '').replace('\u202f', '').replace('₽', ''))
+
+def parse_tx_timestamp(value):
+    """'dd.mm.YYYY HH:MM:SS' -> (секунды от эпохи, year * 12 + month - 1).
+
+    День берется из кэша _TX_DAYS, время разбирается срезами. Все остальное
+    (например, без ведущих нулей) уходит в strptime и бросает ValueError так же.
+    """
+    day = _TX_DAYS.get(value[:10])
+    if day is None and _TX_DAY_RE.fullmatch(value[:10]):
+        try:
+            dt = date(int(value[6:10]), int(value[3:5]), int(value[:2]))
+            day = _TX_DAYS[value[:10]] = ((dt - _EPOCH_DATE).days, dt.year * 12 + dt.month - 1)
+        except ValueError: pass
+    if day is not None and len(value) == 19 and value[10] == ' ' and value[13] == ':' and value[16] == ':':
+        hh, mi, ss = value[11:13], value[14:16], value[17:19]
+        if hh.isdigit() and mi.isdigit() and ss.isdigit():
+            hh, mi, ss = int(hh), int(mi), int(ss)
+            if hh < 24 and mi < 60 and ss < 60: return day[0] * 86400 + hh * 3600 + mi * 60 + ss, day[1]
+    dt = datetime.strptime(value, TX_DATE_FORMAT)
+    return (dt - _EPOCH).total_seconds(), dt.year * 12 + dt.month - 1
+
+class TxRecord:
+    """Строка листа транзакций, разобранная один раз.
+
+    ok = False, если не разобрались дата или сумма: такие строки хранятся, чтобы
+    не сбивать нумерацию, но в расчеты не попадают.
+    """
+
+    __slots__ = ('ok', 'ts', 'month', 'amount', 'date', 'category', 'type', 'comment', 'author', 'tx_id', 'wallet')
+
+    @classmethod
+    def decode(cls, r):
+        rec = cls()
+        c = ["" if v is None else str(v) for v in r[:8]]
+        if len(c) < 8: c += [""] * (8 - len(c))
+        rec.date, _, rec.category, rec.type, rec.comment, rec.author, rec.tx_id, rec.wallet = c
+        rec.tx_id = rec.tx_id.strip()
+        rec.ok = True
+        try: rec.ts, rec.month = parse_tx_timestamp(rec.date)
+        except ValueError: rec.ok = False; rec.ts = 0.0; rec.month = 0
+        try: rec.amount = parse_amount(r[1] if len(r) > 1 else "")
+        except ValueError: rec.ok = False; rec.amount = 0.0
+        return rec
+
+    def encode(self):
+        return [self.date, self.amount, self.category, self.type, self.comment, self.author, self.tx_id, self.wallet]
+
+def decode_debt_row(r):
+    """Строка листа долгов -> dict; ValueError/IndexError для битых строк."""
+    min_p = parse_amount(r[5]) if len(r) > 5 and r[5] else 0.0
+    return {"id": r[4], "name": r[0], "type": r[1], "amount": parse_amount(r[2]), "rate": parse_amount(r[3]), "min_payment": min_p}
+
+# --- ИНДЕКС ТРАНЗАКЦИЙ (колоночный, по одному на таблицу) ---
+
+TX_INDEXES = {}
+TX_INDEX_TTL = 120  # После этого индекс перечитывается из таблицы целиком
+TX_INDEX_BUILDS = {}  # spreadsheet_id -> (задача построения, ее extra_ranges): параллельные запросы ждут одну
+BACKGROUND_TASKS = set()  # Снимок и карта месяцев после сборки индекса: ни действие, ни ответ их не ждут
+BACKGROUND_DRAIN_TIMEOUT = float(os.getenv("BACKGROUND_DRAIN_TIMEOUT", "5"))
+_UPDATED_RANGE_RE = re.compile(r"!\$?[A-Z]+\$?(\d+)")
+
+class TransactionIndex:
+    """Разобранный лист транзакций в виде колонок.
+
+    Позиция i соответствует строке листа i + 2. Строки, у которых не разобрались
+    дата или сумма, хранятся с valid = 0, чтобы номера строк не съезжали.
+    Категории, кошельки и авторы хранятся как id в общей таблице строк.
+
+    rollups — свертка по (месяц, категория, вид): вид — income/expense по знаку
+    суммы или transfer для переводов и корректировок. Она поддерживается в
+    append_records/set_row/delete_row, то есть всеми записями через index_after_*,
+    и строится заново вместе с индексом.
+    """
+
+    TRANSFER_CATEGORIES = ("Перевод", "Корректировка")
+
+    def __init__(self, spreadsheet_id):
+        self.spreadsheet_id = spreadsheet_id
+        self.built_at = time.time()
+        self.verified_at = self.built_at  # Когда строки последний раз целиком сверялись с листом (для снимков)
+        self.valid = bytearray()
+        self.ts = array('d')
+        self.months = array('l')
+        self.amounts = array('d')
+        self.category_ids = array('l')
+        self.wallet_ids = array('l')
+        self.author_ids = array('l')
+        self.dates = []
+        self.types = []
+        self.comments = []
+        self.tx_ids = []
+        self.strings = []
+        self._string_ids = {}
+        self._orders = {}  # month_key или None -> (позиции по возрастанию (ts, tx_id), их ключи)
+        self.rollups = {}  # month_key -> {(category_id, вид): [сумма, потрачено, строк, строк с расходом]}
+        self._id_pos = None  # tx_id -> позиция; после удаления строки позиции сдвигаются, карта строится заново
+
+    @classmethod
+    def build(cls, spreadsheet_id, rows):
+        idx = cls(spreadsheet_id)
+        idx.append_rows(rows)
+        return idx
+
+    SNAPSHOT_VERSION = 1
+    _SNAPSHOT_ARRAYS = ('ts', 'months', 'amounts', 'category_ids', 'wallet_ids', 'author_ids')
+
+    def dumps(self):
+        """Снимок колонок: заголовок JSON со строковыми колонками, затем массивы как есть, все через zlib."""
+        head = json.dumps({'v': self.SNAPSHOT_VERSION, 'itemsize': self.months.itemsize, 'verified_at': self.verified_at,
+                           'strings': self.strings, 'dates': self.dates, 'types': self.types, 'comments': self.comments,
+                           'tx_ids': self.tx_ids}, ensure_ascii=False, separators=(',', ':')).encode()
+        parts = [head, bytes(self.valid)] + [getattr(self, name).tobytes() for name in self._SNAPSHOT_ARRAYS]
+        return zlib.compress(b''.join(len(p).to_bytes(4, 'big') + p for p in parts), 1)
+
+    @classmethod
+    def loads(cls, spreadsheet_id, blob):
+        """Обратное dumps; ValueError для снимка другой версии или платформы. Свертка пересчитывается."""
+        data, parts, pos = zlib.decompress(blob), [], 0
+        while pos < len(data):
+            size = int.from_bytes(data[pos:pos + 4], 'big')
+            parts.append(data[pos + 4:pos + 4 + size])
+            pos += 4 + size
+        head = json.loads(parts[0])
+        if head.get('v') != cls.SNAPSHOT_VERSION or head.get('itemsize') != array('l').itemsize or len(parts) != 8:
+            raise ValueError("incompatible snapshot")
+        idx = cls(spreadsheet_id)
+        idx.verified_at = head['verified_at']
+        idx.strings, idx.dates, idx.types, idx.comments, idx.tx_ids = head['strings'], head['dates'], head['types'], head['comments'], head['tx_ids']
+        idx._string_ids = {v: i for i, v in enumerate(idx.strings)}
+        idx.valid = bytearray(parts[1])
+        for name, raw in zip(cls._SNAPSHOT_ARRAYS, parts[2:]): getattr(idx, name).frombytes(raw)
+        if any(len(col) != len(idx.valid) for col in (idx.ts, idx.months, idx.amounts, idx.category_ids, idx.wallet_ids, idx.author_ids,
+                                                      idx.dates, idx.types, idx.comments, idx.tx_ids)):
+            raise ValueError("broken snapshot")
+        for i in range(len(idx.valid)): idx._rollup(i, 1)
+        return idx
+
+    def __len__(self):
+        return len(self.valid)
+
+    def _intern(self, value):
+        sid = self._string_ids.get(value)
+        if sid is None:
+            sid = len(self.strings)
+            self.strings.append(value)
+            self._string_ids[value] = sid
+        return sid
+
+    def append_rows(self, rows):
+        self.append_records(TxRecord.decode(r) for r in rows)
+
+    def append_records(self, records):
+        self._orders.clear()
+        for rec in records:
+            self.valid.append(rec.ok); self.ts.append(rec.ts); self.months.append(rec.month); self.amounts.append(rec.amount)
+            self.category_ids.append(self._intern(rec.category)); self.wallet_ids.append(self._intern(rec.wallet)); self.author_ids.append(self._intern(rec.author))
+            self.dates.append(rec.date); self.types.append(rec.type); self.comments.append(rec.comment); self.tx_ids.append(rec.tx_id)
+            self._rollup(len(self.valid) - 1, 1)
+            if self._id_pos is not None and rec.tx_id: self._id_pos.setdefault(rec.tx_id, len(self.valid) - 1)
+
+    def set_row(self, pos, r):
+        self._orders.clear()
+        self._rollup(pos, -1)
+        rec = TxRecord.decode(r)
+        if rec.tx_id != self.tx_ids[pos]: self._id_pos = None
+        self.valid[pos] = rec.ok; self.ts[pos] = rec.ts; self.months[pos] = rec.month; self.amounts[pos] = rec.amount
+        self.category_ids[pos] = self._intern(rec.category); self.wallet_ids[pos] = self._intern(rec.wallet); self.author_ids[pos] = self._intern(rec.author)
+        self.dates[pos] = rec.date; self.types[pos] = rec.type; self.comments[pos] = rec.comment; self.tx_ids[pos] = rec.tx_id
+        self._rollup(pos, 1)
+
+    def delete_row(self, pos):
+        self._orders.clear()
+        self._id_pos = None
+        self._rollup(pos, -1)
+        for col in (self.valid, self.ts, self.months, self.amounts, self.category_ids, self.wallet_ids,
+                    self.author_ids, self.dates, self.types, self.comments, self.tx_ids):
+            del col[pos]
+
+    def row(self, pos):
+        return [self.dates[pos], self.amounts[pos], self.category(pos), self.types[pos], self.comments[pos],
+                self.author(pos), self.tx_ids[pos], self.wallet(pos)]
+
+    def category(self, pos): return self.strings[self.category_ids[pos]]
+    def wallet(self, pos): return self.strings[self.wallet_ids[pos]]
+    def author(self, pos): return self.strings[self.author_ids[pos]]
+
+    def positions(self, month=None, year=None, category=None):
+        """Позиции валидных строк, опционально за месяц и/или по категории."""
+        valid = self.valid
+        cat_id = self._string_ids.get(category) if category is not None else None
+        if category is not None and cat_id is None:
+            return []
+        if month and year:
+            key = year * 12 + month - 1
+            months = self.months
+            if cat_id is None:
+                return [i for i in range(len(valid)) if valid[i] and months[i] == key]
+            cats = self.category_ids
+            return [i for i in range(len(valid)) if valid[i] and months[i] == key and cats[i] == cat_id]
+        if cat_id is None:
+            return [i for i in range(len(valid)) if valid[i]]
+        cats = self.category_ids
+        return [i for i in range(len(valid)) if valid[i] and cats[i] == cat_id]
+
+    def _sorted(self, month=None, year=None):
+        key = year * 12 + month - 1 if month and year else None
+        order = self._orders.get(key)
+        if order is None:
+            ts, tx_ids = self.ts, self.tx_ids
+            pos = sorted(self.positions(month, year), key=lambda i: (ts[i], tx_ids[i]))
+            order = self._orders[key] = (pos, [(ts[i], tx_ids[i]) for i in pos])
+        return order
+
+    def page(self, month=None, year=None, after=None, offset=0, limit=20):
+        """Страница от новых к старым: (позиции, ключ курсора следующей страницы или None).
+
+        after — ключ (ts, tx_id) последней показанной строки; без него страница
+        отсчитывается по offset. Отсортированный порядок строится один раз и живет
+        до первой правки индекса, так что каждая следующая страница — O(limit).
+        """
+        pos, keys = self._sorted(month, year)
+        end = bisect_left(keys, tuple(after)) if after else max(0, len(pos) - offset)
+        start = max(0, end - limit)
+        return pos[start:end][::-1], (keys[start] if start > 0 else None)
+
+    def history_item(self, pos, empty_category=""):
+        return {"id": self.tx_ids[pos] or None, "date": self.dates[pos], "amount": self.amounts[pos],
+                "category": self.category(pos) or empty_category, "comment": self.comments[pos], "author": self.author(pos)}
+
+    def _rollup(self, pos, sign):
+        """Добавляет (sign=1) или убирает (sign=-1) строку pos из свертки."""
+        if not self.valid[pos]: return
+        month, cat, amt = self.months[pos], self.category_ids[pos], self.amounts[pos]
+        if self.types[pos] == "Перевод" or self.strings[cat] in self.TRANSFER_CATEGORIES: kind = 'transfer'
+        else: kind = 'income' if amt > 0 else 'expense'
+        bucket = self.rollups.setdefault(month, {})
+        entry = bucket.get((cat, kind))
+        if entry is None: entry = bucket[(cat, kind)] = [0.0, 0.0, 0, 0]
+        entry[0] += sign * amt
+        entry[2] += sign
+        if amt < 0:
+            entry[1] -= sign * amt
+            entry[3] += sign
+        if entry[2] == 0:
+            del bucket[(cat, kind)]
+            if not bucket: del self.rollups[month]
+
+    def month_spent(self, category, month_key):
+        """Потрачено по категории за месяц — все отрицательные суммы, как в проверке бюджета. O(1)."""
+        cat = self._string_ids.get(category)
+        bucket = self.rollups.get(month_key)
+        if cat is None or not bucket: return 0.0
+        return sum(e[1] for e in (bucket.get((cat, k)) for k in ('expense', 'income', 'transfer')) if e)
+
+    def monthly_expenses(self, category):
+        """{month_key: потрачено} по категории, month_key = year * 12 + month - 1."""
+        cat = self._string_ids.get(category)
+        if cat is None: return {}
+        totals = {}
+        for month, bucket in self.rollups.items():
+            entries = [e for e in (bucket.get((cat, k)) for k in ('expense', 'income', 'transfer')) if e and e[3]]
+            if entries: totals[month] = sum(e[1] for e in entries)
+        return totals
+
+    def period_totals(self, month=None, year=None, empty_category=""):
+        """(баланс, доходы, расходы, {(категория, income|expense): сумма}) за месяц или за все время.
+
+        Переводы входят в баланс, но не в доходы, расходы и разбивку.
+        """
+        buckets = [self.rollups.get(year * 12 + month - 1, {})] if month and year else self.rollups.values()
+        bal, inc, exp = 0.0, 0.0, 0.0
+        stats = {}
+        for bucket in buckets:
+            for (cat, kind), entry in bucket.items():
+                bal += entry[0]
+                if kind == 'transfer': continue
+                if kind == 'income': inc += entry[0]
+                else: exp += entry[0]
+                key = (self.strings[cat] or empty_category, kind)
+                stats[key] = stats.get(key, 0.0) + entry[0]
+        return bal, inc, exp, stats
+
+    def find(self, tx_id):
+        if self._id_pos is None:
+            self._id_pos = {}
+            for i, t in enumerate(self.tx_ids):
+                if t: self._id_pos.setdefault(t, i)
+        return self._id_pos.get(str(tx_id).strip(), -1)
+
+def encode_history_cursor(key):
+    """(ts, tx_id) -> непрозрачная строка для клиента."""
+    return base64.urlsafe_b64encode(json.dumps(key, ensure_ascii=False).encode()).decode().rstrip('=') if key else None
+
+def decode_history_cursor(cursor):
+    """Обратное encode_history_cursor; ValueError для чужих строк."""
+    try:
+        ts, tx_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return float(ts), str(tx_id)
+    except Exception as e:
+        raise ValueError(f"bad cursor: {e}")
+
+async def get_transaction_index(service, spreadsheet_id, extra_ranges=()):
+    """Возвращает (индекс, [values для extra_ranges]).
+
+    Если индекс свежий, лист транзакций не скачивается; дополнительные диапазоны
+    всегда читаются одним batchGet вместе с транзакциями, когда индекс нужно строить.
+    """
+    idx = TX_INDEXES.get(spreadsheet_id)
+    if idx is not None and time.time() - idx.built_at < TX_INDEX_TTL:
+        if not extra_ranges: return idx, []
+        return idx, await sheets_batch_get(service, spreadsheet_id, extra_ranges)
+
+    extra_ranges = tuple(extra_ranges)
+    build = TX_INDEX_BUILDS.get(spreadsheet_id)
+    if build is not None:
+        task, build_ranges = build
+        if build_ranges == extra_ranges or not extra_ranges:
+            idx, extras = await asyncio.shield(task)
+            return idx, extras if extra_ranges else []
+        # Свои дополнительные диапазоны читаем, пока строится общий индекс
+        (idx, _), extras = await asyncio.gather(asyncio.shield(task), sheets_batch_get(service, spreadsheet_id, extra_ranges))
+        return idx, extras
+
+    task = asyncio.ensure_future(_build_transaction_index(service, spreadsheet_id, extra_ranges))
+    TX_INDEX_BUILDS[spreadsheet_id] = (task, extra_ranges)
+    task.add_done_callback(lambda t: TX_INDEX_BUILDS.pop(spreadsheet_id) if TX_INDEX_BUILDS.get(spreadsheet_id, (None,))[0] is t else None)
+    return await asyncio.shield(task)
+
+async def _build_transaction_index(service, spreadsheet_id, extra_ranges):
+    start = time.time()
+    restored = await load_index_snapshot(service, spreadsheet_id, extra_ranges)
+    if restored is not None:
+        idx, extras = restored
+        TX_INDEXES[spreadsheet_id] = idx
+        print(f"[PERF] Transaction index for {spreadsheet_id} restored from snapshot: {len(idx)} rows in {time.time() - start:.3f} sec")
+        run_in_background(sync_month_partitions(service, idx), 'month partitions sync')
+        return idx, extras
+
+    value_ranges = await sheets_batch_get(service, spreadsheet_id, [f"'{TRANSACTIONS_SHEET_NAME}'!A2:H"] + list(extra_ranges))
+    idx = TransactionIndex.build(spreadsheet_id, value_ranges[0])
+    TX_INDEXES[spreadsheet_id] = idx
+    print(f"[PERF] Transaction index for {spreadsheet_id} built: {len(idx)} rows in {time.time() - start:.3f} sec")
+    # Запись в YDB (до SNAPSHOT_MAX_BYTES) и batchUpdate метаданных не задерживают действие
+    run_in_background(sync_month_partitions(service, idx), 'month partitions sync')
+    run_in_background(save_index_snapshot(idx), 'snapshot save')
+    return idx, value_ranges[1:]
+
+def run_in_background(coro, what):
+    """Запускает необязательную запись без ожидания. Если контейнер заморозят после ответа,
+    она просто потеряется: следующий холодный контейнер перечитает лист и сохранит заново."""
+    async def guarded():
+        try: await coro
+        except Exception as e: print(f"[ERROR] Background {what}: {e}")
+    task = asyncio.ensure_future(guarded())
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+async def drain_background_tasks():
+    """Дожидается фоновых записей (не дольше BACKGROUND_DRAIN_TIMEOUT) — в timer_handler, где ответа никто не ждет."""
+    if not BACKGROUND_TASKS: return
+    start = time.time()
+    _, pending = await asyncio.wait(set(BACKGROUND_TASKS), timeout=BACKGROUND_DRAIN_TIMEOUT)
+    if pending: print(f"[LOG] {len(pending)} background tasks still running after {BACKGROUND_DRAIN_TIMEOUT} sec")
+    else: print(f"[PERF] Background tasks drained in {time.time() - start:.3f} sec")
+
+async def read_transaction_index(service, spreadsheet_id, extra_ranges=()):
+    """Индекс, прочитанный сейчас (снимок + хвост или лист целиком), мимо TX_INDEXES и его TTL —
+    для фоновых проверок, которые не должны вытеснять общий индекс запросов."""
+    restored = await load_index_snapshot(service, spreadsheet_id, extra_ranges)
+    if restored is not None: return restored
+    value_ranges = await sheets_batch_get(service, spreadsheet_id, [f"'{TRANSACTIONS_SHEET_NAME}'!A2:H"] + list(extra_ranges))
+    return TransactionIndex.build(spreadsheet_id, value_ranges[0]), value_ranges[1:]
+
+def transaction_index_fresh(spreadsheet_id):
+    idx = TX_INDEXES.get(spreadsheet_id)
+    return idx is not None and time.time() - idx.built_at < TX_INDEX_TTL
+
+async def get_transactions(service, spreadsheet_id, month=None, year=None, extra_ranges=()):
+    """get_transaction_index для чтений с фильтром по месяцу.
+
+    Если индекс холодный, а фильтр задан целиком, скачиваются только строки этого
+    месяца (get_month_view). Индекс-вид не кэшируется и годится только для чтения.
+    """
+    if month and year and not transaction_index_fresh(spreadsheet_id):
+        view = await get_month_view(service, spreadsheet_id, year * 12 + month - 1, extra_ranges)
+        if view is not None: return view
+    return await get_transaction_index(service, spreadsheet_id, extra_ranges)
+
+def drop_transaction_index(spreadsheet_id):
+    TX_INDEXES.pop(spreadsheet_id, None)
+
+def index_after_append(spreadsheet_id, rows, append_response):
+    """Дописывает добавленные строки в индекс, если они легли сразу за известным концом листа."""
+    idx = TX_INDEXES.get(spreadsheet_id)
+    if idx is None: return
+    updated = (append_response or {}).get('updates', {}).get('updatedRange', '')
+    m = _UPDATED_RANGE_RE.search(updated)
+    if m and int(m.group(1)) == len(idx) + 2:
+        idx.append_rows(rows)
+    else:
+        print(f"[LOG] Transaction index out of sync ({updated}), dropping")
+        drop_transaction_index(spreadsheet_id)
+
+def index_after_update(spreadsheet_id, pos, row):
+    idx = TX_INDEXES.get(spreadsheet_id)
+    if idx is None: return
+    if pos < len(idx) and idx.tx_ids[pos] == str(row[6]).strip(): idx.set_row(pos, row)
+    else: drop_transaction_index(spreadsheet_id)
+
+def index_after_delete(spreadsheet_id, pos, tx_id):
+    # Строки ниже удаленной сдвинулись: карта месяцев в метаданных удалена тем же
+    # batchUpdate, что и строка (MONTH_PARTITIONS_DELETE), здесь забываем ее в памяти
+    TX_PARTITIONS.pop(spreadsheet_id, None)
+    TX_PARTITIONS_SAVED.pop(spreadsheet_id, None)
+    idx = TX_INDEXES.get(spreadsheet_id)
+    if idx is None: return
+    if pos < len(idx) and idx.tx_ids[pos] == str(tx_id).strip(): idx.delete_row(pos)
+    else: drop_transaction_index(spreadsheet_id)
+
+async def locate_transaction(service, spreadsheet_id, tx_id):
+    """Находит транзакцию по ID: (позиция, TxRecord, индекс кошельков) или (-1, None, кошельки).
+
+    Позиция берется из индекса, даже устаревшего, и сверяется с самой строкой листа,
+    которая читается тем же batchGet, что и кошельки (всегда свежие — по ним пишут). Если строка уехала (правка
+    руками, запись из другого контейнера) или индекса нет, индекс строится заново.
+    """
+    tx_id = str(tx_id).strip()
+    idx = TX_INDEXES.get(spreadsheet_id)
+    pos = idx.find(tx_id) if idx is not None else -1
+    if pos != -1:
+        wallets, (got,) = await get_wallet_index(service, spreadsheet_id, [f"'{TRANSACTIONS_SHEET_NAME}'!A{pos+2}:H{pos+2}"], fresh=True)
+        rec = TxRecord.decode(got[0] if got else [])
+        if rec.tx_id == tx_id: return pos, rec, wallets
+        print(f"[LOG] Transaction {tx_id} is not at row {pos+2} anymore, rebuilding index")
+    drop_transaction_index(spreadsheet_id)
+
+    idx, (w_rows,) = await get_transaction_index(service, spreadsheet_id, [WALLETS_RANGE])
+    wallets = wallet_index_from_rows(spreadsheet_id, w_rows)
+    pos = idx.find(tx_id)
+    return pos, (TxRecord.decode(idx.row(pos)) if pos != -1 else None), wallets
+
+# --- СНИМКИ ИНДЕКСА (второй уровень кэша) ---
+
+# Холодный контейнер поднимает индекс из снимка и дочитывает только строки, добавленные
+# после него. Снимок сверяется с листом по последней строке (ее номер и ID — ревизия снимка);
+# правки в середине листа из приложения пересохраняют снимок, ручные — ловит SNAPSHOT_MAX_AGE.
+SNAPSHOT_STORE_URL = os.getenv("SNAPSHOT_STORE", "ydb")                # 'ydb', 'file:<каталог>' или 'off'
+SNAPSHOT_MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", "1800"))          # Секунд от последнего полного чтения листа
+SNAPSHOT_MAX_BYTES = int(os.getenv("SNAPSHOT_MAX_BYTES", str(4 * 1024 * 1024)))
+SNAPSHOT_RESAVE_TAIL = 200  # Столько дочитанных строк — и снимок пересохраняется
+
+class YdbSnapshotStore:
+    """sheet_snapshots (spreadsheet_id, verified_at Double, saved_at Timestamp, payload String)."""
+
+    async def load(self, spreadsheet_id):
+        res = await ydb_query('get_snapshot', {'$spreadsheet_id': ydb_text(spreadsheet_id)})
+        if not res or not res[0].rows: return None
+        row = res[0].rows[0]
+        return row.verified_at, row.payload
+
+    async def save(self, spreadsheet_id, verified_at, payload):
+        await ydb_query('upsert_snapshot', {'$spreadsheet_id': ydb_text(spreadsheet_id), '$verified_at': float(verified_at), '$payload': payload})
+
+    async def delete(self, spreadsheet_id):
+        await ydb_query('delete_snapshot', {'$spreadsheet_id': ydb_text(spreadsheet_id)})
+
+class FileSnapshotStore:
+    """Снимки файлами в каталоге — для локального запуска и проверок без YDB."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, spreadsheet_id):
+        return os.path.join(self.directory, hashlib.sha1(spreadsheet_id.encode()).hexdigest() + '.snap')
+
+    def _read(self, spreadsheet_id):
+        try:
+            with open(self._path(spreadsheet_id), 'rb') as f: data = f.read()
+        except FileNotFoundError: return None
+        return float(data[:24].decode()), data[24:]
+
+    def _write(self, spreadsheet_id, verified_at, payload):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(spreadsheet_id)
+        with open(path + '.tmp', 'wb') as f: f.write(f"{verified_at:<24.6f}".encode() + payload)
+        os.replace(path + '.tmp', path)
+
+    async def load(self, spreadsheet_id):
+        return await asyncio.to_thread(self._read, spreadsheet_id)
+
+    async def save(self, spreadsheet_id, verified_at, payload):
+        await asyncio.to_thread(self._write, spreadsheet_id, verified_at, payload)
+
+    async def delete(self, spreadsheet_id):
+        try: await asyncio.to_thread(os.remove, self._path(spreadsheet_id))
+        except FileNotFoundError: pass
+
+def make_snapshot_store(url):
+    if url == 'ydb': return YdbSnapshotStore()
+    if url.startswith('file:'): return FileSnapshotStore(url[5:])
+    return None
+
+SNAPSHOT_STORE = make_snapshot_store(SNAPSHOT_STORE_URL)
+SNAPSHOTS_PENDING = set()  # spreadsheet_id, где строку в середине листа поменяли, а ревизию еще не подняли
+
+async def save_index_snapshot(idx):
+    if SNAPSHOT_STORE is None or not len(idx): return
+    try:
+        start = time.time()
+        blob = idx.dumps()
+        if len(blob) > SNAPSHOT_MAX_BYTES:
+            print(f"[LOG] Snapshot for {idx.spreadsheet_id} too large ({len(blob)} bytes), not saved")
+            return
+        await SNAPSHOT_STORE.save(idx.spreadsheet_id, idx.verified_at, blob)
+        print(f"[PERF] Snapshot for {idx.spreadsheet_id} saved: {len(idx)} rows, {len(blob)} bytes in {time.time() - start:.3f} sec")
+    except Exception as e:
+        print(f"[ERROR] Snapshot save: {e}")
+
+async def delete_index_snapshot(spreadsheet_id):
+    if SNAPSHOT_STORE is None: return
+    try: await SNAPSHOT_STORE.delete(spreadsheet_id)
+    except Exception as e: print(f"[ERROR] Snapshot delete: {e}")
+
+def mark_snapshot_pending(spreadsheet_id):
+    """После правки или удаления строки в середине листа: хвостом такое не дочитать, и
+    старый снимок больше не годится. Что с ним делать, решает settle_index_snapshot
+    после bump_revision: только там видно, не писал ли кто-то еще."""
+    SNAPSHOTS_PENDING.add(spreadsheet_id)
+
+async def settle_index_snapshot(spreadsheet_id, in_sync):
+    """in_sync — ревизия выросла ровно на эту запись, значит индекс контейнера совпадает с листом
+    и его можно сохранить. Иначе в индексе могут быть строки, которые правил другой контейнер
+    (якорь при загрузке проверяет только последнюю), и снимок удаляется."""
+    SNAPSHOTS_PENDING.discard(spreadsheet_id)
+    # Старый снимок удаляется сразу: потерянная при заморозке фоновая запись не оставит его жить
+    await delete_index_snapshot(spreadsheet_id)
+    idx = TX_INDEXES.get(spreadsheet_id)
+    if in_sync and idx is not None: run_in_background(save_index_snapshot(idx), 'snapshot save')
+
+async def load_index_snapshot(service, spreadsheet_id, extra_ranges=()):
+    """(индекс, [values для extra_ranges]) из снимка или None.
+
+    Одним batchGet читаются последняя строка снимка, все строки после нее и
+    extra_ranges. Если последняя строка не совпала (удаление, вставка, ручная
+    правка), снимок не годится и вызывающий строит индекс целиком.
+    """
+    if SNAPSHOT_STORE is None: return None
+    try:
+        found = await SNAPSHOT_STORE.load(spreadsheet_id)
+        if found is None or time.time() - found[0] > SNAPSHOT_MAX_AGE: return None
+        idx = TransactionIndex.loads(spreadsheet_id, found[1])
+    except Exception as e:
+        print(f"[ERROR] Snapshot load: {e}")
+        return None
+    n = len(idx)
+    if not n: return None
+    value_ranges = await sheets_batch_get(service, spreadsheet_id, [f"'{TRANSACTIONS_SHEET_NAME}'!A{n + 1}:H"] + list(extra_ranges))
+    tail = value_ranges[0]
+    anchor = TxRecord.decode(tail[0]) if tail else None
+    if anchor is None or anchor.tx_id != idx.tx_ids[n - 1] or anchor.date != idx.dates[n - 1]:
+        print(f"[LOG] Snapshot for {spreadsheet_id} does not match row {n + 1}, rebuilding")
+        return None
+    idx.append_rows(tail[1:])
+    idx.built_at = time.time()
+    if len(tail) - 1 >= SNAPSHOT_RESAVE_TAIL: run_in_background(save_index_snapshot(idx), 'snapshot save')
+    return idx, value_ranges[1:]
+
+# --- РАЗБИЕНИЕ ТРАНЗАКЦИЙ ПО МЕСЯЦАМ ---
+
+TX_PARTITIONS = {}        # sid -> MonthPartitions
+TX_PARTITIONS_SAVED = {}  # sid -> MonthPartitions, записанное в метаданные таблицы
+TX_PARTITIONS_KEY = 'tx_month_partitions'
+TX_PARTITIONS_MIN_ROWS = int(os.getenv("TX_PARTITIONS_MIN_ROWS", "500"))  # На маленьких таблицах полное чтение дешевле
+TX_PARTITIONS_MAX_TAIL = 300      # Столько строк после сохраненного конца дочитываются, потом карта пересохраняется
+TX_PARTITIONS_MAX_CHARS = 20000   # Лимит метаданных Sheets — 30000 символов на таблицу
+
+class MonthPartitions:
+    """month_key -> отрезки строк листа [(первая, последняя)], по данным на момент построения.
+
+    rows — сколько строк транзакций было учтено; все, что ниже, — «хвост», который
+    дочитывается целиком. Карта хранится в developer metadata таблицы, чтобы холодный
+    контейнер мог прочитать старый месяц, не скачивая всю историю.
+    """
+
+    def __init__(self, months, rows):
+        self.months = months
+        self.rows = rows
+
+    @classmethod
+    def from_index(cls, idx, upto=None):
+        months = {}
+        valid, keys = idx.valid, idx.months
+        n = len(idx) if upto is None else min(upto, len(idx))
+        for i in range(n):
+            if not valid[i]: continue
+            runs = months.setdefault(keys[i], [])
+            if runs and runs[-1][1] == i + 1: runs[-1][1] = i + 2
+            else: runs.append([i + 2, i + 2])
+        return cls(months, n)
+
+    def dumps(self):
+        return json.dumps({'rows': self.rows, 'months': {str(k): v for k, v in self.months.items()}}, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, value):
+        data = json.loads(value)
+        return cls({int(k): v for k, v in data['months'].items()}, int(data['rows']))
+
+async def load_month_partitions(service, spreadsheet_id):
+    parts = TX_PARTITIONS.get(spreadsheet_id)
+    if parts is not None: return parts
+    try:
+        resp = await sheets_execute(service.spreadsheets().developerMetadata().search(spreadsheetId=spreadsheet_id, body={
+            'dataFilters': [{'developerMetadataLookup': {'metadataKey': TX_PARTITIONS_KEY}}]}))
+        found = resp.get('matchedDeveloperMetadata', [])
+        if not found: return None
+        parts = MonthPartitions.loads(found[0]['developerMetadata']['metadataValue'])
+    except Exception as e:
+        print(f"[ERROR] Month partitions load: {e}")
+        return None
+    TX_PARTITIONS[spreadsheet_id] = TX_PARTITIONS_SAVED[spreadsheet_id] = parts
+    return parts
+
+MONTH_PARTITIONS_DELETE = {'deleteDeveloperMetadata': {'dataFilter': {'developerMetadataLookup': {'metadataKey': TX_PARTITIONS_KEY}}}}
+
+async def save_month_partitions(service, spreadsheet_id, parts):
+    """Перезаписывает карту в метаданных; parts=None просто удаляет ее."""
+    requests = [MONTH_PARTITIONS_DELETE]
+    if parts is not None:
+        value = parts.dumps()
+        if len(value) > TX_PARTITIONS_MAX_CHARS:
+            print(f"[LOG] Month partitions for {spreadsheet_id} too large ({len(value)} chars), not persisted")
+            parts, value = None, None
+        else:
+            requests.append({'createDeveloperMetadata': {'developerMetadata': {
+                'metadataKey': TX_PARTITIONS_KEY, 'metadataValue': value,
+                'location': {'spreadsheet': True}, 'visibility': 'DOCUMENT'}}})
+    try:
+        await sheets_execute(service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': requests}))
+        if parts is None: TX_PARTITIONS_SAVED.pop(spreadsheet_id, None)
+        else: TX_PARTITIONS_SAVED[spreadsheet_id] = parts
+    except Exception as e:
+        print(f"[ERROR] Month partitions save: {e}")
+
+async def sync_month_partitions(service, idx):
+    """После полной сборки индекса: обновляет карту в памяти и, если сохраненная
+    разошлась с таблицей или хвост вырос, пересохраняет ее."""
+    sid = idx.spreadsheet_id
+    parts = TX_PARTITIONS[sid] = MonthPartitions.from_index(idx)
+    if len(idx) < TX_PARTITIONS_MIN_ROWS: return
+    saved = TX_PARTITIONS_SAVED.get(sid)
+    if saved is not None and saved.rows <= len(idx) and len(idx) - saved.rows <= TX_PARTITIONS_MAX_TAIL \
+            and MonthPartitions.from_index(idx, upto=saved.rows).months == saved.months:
+        return
+    await save_month_partitions(service, sid, parts)
+
+async def invalidate_month_partitions(service, spreadsheet_id):
+    """Дата строки сменила месяц: такую правку по карте не обнаружить, поэтому карта удаляется."""
+    TX_PARTITIONS.pop(spreadsheet_id, None)
+    if TX_PARTITIONS_SAVED.get(spreadsheet_id) is not None:
+        await save_month_partitions(service, spreadsheet_id, None)
+
+async def get_month_view(service, spreadsheet_id, month_key, extra_ranges=()):
+    """(индекс только из строк месяца, [values для extra_ranges]) или None, если карты нет или она устарела.
+
+    Читаются отрезки месяца и хвост после rows одним batchGet. Каждая строка отрезка
+    обязана быть валидной и из этого месяца, иначе вызывающий откатывается на полный
+    индекс. Сдвиг на одну строку эта проверка ловит не всегда, поэтому удаление из
+    приложения удаляет карту сразу (delete_transaction), а правка со сменой месяца —
+    invalidate_month_partitions. Ручные удаления и вставки видны только после пересборки.
+    """
+    parts = await load_month_partitions(service, spreadsheet_id)
+    if parts is None: return None
+    runs = parts.months.get(month_key, [])
+    ranges = [f"'{TRANSACTIONS_SHEET_NAME}'!A{a}:H{b}" for a, b in runs] + [f"'{TRANSACTIONS_SHEET_NAME}'!A{parts.rows + 2}:H"]
+    start = time.time()
+    value_ranges = await sheets_batch_get(service, spreadsheet_id, ranges + list(extra_ranges))
+
+    records = []
+    for (a, b), values in zip(runs, value_ranges):
+        if len(values) != b - a + 1: break
+        recs = [TxRecord.decode(r) for r in values]
+        if not all(rec.ok and rec.month == month_key for rec in recs): break
+        records.extend(recs)
+    else:
+        records.extend(rec for rec in map(TxRecord.decode, value_ranges[len(runs)]) if rec.month == month_key)
+        view = TransactionIndex(spreadsheet_id)
+        view.append_records(records)
+        print(f"[PERF] Month view {month_key} for {spreadsheet_id}: {len(view)} rows from {len(runs)} ranges in {time.time() - start:.3f} sec")
+        return view, value_ranges[len(runs) + 1:]
+
+    print(f"[LOG] Month partitions for {spreadsheet_id} are stale, falling back to full index")
+    TX_PARTITIONS.pop(spreadsheet_id, None)
+    return None
+
+def benchmark_row_codec(n=20000, seed=7):
+    """Стоимость разбора строки: старый путь (dict + strptime дважды + цепочка replace)
+    против TxRecord.decode и полной сборки TransactionIndex. Запуск: python main.py bench-codec
+    """
+    import random
+    rnd = random.Random(seed)
+    rows = [[f"{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}.{rnd.randint(2022, 2025)} {rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d}",
+             f"{rnd.uniform(-50000, 50000):.2f}".replace('.', ','), f"cat{rnd.randint(1, 30)}", "Расход", "", "user", str(uuid.uuid4()), "w1"] for _ in range(n)]
+
+    def legacy():
+        hist = []
+        for r in rows:
+            try:
+                amt = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', ''))
+                datetime.strptime(r[0], TX_DATE_FORMAT)
+                hist.append({"id": r[6], "date": r[0], "amount": amt, "category": r[2], "comment": r[4], "author": r[5]})
+            except: continue
+        hist.sort(key=lambda x: datetime.strptime(x['date'], TX_DATE_FORMAT), reverse=True)
+
+    report = {}
+    for name, fn in (('legacy', legacy), ('record', lambda: [TxRecord.decode(r) for r in rows]),
+                     ('index', lambda: TransactionIndex.build('bench', rows))):
+        _TX_DAYS.clear()
+        start = time.perf_counter(); fn()
+        report[name] = (time.perf_counter() - start) / n * 1e6
+        print(f"[PERF] row codec {name}: {report[name]:.2f} us/row")
+    return report
+
+# --- ИНДЕКС КОШЕЛЬКОВ ---
+
+WALLETS_RANGE = f"'{WALLETS_SHEET_NAME}'!A2:E"
+WALLET_INDEXES = {}
+WALLET_INDEX_TTL = int(os.getenv("WALLET_INDEX_TTL", "30"))  # Кэш только для чтений: записи читают лист заново
+WALLET_LOCKS = {}
+
+class WalletIndex:
+    """UUID кошелька -> строка листа и текущий баланс.
+
+    Изменения балансов ставятся в SheetWriteBatch через queue_deltas: все дельты
+    одного действия складываются, и на каждый кошелек уходит одна ячейка B.
+    Баланс пишется абсолютным значением, поэтому индекс для записи должен быть
+    прочитан только что (get_wallet_index(..., fresh=True)), а не взят из кэша.
+    """
+
+    def __init__(self, spreadsheet_id, rows):
+        self.spreadsheet_id = spreadsheet_id
+        self.built_at = time.time()
+        self.positions = {}   # uuid -> позиция (строка листа = позиция + 2)
+        self.balances = []
+        self.default_uuid = None
+        first_valid_uuid = None
+        for i, r in enumerate(rows):
+            try: balance = parse_amount(r[1]) if len(r) > 1 else 0.0
+            except: balance = 0.0
+            self.balances.append(balance)
+            if len(r) < 5: continue
+            w_uuid = str(r[4]).strip()
+            self.positions.setdefault(w_uuid, i)
+            if not first_valid_uuid: first_valid_uuid = w_uuid
+            if not self.default_uuid and str(r[3]).upper() == 'TRUE': self.default_uuid = w_uuid
+        self.default_uuid = self.default_uuid or first_valid_uuid
+
+    def __contains__(self, wallet_uuid):
+        return str(wallet_uuid).strip() in self.positions
+
+    def balance(self, wallet_uuid):
+        pos = self.positions.get(str(wallet_uuid).strip())
+        return None if pos is None else self.balances[pos]
+
+    def set_balance(self, batch, wallet_uuid, value):
+        pos = self.positions.get(str(wallet_uuid).strip())
+        if pos is None: return False
+        self.balances[pos] = value
+        batch.update(f"'{WALLETS_SHEET_NAME}'!B{pos + 2}", [[value]])
+        return True
+
+    def queue_deltas(self, batch, deltas):
+        """deltas — пары (uuid, сумма). Неизвестные и пустые UUID пропускаются."""
+        totals = {}
+        for wallet_uuid, delta in deltas:
+            if not wallet_uuid or not delta: continue
+            key = str(wallet_uuid).strip()
+            totals[key] = totals.get(key, 0.0) + delta
+        for wallet_uuid, delta in totals.items():
+            pos = self.positions.get(wallet_uuid)
+            if pos is None:
+                print(f"[LOG] Wallet {wallet_uuid} not found, delta {delta} skipped")
+                continue
+            self.set_balance(batch, wallet_uuid, self.balances[pos] + delta)
+            print(f"[LOG] Wallet {wallet_uuid} queued: {delta:+} -> {self.balances[pos]}")
+
+async def get_wallet_index(service, spreadsheet_id, extra_ranges=(), fresh=False):
+    """Возвращает (индекс кошельков, [values для extra_ranges]) — как get_transaction_index.
+
+    fresh=True — для записей: лист кошельков читается тем же batchGet, что и extra_ranges.
+    """
+    widx = WALLET_INDEXES.get(spreadsheet_id)
+    if not fresh and widx is not None and time.time() - widx.built_at < WALLET_INDEX_TTL:
+        if not extra_ranges: return widx, []
+        return widx, await sheets_batch_get(service, spreadsheet_id, extra_ranges)
+
+    value_ranges = await sheets_batch_get(service, spreadsheet_id, [WALLETS_RANGE] + list(extra_ranges))
+    return wallet_index_from_rows(spreadsheet_id, value_ranges[0]), value_ranges[1:]
+
+def wallet_index_fresh(spreadsheet_id):
+    widx = WALLET_INDEXES.get(spreadsheet_id)
+    return widx is not None and time.time() - widx.built_at < WALLET_INDEX_TTL
+
+def wallet_index_from_rows(spreadsheet_id, rows):
+    """Строит и кэширует индекс из уже прочитанного WALLETS_RANGE."""
+    widx = WALLET_INDEXES[spreadsheet_id] = WalletIndex(spreadsheet_id, rows)
+    return widx
+
+def drop_wallet_index(spreadsheet_id):
+    WALLET_INDEXES.pop(spreadsheet_id, None)
+
+def wallet_write_lock(spreadsheet_id):
+    """Чтение балансов и их запись внутри контейнера идут по очереди: иначе два действия
+    прочитают один и тот же баланс, и второе затрет дельту первого."""
+    lock = WALLET_LOCKS.get(spreadsheet_id)
+    if lock is None: lock = WALLET_LOCKS[spreadsheet_id] = asyncio.Lock()
+    return lock
+
+# --- ПАКЕТНАЯ ЗАПИСЬ В ТАБЛИЦУ ---
+
+class SheetWriteBatch:
+    """Записи одного действия: изменения ячеек и добавления строк.
+
+    commit() отправляет все изменения одним values.batchUpdate и не более чем
+    одним append на лист, параллельно. Повторная запись в тот же диапазон
+    заменяет предыдущую.
+    """
+
+    def __init__(self, spreadsheet_id):
+        self.spreadsheet_id = spreadsheet_id
+        self.updates = {}   # range -> values (порядок вставки сохраняется)
+        self.appends = {}   # sheet name -> rows
+
+    def __bool__(self):
+        return bool(self.updates or self.appends)
+
+    def update(self, range_, values):
+        self.updates.pop(range_, None)
+        self.updates[range_] = values
+
+    def append(self, sheet_name, rows):
+        self.appends.setdefault(sheet_name, []).extend(rows)
+
+    async def commit(self, service):
+        if self: await get_sheet_writer(self.spreadsheet_id).submit(service, self)
+
+class SheetWriter:
+    """Групповая фиксация записей в одну таблицу.
+
+    Пока идет запись, пакеты других действий этого контейнера копятся в
+    pending и уходят следующей общей записью.
+    """
+
+    def __init__(self, spreadsheet_id):
+        self.spreadsheet_id = spreadsheet_id
+        self.pending = []
+        self.lock = asyncio.Lock()
+
+    async def submit(self, service, batch):
+        done = asyncio.get_running_loop().create_future()
+        self.pending.append((batch, done))
+        async with self.lock:
+            if not done.done():
+                items, self.pending = self.pending, []
+                try:
+                    await self._flush(service, [b for b, _ in items])
+                except Exception as e:
+                    for _, fut in items:
+                        if not fut.done(): fut.set_exception(e)
+                else:
+                    for _, fut in items:
+                        if not fut.done(): fut.set_result(None)
+        return await done
+
+    async def _flush(self, service, batches):
+        sid = self.spreadsheet_id
+        updates, appends = {}, {}
+        for b in batches:
+            for rng, values in b.updates.items():
+                updates.pop(rng, None)
+                updates[rng] = values
+            for sheet, rows in b.appends.items():
+                appends.setdefault(sheet, []).extend(rows)
+        if len(batches) > 1: print(f"[LOG] Coalesced {len(batches)} write batches for {sid}")
+
+        calls = []
+        if updates:
+            data = [{'range': rng, 'values': values} for rng, values in updates.items()]
+            calls.append(sheets_execute(service.spreadsheets().values().batchUpdate(spreadsheetId=sid, body={'valueInputOption': 'USER_ENTERED', 'data': data})))
+        sheets = list(appends)
+        for sheet in sheets:
+            calls.append(sheets_execute(service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{sheet}'", valueInputOption='USER_ENTERED', body={'values': appends[sheet]})))
+        try:
+            results = await asyncio.gather(*calls)
+        except Exception:
+            # Балансы в индексе кошельков уже сдвинуты под эту запись
+            drop_wallet_index(sid)
+            raise
+
+        for sheet, resp in zip(sheets, results[1:] if updates else results):
+            if sheet == TRANSACTIONS_SHEET_NAME: index_after_append(sid, appends[sheet], resp)
+            elif sheet == WALLETS_SHEET_NAME: drop_wallet_index(sid)
+
+SHEET_WRITERS = {}
+
+def get_sheet_writer(spreadsheet_id):
+    writer = SHEET_WRITERS.get(spreadsheet_id)
+    if writer is None: writer = SHEET_WRITERS[spreadsheet_id] = SheetWriter(spreadsheet_id)
+    return writer
 
 # --- DEBT STRATEGY ENGINE (v3.7: SAFETY NET LOGIC) ---
 
@@ -249,14 +1643,35 @@ class DebtStrategist:
         if debt.get('min_payment', 0) <= 0: return 9999 
         return debt['amount'] / debt['min_payment']
 
-    def simulate_payoff(self, strategy='avalanche', one_time_payment=0):
-        sim_debts = [d.copy() for d in self.debts]
-        sim_savings = self.current_savings
-        
+    def payoff_order(self, strategy):
+        """Индексы self.debts в порядке, в котором стратегия гасит долги свободными деньгами."""
+        order = list(range(len(self.debts)))
         if strategy == 'avalanche':
-            sim_debts.sort(key=lambda x: x['rate'], reverse=True)
+            order.sort(key=lambda i: self.debts[i]['rate'], reverse=True)
         elif strategy == 'snowball':
-            sim_debts.sort(key=lambda x: x['amount'])
+            order.sort(key=lambda i: self.debts[i]['amount'])
+        return order
+
+    @staticmethod
+    def freedom_date(months):
+        now = datetime.now()
+        year = now.year + (now.month + months - 1) // 12
+        month = (now.month + months - 1) % 12 + 1
+        return f"{month:02d}.{year}"
+
+    def simulate_many(self, scenarios):
+        """scenarios — список (strategy, extra_monthly_payment, one_time_payment).
+
+        Большие портфели с NumPy считаются одним проходом (DebtScenarioEngine),
+        остальные — по очереди через simulate_payoff. Результаты одинаковые.
+        """
+        if len(self.debts) * len(scenarios) >= DebtScenarioEngine.MIN_CELLS and load_numpy() is not None: return DebtScenarioEngine(self).run(scenarios)
+        return [self.simulate_payoff(strategy, one_time, extra_monthly_payment=extra) for strategy, extra, one_time in scenarios]
+
+    def simulate_payoff(self, strategy='avalanche', one_time_payment=0, extra_monthly_payment=None):
+        sim_debts = [self.debts[i].copy() for i in self.payoff_order(strategy)]
+        sim_savings = self.current_savings
+        extra_money = self.extra_money if extra_monthly_payment is None else float(extra_monthly_payment)
 
         total_interest_paid = 0
         months = 0
@@ -272,7 +1687,7 @@ class DebtStrategist:
                     d['amount'] += interest
                     total_interest_paid += interest
 
-            monthly_surplus = self.extra_money
+            monthly_surplus = extra_money
             if months == 1:
                 monthly_surplus += float(one_time_payment)
             
@@ -305,123 +1720,329 @@ class DebtStrategist:
                         monthly_surplus -= payment
                         if monthly_surplus <= 0: break
         
-        freedom_date = datetime.now()
-        year = freedom_date.year + (freedom_date.month + months - 1) // 12
-        month = (freedom_date.month + months - 1) % 12 + 1
-        freedom_str = f"{month:02d}.{year}"
-
         return {
             "strategy": strategy,
             "months_to_free": months,
-            "freedom_date": freedom_str,
+            "freedom_date": self.freedom_date(months),
             "total_interest": round(total_interest_paid, 2),
             "months_saved_emergency": months_filling_emergency,
             "is_emergency_first": (self.current_savings < self.emergency_goal)
         }
 
-# --- BUSINESS LOGIC HELPERS ---
+class DebtScenarioEngine:
+    """NumPy-версия simulate_payoff для пачки сценариев одного портфеля.
 
-def get_default_wallet_uuid(service, spreadsheet_id):
-    try:
-        resp = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f"'{WALLETS_SHEET_NAME}'!A2:E").execute()
-        rows = resp.get('values', [])
-        first_valid_uuid = None
-        for r in rows:
-            if len(r) >= 5:
-                if not first_valid_uuid: first_valid_uuid = r[4]
-                if str(r[3]).upper() == 'TRUE': return r[4]
-        return first_valid_uuid
-    except Exception as e:
-        print(f"[ERROR] getting default wallet: {e}")
-    return None
-
-def update_wallet_balance(service, spreadsheet_id, wallet_uuid, delta_amount):
-    print(f"[LOG] Updating wallet {wallet_uuid} by {delta_amount}")
-    if not wallet_uuid or delta_amount == 0: return
+    Остатки хранятся матрицей [сценарий x долг], столбцы каждой строки уже
+    переставлены в порядке стратегии сценария. Проценты и минимальные платежи
+    считаются поэлементно, распределение свободных денег — через cumsum по строке.
+    Сценарий, у которого долги кончились, замораживается маской active.
+    """
 
-    try:
-        resp = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f"'{WALLETS_SHEET_NAME}'!A2:E").execute()
-        rows = resp.get('values', [])
-        target_index = -1
-        current_balance = 0.0
-        
-        for i, r in enumerate(rows):
-            if len(r) >= 5 and str(r[4]).strip() == str(wallet_uuid).strip():
-                target_index = i
-                try: current_balance = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', ''))
-                except: current_balance = 0.0
-                break
-        
-        if target_index != -1:
-            new_balance = current_balance + delta_amount
-            update_range = f"'{WALLETS_SHEET_NAME}'!B{target_index + 2}"
-            service.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id, 
-                range=update_range, 
-                valueInputOption='USER_ENTERED', 
-                body={'values': [[new_balance]]}
-            ).execute()
-            print(f"[LOG] Wallet updated. New balance: {new_balance}")
-    except Exception as e:
-        print(f"[ERROR] Update Wallet Balance Error: {e}")
+    MAX_MONTHS = 360
+    MIN_CELLS = 200  # долги x сценарии; bench-debts: при 4 сценариях NumPy обгоняет цикл только к ~50 долгам
+
+    def __init__(self, strategist):
+        self.strategist = strategist
+
+    def run(self, scenarios):
+        st = self.strategist
+        n = len(scenarios)
+        base_amount = np.array([d['amount'] for d in st.debts], dtype=float)
+        base_rate = np.array([d['rate'] for d in st.debts], dtype=float) / 100.0 / 12.0
+        base_mp = np.array([d.get('min_payment', 0) for d in st.debts], dtype=float)
+
+        orders = {}
+        perm = np.array([orders.setdefault(strategy, st.payoff_order(strategy)) for strategy, _, _ in scenarios], dtype=np.intp).reshape(n, len(st.debts))
+        amount = base_amount[perm]
+        monthly_rate = base_rate[perm]
+        mp = base_mp[perm]
+        extra = np.array([float(e) for _, e, _ in scenarios])
+        one_time = np.array([float(o) for _, _, o in scenarios])
+
+        goal = st.emergency_goal
+        savings = np.full(n, st.current_savings)
+        total_interest = np.zeros(n)
+        months = np.zeros(n, dtype=int)
+        filling = np.zeros(n, dtype=int)
+
+        for m in range(1, self.MAX_MONTHS + 2):
+            active = (amount > 0.01).any(axis=1)
+            if not active.any(): break
+            months[active] = m
+            if m > self.MAX_MONTHS: break
+            live = active[:, None]
+
+            owing = live & (amount > 0)
+            interest = np.where(owing, amount * monthly_rate, 0.0)
+            amount += interest
+            total_interest += interest.sum(axis=1)
+
+            surplus = extra + one_time if m == 1 else extra.copy()
+            owing = live & (amount > 0)
+            payment = np.where(owing, np.minimum(amount, mp), 0.0)
+            amount -= payment
+            surplus += np.where(owing, np.maximum(mp - payment, 0.0), mp).sum(axis=1)
+
+            short = active & (savings < goal)
+            if short.any():
+                needed = goal - savings
+                full = short & (surplus >= needed)
+                part = short & ~full
+                filling[full & (filling == 0)] = m
+                filling[part] = m
+                savings = np.where(full, savings + needed, np.where(part, savings + surplus, savings))
+                surplus = np.where(full, surplus - needed, np.where(part, 0.0, surplus))
+
+            give = active & (surplus > 0)
+            if give.any():
+                owed = np.where(amount > 0, amount, 0.0)
+                before = np.zeros_like(owed)
+                np.cumsum(owed[:, :-1], axis=1, out=before[:, 1:])
+                payment = np.clip(surplus[:, None] - before, 0.0, owed)
+                amount -= np.where(give[:, None], payment, 0.0)
+
+        is_emergency_first = st.current_savings < st.emergency_goal
+        return [{
+            "strategy": strategy,
+            "months_to_free": int(months[i]),
+            "freedom_date": st.freedom_date(int(months[i])),
+            "total_interest": round(float(total_interest[i]), 2),
+            "months_saved_emergency": int(filling[i]),
+            "is_emergency_first": is_emergency_first
+        } for i, (strategy, _, _) in enumerate(scenarios)]
+
+DEBT_SIM_CACHE = RamCache(int(os.getenv("DEBT_SIM_CACHE_ENTRIES", "4096")), 4 * 1024 * 1024)
+DEBT_SIM_TTL = 3600  # Результат зависит только от портфеля, так что живет долго
+
+def portfolio_fingerprint(strategist):
+    """Хэш всего, от чего зависит симуляция. Порядок долгов важен: при равных ставках он задает очередность."""
+    parts = [[d['amount'], d['rate'], d.get('min_payment', 0)] for d in strategist.debts]
+    parts.append([strategist.extra_money, strategist.current_savings, strategist.emergency_goal])
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()[:16]
+
+def simulate_cached(strategist, scenarios):
+    """simulate_many с мемоизацией каждого сценария по отпечатку портфеля.
+
+    Несчитанные сценарии досчитываются одним вызовом simulate_many.
+    freedom_date пересчитывается при выдаче — она зависит от текущего месяца.
+    """
+    fp = portfolio_fingerprint(strategist)
+    keys = [(fp, strategy, float(extra), float(one_time)) for strategy, extra, one_time in scenarios]
+    results = [DEBT_SIM_CACHE.get(k) for k in keys]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing:
+        for i, res in zip(missing, strategist.simulate_many([scenarios[i] for i in missing])):
+            DEBT_SIM_CACHE.set(keys[i], res, DEBT_SIM_TTL)
+            results[i] = res
+    return [dict(r, freedom_date=strategist.freedom_date(r['months_to_free'])) for r in results]
+
+def expense_impact_points(debts_list, total_debt, amounts):
+    """Насколько отодвигается свобода от долгов, если сумму потратить, а не внести в долг."""
+    strategist = DebtStrategist(debts_list)
+    # A: Baseline (Status Quo), B: Invested (If we put this money into debt instead of spending)
+    base_scenario, *invest_scenarios = simulate_cached(strategist, [('avalanche', 0, 0)] + [('avalanche', 0, a) for a in amounts])
+    points = []
+    for amount, invest_scenario in zip(amounts, invest_scenarios):
+        months_diff = base_scenario['months_to_free'] - invest_scenario['months_to_free']
+        interest_diff = base_scenario['total_interest'] - invest_scenario['total_interest']
+        points.append({
+            'amount': amount,
+            'days_delayed': months_diff * 30,
+            'interest_cost': round(interest_diff, 2),
+            'percentage': round((amount / total_debt * 100) if total_debt > 0 else 0, 1),
+        })
+    return points
+
+def benchmark_debt_engines(sizes=(1, 5, 10, 25, 50), repeats=5, seed=42):
+    """Сравнивает simulate_payoff и DebtScenarioEngine на случайных портфелях.
+
+    Для каждого размера считает 4 сценария get_debts/calculate_expense_impact,
+    проверяет совпадение результатов и печатает время. Запуск: python main.py bench-debts
+    """
+    import random
+    rnd = random.Random(seed)
+    scenarios = [('avalanche', 0, 0), ('snowball', 0, 0), ('avalanche', 0, 50000), ('avalanche', 5000, 0)]
+    report = []
+    for size in sizes:
+        debts = [{"id": str(i), "name": f"d{i}", "type": "credit", "amount": round(rnd.uniform(1000, 500000), 2),
+                  "rate": round(rnd.uniform(0, 40), 1), "min_payment": round(rnd.uniform(500, 20000), 2)} for i in range(size)]
+        strategist = DebtStrategist(debts, current_savings=rnd.uniform(0, 100000), emergency_goal=100000)
+
+        start = time.perf_counter()
+        for _ in range(repeats): expected = [strategist.simulate_payoff(s, o, extra_monthly_payment=e) for s, e, o in scenarios]
+        loop_sec = (time.perf_counter() - start) / repeats
+        row = {"debts": size, "loop_sec": loop_sec, "numpy_sec": None, "match": None}
+        if load_numpy() is not None:
+            start = time.perf_counter()
+            for _ in range(repeats): got = DebtScenarioEngine(strategist).run(scenarios)
+            row["numpy_sec"] = (time.perf_counter() - start) / repeats
+            row["match"] = got == expected
+        print(f"[PERF] debts={size}: loop {loop_sec * 1000:.2f} ms" + (f", numpy {row['numpy_sec'] * 1000:.2f} ms, match={row['match']}" if np is not None else ", numpy not installed"))
+        report.append(row)
+    return report
 
-async def check_budget_and_notify(service, spreadsheet_id, category_name, user_id, amount_added):
-    try:
-        ranges = [f"'{BUDGET_SHEET_NAME}'!A:B", f"'{TRANSACTIONS_SHEET_NAME}'!A2:C"]
-        resp = service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges).execute()
-        b_rows = resp.get('valueRanges', [])[0].get('values', [])
-        t_rows = resp.get('valueRanges', [])[1].get('values', [])
-        limit = 0.0
-        for r in b_rows:
-            if len(r) >= 2 and r[0] == category_name:
-                try: limit = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', '').replace('₽', ''))
-                except: pass
-                break
-        
-        if limit <= 0: return
+# --- BUSINESS LOGIC HELPERS ---
 
-        now = datetime.now(MOSCOW_TIMEZONE)
-        total_spent = 0.0
-        for r in t_rows:
-            if len(r) < 3 or r[2] != category_name: continue
-            try:
-                dt = datetime.strptime(r[0], '%d.%m.%Y %H:%M:%S')
-                if dt.month == now.month and dt.year == now.year:
-                    val = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', '').replace('₽', ''))
-                    if val < 0: total_spent += abs(val)
-            except: continue
-            
-        pct = (total_spent / limit) * 100
-        msg_text = ""
-        spent_fmt = f"{int(total_spent):,} ₽".replace(',', ' ')
-        limit_fmt = f"{int(limit):,} ₽".replace(',', ' ')
-        
-        if total_spent > limit:
-            diff = total_spent - limit
-            msg_text = (f"🚨 <b>Лимит превышен!</b>\n"
-                        f"Категория: {category_name}\n"
-                        f"Потрачено: {spent_fmt} из {limit_fmt}\n"
-                        f"Превышение: {int(diff)} ₽")
-        elif pct >= 80:
-            msg_text = (f"⚠️ <b>Внимание!</b>\n"
-                        f"Категория: {category_name}\n"
-                        f"Вы потратили {int(pct)}% бюджета ({spent_fmt}).")
-        
-        if msg_text:
-            await bot.send_message(chat_id=user_id, text=msg_text, parse_mode="HTML")
-    except Exception as e:
-        print(f"[ERROR] Notification Error: {e}")
+# Уведомления о лимитах: запрос только ставит проверку в очередь YDB (alert_queue),
+# а считает и отправляет их run_alert_worker из timer_handler.
+ALERT_QUEUE_BATCH = int(os.getenv("ALERT_QUEUE_BATCH", "200"))        # Проверок за один проход воркера
+TELEGRAM_SEND_RATE = float(os.getenv("TELEGRAM_SEND_RATE", "25"))      # Сообщений в секунду (лимит Bot API — 30)
+ALERTS_SENT = {}  # (sid, категория, month_key) -> уровень, уже отправленный (память контейнера поверх budget_alerts)
+
+def month_label(month_key):
+    return f"{month_key // 12:04d}-{month_key % 12 + 1:02d}"
+
+def budget_limit(budget_rows, category_name):
+    for r in budget_rows:
+        if len(r) >= 2 and r[0] == category_name:
+            try: return parse_amount(r[1])
+            except: return 0.0
+    return 0.0
+
+def budget_alert_level(spent, limit):
+    """100 — лимит превышен, 80 — потрачено от 80%, 0 — уведомлять не о чем."""
+    if limit <= 0: return 0
+    if spent > limit: return 100
+    return 80 if spent * 100 >= limit * 80 else 0
+
+def budget_alert_text(level, category_name, spent, limit):
+    spent_fmt = f"{int(spent):,} ₽".replace(',', ' ')
+    limit_fmt = f"{int(limit):,} ₽".replace(',', ' ')
+    if level == 100:
+        return (f"🚨 <b>Лимит превышен!</b>\n"
+                f"Категория: {category_name}\n"
+                f"Потрачено: {spent_fmt} из {limit_fmt}\n"
+                f"Превышение: {int(spent - limit)} ₽")
+    return (f"⚠️ <b>Внимание!</b>\n"
+            f"Категория: {category_name}\n"
+            f"Вы потратили {int(spent * 100 / limit)}% бюджета ({spent_fmt}).")
+
+async def queue_budget_checks(spreadsheet_id, user_id, categories, month_key, budget_rows, idx=None):
+    """Ставит в очередь проверки категорий, которые могут дать новое уведомление.
+
+    По индексу (если он есть) отсеиваются категории без лимита, ниже 80% и уже
+    оповещенные этим контейнером — обычный расход не пишет в YDB вовсе.
+    """
+    jobs = []
+    for category in dict.fromkeys(categories):
+        limit = budget_limit(budget_rows, category)
+        if limit <= 0: continue
+        level = budget_alert_level(idx.month_spent(category, month_key), limit) if idx is not None else 100
+        if level <= ALERTS_SENT.get((spreadsheet_id, category, month_key), 0): continue
+        jobs.append({'spreadsheet_id': ydb_text(spreadsheet_id), 'category': ydb_text(category),
+                     'month': ydb_text(month_label(month_key)), 'user_id': int(user_id)})
+    if not jobs: return
+    try: await ydb_query('enqueue_alert_checks', {'$rows': jobs})
+    except Exception as e: print(f"[ERROR] Budget alert enqueue: {e}")
+
+async def claim_budget_alerts(levels):
+    """levels: {(sid, категория, month_key): уровень}. Отмечает все отправленными одним запросом и
+    возвращает ключи, для которых этот уровень (или выше) за месяц еще не отправлялся."""
+    levels = {key: level for key, level in levels.items() if ALERTS_SENT.get(key, 0) < level}
+    if not levels: return set()
+    res = await ydb_query('claim_budget_alerts', {'$rows': [
+        {'spreadsheet_id': ydb_text(sid), 'category': ydb_text(category), 'month': ydb_text(month_label(month_key)), 'threshold': level}
+        for (sid, category, month_key), level in levels.items()]})
+    sent = {(ydb_str(r.spreadsheet_id), ydb_str(r.category), ydb_str(r.month)): r.sent for rs in res for r in rs.rows}
+    claimed = set()
+    for key, level in levels.items():
+        already = sent.get((key[0], key[1], month_label(key[2])))
+        if already is None or already < level: claimed.add(key)
+        ALERTS_SENT[key] = max(ALERTS_SENT.get(key, 0), level)
+    return claimed
+
+class RateLimiter:
+    """Токен-бакет: не больше rate вызовов acquire() в секунду."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+async def run_alert_worker():
+    """Разбирает alert_queue: считает траты по индексу, отмечает уровни в budget_alerts
+    и шлет каждому пользователю одно сообщение со всеми его уведомлениями.
+
+    Уровень отмечается до отправки: при сбое Telegram уведомление теряется, но не дублируется.
+    """
+    start = time.time()
+    res = await ydb_query('pending_alert_checks', {'$limit': ALERT_QUEUE_BATCH})
+    jobs = [(ydb_str(r.spreadsheet_id), ydb_str(r.category), ydb_str(r.month), int(r.user_id)) for rs in res for r in rs.rows]
+    if not jobs: return {'checks': 0, 'sent': 0}
+    
+    service = get_sheets_service()
+    by_sid = {}
+    for job in jobs: by_sid.setdefault(job[0], []).append(job)
+    found, done = {}, []  # (sid, категория, month_key) -> (уровень, текст, кому — первый в очереди)
+    for sid, sid_jobs in by_sid.items():
+        # Кэш TX_INDEXES мог не видеть расходы из других контейнеров, а проверка после этого
+        # удаляется из очереди — поэтому свой свежий индекс, не вытесняя общий индекс запросов
+        try: idx, (b_rows,) = await read_transaction_index(service, sid, [f"'{BUDGET_SHEET_NAME}'!A:B"])
+        except Exception as e:
+            print(f"[ERROR] Budget alerts for {sid}: {e}")  # Проверки остаются в очереди до следующего прохода
+            continue
+        for job in sid_jobs:
+            _, category, month, user_id = job
+            month_key = int(month[:4]) * 12 + int(month[5:7]) - 1
+            limit = budget_limit(b_rows, category)
+            spent = idx.month_spent(category, month_key)
+            level = budget_alert_level(spent, limit)
+            if level and (sid, category, month_key) not in found:
+                found[(sid, category, month_key)] = (level, budget_alert_text(level, category, spent, limit), user_id)
+            done.append(job)
+    
+    messages = {}
+    claimed = await claim_budget_alerts({key: level for key, (level, _, _) in found.items()}) if found else set()
+    for key, (_, text, user_id) in found.items():
+        if key in claimed: messages.setdefault(user_id, []).append(text)
+    
+    limiter = RateLimiter(TELEGRAM_SEND_RATE)
+    async def send(user_id, texts):
+        await limiter.acquire()
+        try:
+            await get_bot().send_message(chat_id=user_id, text="\n\n".join(texts), parse_mode="HTML")
+            return True
+        except Exception as e:
+            print(f"[ERROR] Notification Error: {e}")
+            return False
+    sent = await asyncio.gather(*(send(u, texts) for u, texts in messages.items()))
+    
+    if done:
+        await ydb_query('delete_alert_checks', {'$rows': [{'spreadsheet_id': ydb_text(sid), 'category': ydb_text(c), 'month': ydb_text(m), 'user_id': u} for sid, c, m, u in done]})
+    print(f"[PERF] Budget alerts: {len(done)}/{len(jobs)} checks, {sum(sent)} messages in {time.time() - start:.3f} sec")
+    return {'checks': len(done), 'sent': sum(sent)}
+
+def subscription_next_due(sub_day, last_paid, today):
+    """Дата следующего списания подписки с днем sub_day; last_paid — date последней оплаты или None."""
+    y, m = today.year, today.month
+    if last_paid is not None and (last_paid.year, last_paid.month) >= (y, m):
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return date(y, m, min(sub_day, calendar.monthrange(y, m)[1]))
 
 async def process_subscriptions(service, spreadsheet_id):
+    """Списывает подписки, чей день наступил. Возвращает (были ли записи, {id подписки: следующая дата})
+    или (False, None), если таблицу прочитать не удалось."""
     try:
-        resp = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f"'{SUBSCRIPTIONS_SHEET_NAME}'!A2:F").execute()
-        rows = resp.get('values', [])
-        if not rows: return False
+        wallets, (rows,) = await get_wallet_index(service, spreadsheet_id, [f"'{SUBSCRIPTIONS_SHEET_NAME}'!A2:F"], fresh=True)
+        schedule = {}
+        if not rows: return False, schedule
 
         now = datetime.now(MOSCOW_TIMEZONE)
         _, last_day_of_month = calendar.monthrange(now.year, now.month)
-        updates = []; new_transactions = []; has_changes = False
-        default_wallet = get_default_wallet_uuid(service, spreadsheet_id)
+        batch = SheetWriteBatch(spreadsheet_id); new_transactions = []; has_changes = False
+        default_wallet = wallets.default_uuid
 
         for i, r in enumerate(rows):
             if len(r) < 6: continue
@@ -440,49 +2061,260 @@ async def process_subscriptions(service, spreadsheet_id):
                     elif last_paid_date.month != now.month or last_paid_date.year != now.year: should_pay = True
                 
                 if should_pay:
-                    amount = float(amount_str)
+                    amount = parse_amount(amount_str)
                     final_amt = -abs(amount)
                     trans_date_str = datetime(now.year, now.month, target_day, 10, 0, 0).strftime('%d.%m.%Y %H:%M:%S')
                     new_transactions.append([
                         trans_date_str, final_amt, category, "Расход", 
                         f"Подписка: {name}", "System", str(uuid.uuid4()), default_wallet if default_wallet else ""
                     ])
-                    updates.append({ 'range': f"'{SUBSCRIPTIONS_SHEET_NAME}'!E{i+2}", 'values': [[now.strftime('%d.%m.%Y')]] })
+                    batch.update(f"'{SUBSCRIPTIONS_SHEET_NAME}'!E{i+2}", [[now.strftime('%d.%m.%Y')]])
                     has_changes = True
-                    if default_wallet: update_wallet_balance(service, spreadsheet_id, default_wallet, final_amt)
+                    last_paid_date = now
+                schedule[str(sub_id).strip()] = subscription_next_due(sub_day, last_paid_date and last_paid_date.date(), now.date())
             except Exception as e: continue
         
         if new_transactions:
-            service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range=f"'{TRANSACTIONS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': new_transactions}).execute()
-        if updates:
-            data = [{'range': u['range'], 'values': u['values']} for u in updates]
-            service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body={'valueInputOption': 'USER_ENTERED', 'data': data}).execute()
-        return has_changes
-    except Exception as e: return False
+            batch.append(TRANSACTIONS_SHEET_NAME, new_transactions)
+            wallets.queue_deltas(batch, [(default_wallet, t[1]) for t in new_transactions])
+        await batch.commit(service)
+        return has_changes, schedule
+    except Exception as e:
+        print(f"[ERROR] Subscriptions for {spreadsheet_id}: {e}")
+        return False, None
+
+# --- ПЛАНИРОВЩИК ПОДПИСОК ---
+
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "5"))  # Таблиц, обрабатываемых одновременно
+
+def is_timer_event(event):
+    return any(m.get('event_metadata', {}).get('event_type', '').endswith('TimerMessage') for m in event.get('messages', []) if isinstance(m, dict))
+
+async def run_subscription_scheduler():
+    """Обходит таблицы с наступившими списаниями (по subscription_due в YDB), не больше
+    SCHEDULER_CONCURRENCY одновременно, и сохраняет следующие даты."""
+    start = time.time()
+    sids = await get_due_spreadsheets(datetime.now(MOSCOW_TIMEZONE).date())
+    service = get_sheets_service()
+    sem = asyncio.Semaphore(SCHEDULER_CONCURRENCY)
+    
+    async def run(sid):
+        async with sem:
+            try:
+                async with wallet_write_lock(sid): changed, schedule = await process_subscriptions(service, sid)
+                if schedule is None: return 'failed'
+                await save_subscription_schedule(sid, schedule)
+                if changed:
+                    clear_user_cache(sid)
+                    await bump_revision(sid)
+                return 'charged' if changed else 'checked'
+            except Exception as e:
+                print(f"[ERROR] Scheduler for {sid}: {e}")
+                return 'failed'
+    
+    results = await asyncio.gather(*(run(sid) for sid in sids))
+    summary = {k: results.count(k) for k in ('charged', 'checked', 'failed')}
+    print(f"[PERF] Subscription scheduler: {len(sids)} spreadsheets {summary} in {time.time() - start:.3f} sec")
+    return summary
+
+async def timer_handler(event, context):
+    """Точка входа для таймер-триггера (например, раз в минуту): подписки и уведомления о бюджете."""
+    results = await asyncio.gather(run_subscription_scheduler(), run_alert_worker(), return_exceptions=True)
+    await drain_background_tasks()
+    summary = {}
+    for name, res in zip(('subscriptions', 'alerts'), results):
+        if isinstance(res, Exception): print(f"[ERROR] Timer job {name}: {res}")
+        summary[name] = {'error': str(res)} if isinstance(res, Exception) else res
+    return {'statusCode': 200, 'body': json.dumps(summary)}
+
+# --- ИМПОРТ ТРАНЗАКЦИЙ ---
+
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "2000"))  # Строк в одном values.append
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "50000"))
+IMPORT_MAX_ERRORS = 20  # Столько ошибок строк уходит клиенту, остальные только считаются
+IMPORT_FIELDS = {  # Заголовок колонки CSV / ключ JSON -> поле
+    'date': 'date', 'дата': 'date', 'amount': 'amount', 'сумма': 'amount',
+    'category': 'category', 'категория': 'category', 'type': 'type', 'тип': 'type',
+    'comment': 'comment', 'комментарий': 'comment', 'description': 'comment', 'описание': 'comment',
+    'wallet_uuid': 'wallet', 'wallet': 'wallet', 'кошелек': 'wallet', 'id': 'id',
+}
+IMPORT_TYPES = {'expense': -1, 'расход': -1, 'income': 1, 'доход': 1}
+# Без времени — полночь: повторный импорт той же выписки дает те же строки
+IMPORT_DATE_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+def iter_import_records(data, fmt=None):
+    """Построчно разбирает CSV с заголовком или JSON lines, отдает (номер строки, {поле: значение}).
+
+    Формат без явного указания определяется по первой непустой строке. Битая
+    строка отдается как (номер, ValueError), чтобы импорт шел дальше.
+    """
+    lines = io.StringIO(data.lstrip('\ufeff'))
+    if fmt is None:
+        first = next((l for l in lines if l.strip()), '')
+        lines.seek(0)
+        fmt = 'jsonl' if first.lstrip().startswith('{') else 'csv'
+    if fmt == 'jsonl':
+        for n, line in enumerate(lines, 1):
+            if not line.strip(): continue
+            try: obj = json.loads(line)
+            except ValueError as e:
+                yield n, ValueError(f"bad json: {e}")
+                continue
+            if not isinstance(obj, dict): yield n, ValueError("not an object")
+            else: yield n, {IMPORT_FIELDS[k.strip().lower()]: v for k, v in obj.items() if k.strip().lower() in IMPORT_FIELDS}
+        return
+
+    header = lines.readline()
+    delimiter = ';' if header.count(';') > header.count(',') else ('\t' if '\t' in header else ',')
+    fields = [IMPORT_FIELDS.get(h.strip().lower()) for h in next(csv.reader([header], delimiter=delimiter), [])]
+    if 'amount' not in fields: raise ValueError("CSV header has no amount column")
+    reader = csv.reader(lines, delimiter=delimiter)
+    for r in reader:
+        if any(c.strip() for c in r): yield reader.line_num + 1, {f: v for f, v in zip(fields, r) if f}
+
+def import_date(value, cache):
+    """Дата из выписки -> TX_DATE_FORMAT; разобранные строки кэшируются на время импорта."""
+    out = cache.get(value)
+    if out is None:
+        for fmt in IMPORT_DATE_FORMATS:
+            try:
+                out = datetime.strptime(value, fmt).strftime(TX_DATE_FORMAT)
+                break
+            except ValueError: pass
+        else: raise ValueError(f"bad date {value!r}")
+        cache[value] = out
+    return out
+
+def import_row(rec, wallets, defaults, dates):
+    """{поле: значение} -> строка листа транзакций, как ее пишет add_transaction.
+
+    Со столбцом типа сумма берется по модулю и получает знак типа, без него
+    знак суммы сохраняется (так выгружают банки).
+    """
+    amount = parse_amount(rec.get('amount', ''))
+    if not amount: raise ValueError("zero amount")
+    sign = IMPORT_TYPES.get(str(rec.get('type') or '').strip().lower())
+    if sign is not None: amount = sign * abs(amount)
+    raw_date = str(rec.get('date') or '').strip()
+    wallet = str(rec.get('wallet') or '').strip() or defaults['wallet']
+    if wallet and wallet not in wallets: raise ValueError(f"unknown wallet {wallet}")
+    return [import_date(raw_date, dates) if raw_date else defaults['date'], amount,
+            str(rec.get('category') or '').strip() or defaults['category'], "Расход" if amount < 0 else "Доход",
+            str(rec.get('comment') or '').strip(), defaults['author'], str(rec.get('id') or '').strip() or str(uuid.uuid4()), wallet]
+
+# --- ЭКСПОРТ ТРАНЗАКЦИЙ ---
+
+EXPORT_WINDOW_ROWS = int(os.getenv("EXPORT_WINDOW_ROWS", "5000"))  # Строк листа в одном чтении
+EXPORT_PAGE_ROWS = int(os.getenv("EXPORT_PAGE_ROWS", "5000"))      # Строк листа на страницу export_transactions
+EXPORT_PAGE_BYTES = int(os.getenv("EXPORT_PAGE_BYTES", str(1024 * 1024)))  # Ответ функции ограничен по размеру
+EXPORT_FIELDS = ('id', 'date', 'amount', 'category', 'type', 'comment', 'author', 'wallet_uuid')
+
+async def iter_transaction_rows(service, spreadsheet_id, window=None):
+    """Строки листа транзакций окнами по window; следующее окно читается, пока отдается текущее.
+
+    Конец листа — число строк сетки, а не неполное или пустое окно: Sheets обрезает
+    пустые строки в конце окна, а данные могут идти после них. Число строк читается
+    вместе с первым окном; если не прочиталось, конец — первое пустое окно.
+    """
+    window = window or EXPORT_WINDOW_ROWS
+    def read(first):
+        return asyncio.ensure_future(sheets_batch_get(service, spreadsheet_id, [f"'{TRANSACTIONS_SHEET_NAME}'!A{first}:H{first + window - 1}"]))
+    first, pending = 2, read(2)
+    try:
+        try: row_count = await get_sheet_row_count(service, spreadsheet_id, TRANSACTIONS_SHEET_NAME)
+        except Exception as e:
+            print(f"[ERROR] Row count for export: {e}")
+            row_count = None
+        while pending is not None:
+            (rows,) = await pending
+            if (first + window > row_count) if row_count is not None else not rows: pending = None
+            else:
+                first += window
+                pending = read(first)
+            for r in rows: yield r
+    finally:
+        if pending is not None: pending.cancel()
+
+def export_record(row, month_key=None, wallet=None):
+    """Строка листа -> dict с полями EXPORT_FIELDS или None: битые строки пропускаются, как в истории."""
+    rec = TxRecord.decode(row)
+    if not rec.ok or (month_key is not None and rec.month != month_key) or (wallet and rec.wallet != wallet): return None
+    return {'id': rec.tx_id, 'date': (_EPOCH + timedelta(seconds=rec.ts)).isoformat(), 'amount': rec.amount, 'category': rec.category,
+            'type': rec.type, 'comment': rec.comment, 'author': rec.author, 'wallet_uuid': rec.wallet}
+
+async def iter_export_records(service, spreadsheet_id, month_key=None, wallet=None):
+    async for r in iter_transaction_rows(service, spreadsheet_id):
+        rec = export_record(r, month_key, wallet)
+        if rec is not None: yield rec
+
+def export_csv_line(values):
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='\n').writerow(values)
+    return buf.getvalue()
+
+def export_line(rec, fmt):
+    return export_csv_line([rec[f] for f in EXPORT_FIELDS]) if fmt == 'csv' else json.dumps(rec, ensure_ascii=False) + '\n'
+
+async def iter_export_lines(service, spreadsheet_id, fmt='csv', month_key=None, wallet=None):
+    """Строки выгрузки CSV (с заголовком) или JSON lines; память — одно окно листа."""
+    if fmt == 'csv': yield export_csv_line(EXPORT_FIELDS)
+    async for rec in iter_export_records(service, spreadsheet_id, month_key, wallet):
+        yield export_line(rec, fmt)
+
+async def export_to_stream(spreadsheet_id, out, fmt='csv', month_key=None, wallet=None):
+    """CLI-выгрузка: пишет строки в out по мере чтения листа."""
+    start, n = time.time(), -1 if fmt == 'csv' else 0
+    async for line in iter_export_lines(get_sheets_service(), spreadsheet_id, fmt, month_key, wallet):
+        out.write(line)
+        n += 1
+    print(f"[PERF] Exported {n} transactions in {time.time() - start:.3f} sec", file=sys.stderr)
 
 # --- TELEGRAM HANDLERS ---
 
-@dp.message(CommandStart())
-async def start_cmd(message: types.Message):
+def get_bot():
+    global bot
+    if bot is None:
+        with startup_timer('import aiogram'):
+            from aiogram import Bot
+        bot = Bot(token=BOT_TOKEN)
+    return bot
+
+def get_dispatcher():
+    """Dispatcher с обработчиками сообщений — нужен только для обновлений Telegram."""
+    global dp
+    if dp is None:
+        with startup_timer('import aiogram'):
+            from aiogram import Dispatcher, F
+            from aiogram.filters import CommandStart
+        dp = Dispatcher()
+        dp.message(CommandStart())(start_cmd)
+        dp.message(F.text.contains("google.com"))(sheet_handler)
+    return dp
+
+def web_app_keyboard(text):
+    from aiogram.types import WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=text, web_app=WebAppInfo(url=WEB_APP_URL))]])
+
+async def start_cmd(message):
     uid = message.from_user.id
     first_name = message.from_user.first_name
-    user = get_user_data(uid)
+    user = await get_user_data(uid)
     args = message.text.split(' ')[1] if len(message.text.split(' ')) > 1 else None
 
     if args and args.startswith('join_'):
         try:
             owner_id = int(args.split('_')[1])
-            owner_data = get_user_data(owner_id)
+            owner_data = await get_user_data(owner_id)
             if owner_data:
-                save_user_data(uid, owner_data['spreadsheet_id'], owner_id, first_name)
-                kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="📱 Открыть Финансы", web_app=WebAppInfo(url=WEB_APP_URL))]])
+                await save_user_data(uid, owner_data['spreadsheet_id'], owner_id, first_name)
+                kb = web_app_keyboard("📱 Открыть Финансы")
                 await message.answer(f"✅ Вы успешно присоединились к семейному бюджету!", reply_markup=kb)
             else: await message.answer("❌ Семья не найдена.")
         except: await message.answer("❌ Некорректная ссылка.")
         return
 
     if user:
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="📱 Открыть Финансы", web_app=WebAppInfo(url=WEB_APP_URL))]])
+        kb = web_app_keyboard("📱 Открыть Финансы")
         await message.answer("✅ Вы уже настроены.", reply_markup=kb)
     else:
         await message.answer(
@@ -493,8 +2325,7 @@ async def start_cmd(message: types.Message):
             parse_mode="HTML"
         )
 
-@dp.message(F.text.contains("google.com"))
-async def sheet_handler(message: types.Message):
+async def sheet_handler(message):
     link = message.text
     try:
         if '/d/' in link: sid = link.split('/d/')[1].split('/')[0]
@@ -503,25 +2334,1020 @@ async def sheet_handler(message: types.Message):
             return
         msg = await message.answer("⏳ Настраиваю таблицу...")
         await setup_sheet(sid)
-        save_user_data(message.from_user.id, sid, message.from_user.id, message.from_user.first_name)
-        create_default_categories(message.from_user.id)
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🚀 Запустить", web_app=WebAppInfo(url=WEB_APP_URL))]])
-        await bot.edit_message_text(text="✅ <b>Готово!</b>", chat_id=message.chat.id, message_id=msg.message_id, parse_mode="HTML", reply_markup=kb)
+        await save_user_data(message.from_user.id, sid, message.from_user.id, message.from_user.first_name)
+        await create_default_categories(message.from_user.id)
+        kb = web_app_keyboard("🚀 Запустить")
+        await get_bot().edit_message_text(text="✅ <b>Готово!</b>", chat_id=message.chat.id, message_id=msg.message_id, parse_mode="HTML", reply_markup=kb)
     except Exception as e: await message.answer(f"❌ Ошибка: {str(e)}")
 
+# --- РЕВИЗИИ ДАННЫХ, ETAG И СЖАТИЕ ОТВЕТОВ ---
+# У каждой таблицы в YDB (sheet_revisions) счетчик ревизии, который растет после любого
+# действия 'write' и изменений планировщика. ETag читающего действия строится из ревизии,
+# поэтому совпадение с If-None-Match клиента дает 304 без обращения к Sheets.
+# Правки руками в самой таблице счетчик не видит: их подхватывает смена эпохи ETAG_MAX_AGE.
+#
+# Тело ответа и ETag должны быть одной ревизии: ревизия входит в ключ RAM_CACHE, а если
+# она сдвинулась не нашей записью, кэши и индексы этой таблицы в контейнере сбрасываются
+# (observe_revision). Прочитанная ревизия живет в контейнере REVISION_TTL секунд, чтобы
+# действие из кэша не ходило в YDB каждый раз; это же — предел отставания от чужих записей.
+
+ETAG_MAX_AGE = int(os.getenv("ETAG_MAX_AGE", "300"))
+REVISION_TTL = float(os.getenv("REVISION_TTL", "2"))
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1400"))  # Меньше — не сжимаем, выигрыш съедает base64
+REVISIONS = {}  # spreadsheet_id -> (до какого времени верить, ревизия)
+
+async def get_revision(spreadsheet_id):
+    res = await ydb_query('get_revision', {'$spreadsheet_id': ydb_text(spreadsheet_id)})
+    return int(res[0].rows[0].revision) if res and res[0].rows else 0
+
+def observe_revision(spreadsheet_id, revision, expected):
+    """Запоминает ревизию; если она не та, что ожидалась, сбрасывает все, что контейнер держит по таблице.
+
+    expected=None — ревизия контейнеру еще не известна (первое обращение после старта): она
+    принимается за точку отсчета, иначе первая же запись сбросила бы только что обновленное.
+    """
+    if expected is not None and revision != expected:
+        print(f"[LOG] Revision of {spreadsheet_id} moved to {revision} (expected {expected}), dropping local state")
+        clear_user_cache(spreadsheet_id)
+        drop_transaction_index(spreadsheet_id)
+        drop_wallet_index(spreadsheet_id)
+        TX_PARTITIONS.pop(spreadsheet_id, None)
+    REVISIONS[spreadsheet_id] = (time.time() + REVISION_TTL, revision)
+
+async def current_revision(spreadsheet_id):
+    """Ревизия таблицы (не старше REVISION_TTL) или None, если YDB недоступна."""
+    known = REVISIONS.get(spreadsheet_id)
+    if known is not None and known[0] > time.time(): return known[1]
+    try: revision = await get_revision(spreadsheet_id)
+    except Exception as e:
+        print(f"[ERROR] Revision read for {spreadsheet_id}: {e}")
+        return None
+    observe_revision(spreadsheet_id, revision, known[1] if known else None)
+    return revision
+
+async def bump_revision(spreadsheet_id):
+    known = REVISIONS.get(spreadsheet_id)
+    try:
+        res = await ydb_query('bump_revision', {'$spreadsheet_id': ydb_text(spreadsheet_id)})
+        revision = int(res[0].rows[0].revision)
+    except Exception as e:
+        print(f"[ERROR] Revision bump for {spreadsheet_id}: {e}")
+        REVISIONS.pop(spreadsheet_id, None)
+        if spreadsheet_id in SNAPSHOTS_PENDING: await settle_index_snapshot(spreadsheet_id, False)
+        return
+    # Ровно +1 к известной ревизии — между чтением и записью никто больше не писал
+    observe_revision(spreadsheet_id, revision, known[1] + 1 if known else None)
+    if spreadsheet_id in SNAPSHOTS_PENDING:
+        await settle_index_snapshot(spreadsheet_id, known is not None and revision == known[1] + 1)
+
+def action_etag(spec, ctx):
+    """ETag ответа действия по ctx.revision или None, если ревизия неизвестна (тогда отдаем полный ответ)."""
+    if ctx.revision is None: return None
+    payload = json.dumps(ctx.payload if spec.vary_payload else {}, sort_keys=True)
+    key = f"{ctx.sid}:{ctx.revision}:{int(time.time() // ETAG_MAX_AGE)}:{ctx.uid}:{spec.name}:{payload}"
+    return f'"{ctx.revision}-{hashlib.sha1(key.encode()).hexdigest()[:20]}"'
+
+def request_header(event, name):
+    name = name.lower()
+    return next((v for k, v in (event.get('headers') or {}).items() if k.lower() == name), '') or ''
+
+def etag_matches(event, etag):
+    header = request_header(event, 'If-None-Match')
+    return bool(etag and header) and (header.strip() == '*' or etag in (t.strip().removeprefix('W/') for t in header.split(',')))
+
+def json_response(event, headers, body, etag=None):
+    """200 с телом body; крупное тело сжимается gzip и отдается в base64, как требует шлюз функции."""
+    headers = dict(headers)
+    if etag: headers['ETag'] = etag
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in request_header(event, 'Accept-Encoding'):
+        headers['Content-Encoding'] = 'gzip'; headers['Vary'] = 'Accept-Encoding'
+        return {'statusCode': 200, 'headers': headers, 'isBase64Encoded': True,
+                'body': base64.b64encode(gzip.compress(body.encode('utf-8'), compresslevel=6)).decode('ascii')}
+    return {'statusCode': 200, 'headers': headers, 'body': body}
+
+# --- РЕЕСТР ДЕЙСТВИЙ WEB APP ---
+
+ACTIONS = {}
+ACTION_STATS = {}
+STATS_LOG_EVERY = int(os.getenv("STATS_LOG_EVERY", "100"))  # Раз в столько действий контейнер пишет свою статистику в лог
+_STATS_CALLS = 0
+
+class ApiError(Exception):
+    """Прерывает действие с заданным HTTP-статусом и телом ответа."""
+    def __init__(self, status_code, body):
+        super().__init__(body)
+        self.status_code = status_code
+        self.body = body
+
+class ActionSpec:
+    """Описание действия: обработчик и политика, которую применяет handler.
+
+    kind: 'read' или 'write'; после успешного 'write' сбрасывается кэш таблицы.
+    cache_ttl: если задан, результат кэшируется в RAM_CACHE на столько секунд.
+    vary_payload: входит ли payload в ключ кэша.
+    resources: листы таблицы (или 'ydb'), которые действие читает/пишет.
+    requires_user: нужна ли запись пользователя в YDB (sid/oid).
+    etag: отдавать ETag по ревизии таблицы и 304 при совпадении If-None-Match.
+    """
+    __slots__ = ('name', 'func', 'kind', 'cache_ttl', 'vary_payload', 'resources', 'requires_user', 'etag')
+
+    def __init__(self, name, func, kind='read', cache_ttl=None, vary_payload=True, resources=(), requires_user=True, etag=False):
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.cache_ttl = cache_ttl
+        self.vary_payload = vary_payload
+        self.resources = tuple(resources)
+        self.requires_user = requires_user
+        self.etag = etag
+
+class ActionContext:
+    __slots__ = ('action', 'uid', 'user_name', 'payload', 'sid', 'oid', 'revision')
+
+    def __init__(self, action, uid, user_name, payload, sid=None, oid=None, revision=None):
+        self.action = action
+        self.uid = uid
+        self.user_name = user_name
+        self.payload = payload
+        self.sid = sid
+        self.oid = oid
+        self.revision = revision  # Ревизия данных для действий с ETag (current_revision)
+
+def api_action(name, **policy):
+    def register(func):
+        ACTIONS[name] = ActionSpec(name, func, **policy)
+        return func
+    return register
+
+def record_action_stats(name, elapsed, error=False, cache_hit=False, sheets_calls=0):
+    st = ACTION_STATS.get(name)
+    if st is None:
+        st = ACTION_STATS[name] = {'calls': 0, 'errors': 0, 'cache_hits': 0, 'total_sec': 0.0, 'max_sec': 0.0, 'sheets_calls': 0}
+    st['calls'] += 1
+    st['sheets_calls'] += sheets_calls
+    st['total_sec'] += elapsed
+    if elapsed > st['max_sec']: st['max_sec'] = elapsed
+    if error: st['errors'] += 1
+    if cache_hit: st['cache_hits'] += 1
+
+def get_action_stats():
+    return {name: dict(st, avg_sec=st['total_sec'] / st['calls'] if st['calls'] else 0.0) for name, st in ACTION_STATS.items()}
+
+def log_stats_periodically():
+    """Накопленные с запуска контейнера счетчики RAM_CACHE и действий — одной строкой [PERF]."""
+    global _STATS_CALLS
+    _STATS_CALLS += 1
+    if STATS_LOG_EVERY <= 0 or _STATS_CALLS % STATS_LOG_EVERY: return
+    actions = {name: {k: round(v, 4) if isinstance(v, float) else v for k, v in st.items()} for name, st in get_action_stats().items()}
+    print(f"[PERF] Stats after {_STATS_CALLS} actions: cache {json.dumps(cache_stats())}, actions {json.dumps(actions, ensure_ascii=False)}")
+
+async def dispatch_action(spec, ctx):
+    """Выполняет действие с учетом его политики кэша и инвалидации. Возвращает (данные, из_кэша)."""
+    RAM_CACHE.purge_expired()
+    cache_key = None
+    if spec.cache_ttl and ctx.sid:
+        cache_key = get_cache_key(ctx.sid, spec.name, ctx.payload if spec.vary_payload else {}, ctx.revision)
+        cached = get_from_cache(cache_key)
+        if cached is not None: return cached, True
+
+    try:
+        if spec.kind == 'write' and ctx.sid and WALLETS_SHEET_NAME in spec.resources:
+            async with wallet_write_lock(ctx.sid): result = await spec.func(ctx)
+        else: result = await spec.func(ctx)
+    finally:
+        # И при ошибке: действие могло успеть записать часть данных (bulk_import)
+        if spec.kind == 'write' and ctx.sid:
+            clear_user_cache(ctx.sid)
+            await bump_revision(ctx.sid)
+
+    if cache_key is not None: save_to_cache(cache_key, result, ttl=spec.cache_ttl)
+    return result, False
+
+# --- ДЕЙСТВИЯ WEB APP ---
+
+@api_action('check_user', kind='read', resources=('ydb',), requires_user=False)
+async def action_check_user(ctx):
+    uid = ctx.uid
+    u = await get_user_data(uid)
+    if u and u.get('first_name') != ctx.user_name:
+        await save_user_data(uid, u['spreadsheet_id'], u['owner_id'], ctx.user_name)
+    return {'is_registered': bool(u), 'user_id': uid}
+
+@api_action('update_structure', kind='write', resources=('sheets',))
+async def action_update_structure(ctx):
+    sid = ctx.sid
+    await setup_sheet(sid, refresh=True)
+
+@api_action('get_categories', cache_ttl=300, vary_payload=False, resources=('ydb',))
+async def action_get_categories(ctx):
+    return await get_categories(ctx.oid)
+
+@api_action('add_category', kind='write', resources=('ydb',))
+async def action_add_category(ctx):
+    oid, payload = ctx.oid, ctx.payload
+    await ydb_query('upsert_categories', {'$rows': [{
+        'telegram_id': oid, 'category_id': ydb_text(uuid.uuid4()),
+        'category_name': ydb_text(payload['name']), 'category_type': ydb_text(payload['type']),
+    }]})
+
+@api_action('edit_category', kind='write', resources=('ydb',))
+async def action_edit_category(ctx):
+    oid, payload = ctx.oid, ctx.payload
+    await ydb_query('rename_category', {'$telegram_id': oid, '$category_id': ydb_text(payload['id']), '$category_name': ydb_text(payload['new_name'])})
+
+@api_action('delete_category', kind='write', resources=('ydb',))
+async def action_delete_category(ctx):
+    oid, payload = ctx.oid, ctx.payload
+    await ydb_query('delete_category', {'$telegram_id': oid, '$category_id': ydb_text(payload['id'])})
+
+@api_action('get_category_stats', cache_ttl=CACHE_TTL, resources=(TRANSACTIONS_SHEET_NAME,))
+async def action_get_category_stats(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    try: idx, _ = await get_transaction_index(service, sid)
+    except: idx = TransactionIndex(sid)
+    
+    monthly_spent = idx.monthly_expenses(payload['category'])
+    
+    history = []
+    for k in sorted(monthly_spent.keys(), reverse=True)[:3]:
+        label = datetime(k // 12, k % 12 + 1, 1).strftime('%B %Y')
+        history.append({"label": label, "amount": monthly_spent[k]})
+    
+    result = {"history": history}
+    return result
+
+@api_action('set_budget', kind='write', resources=(BUDGET_SHEET_NAME,))
+async def action_set_budget(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    try:
+        resp = await sheets_execute(service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!A2:C"))
+        rows = resp.get('values', [])
+    except: rows = []
+    
+    cat_name = payload['category_name']
+    limit_val = float(payload['limit'])
+    found_idx = -1
+    
+    for i, r in enumerate(rows):
+        if len(r) >= 1 and r[0] == cat_name:
+            found_idx = i
+            break
+    
+    if found_idx != -1:
+        await sheets_execute(service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!B{found_idx+2}:C{found_idx+2}", valueInputOption='USER_ENTERED', body={'values': [[limit_val, datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y')]]}))
+    else:
+        new_row = [cat_name, limit_val, datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y')]
+        await sheets_execute(service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [new_row]}))
+
+@api_action('get_settings', resources=(BUDGET_SHEET_NAME,))
+async def action_get_settings(ctx):
+    sid = ctx.sid
+    service = get_sheets_service()
+    
+    try:
+        resp = await sheets_execute(service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!D2:E"))
+        rows = resp.get('values', [])
+    except: rows = []
+    
+    settings = {}
+    for r in rows:
+        if len(r) >= 2:
+            settings[r[0]] = r[1]
+    
+    return settings
+
+@api_action('set_setting', kind='write', resources=(BUDGET_SHEET_NAME,))
+async def action_set_setting(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    try:
+        resp = await sheets_execute(service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!D2:E"))
+        rows = resp.get('values', [])
+    except: rows = []
+    
+    key = payload['key']
+    value = payload['value']
+    found_idx = -1
+    
+    for i, r in enumerate(rows):
+        if len(r) >= 1 and r[0] == key:
+            found_idx = i
+            break
+    
+    if found_idx != -1:
+        await sheets_execute(service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!E{found_idx+2}", valueInputOption='USER_ENTERED', body={'values': [[value]]}))
+    else:
+        new_row = [[], [], [], key, value]
+        await sheets_execute(service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!A", valueInputOption='USER_ENTERED', body={'values': [new_row]}))
+
+@api_action('get_subscriptions', cache_ttl=CACHE_TTL, vary_payload=False, resources=(SUBSCRIPTIONS_SHEET_NAME,))
+async def action_get_subscriptions(ctx):
+    sid = ctx.sid
+    service = get_sheets_service()
+    
+    try:
+        resp = await sheets_execute(service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{SUBSCRIPTIONS_SHEET_NAME}'!A2:F"))
+        rows = resp.get('values', [])
+    except: rows = []
+    
+    subs = []
+    for r in rows:
+        if len(r) < 6: continue
+        subs.append({"name": r[0], "amount": parse_amount(r[1]), "category": r[2], "day": int(r[3]), "last_paid": r[4], "id": r[5]})
+    
+    return subs
+
+@api_action('add_subscription', kind='write', resources=(SUBSCRIPTIONS_SHEET_NAME, 'ydb'))
+async def action_add_subscription(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    new_row = [payload['name'], float(payload['amount']), payload['category'], int(payload['day']), "-", str(uuid.uuid4())]
+    await sheets_execute(service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{SUBSCRIPTIONS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [new_row]}))
+    due = subscription_next_due(new_row[3], None, datetime.now(MOSCOW_TIMEZONE).date())
+    await ydb_query('upsert_subscription_due', {'$rows': [{'spreadsheet_id': ydb_text(sid), 'subscription_id': ydb_text(new_row[5]), 'next_due': ydb_text(due.isoformat())}]})
+
+@api_action('delete_subscription', kind='write', resources=(SUBSCRIPTIONS_SHEET_NAME, 'ydb'))
+async def action_delete_subscription(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    rows = (await sheets_execute(service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{SUBSCRIPTIONS_SHEET_NAME}'!F:F"))).get('values', [])
+    target_id = str(payload['id']).strip()
+    idx = next((i for i, r in enumerate(rows) if r and r[0].strip() == target_id), -1)
+    
+    if idx != -1:
+        sheet_id = await get_sheet_id(service, sid, SUBSCRIPTIONS_SHEET_NAME)
+        await sheets_execute(service.spreadsheets().batchUpdate(spreadsheetId=sid, body={"requests": [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": idx, "endIndex": idx + 1}}}]}))
+        await ydb_query('delete_subscription_due', {'$spreadsheet_id': ydb_text(sid), '$subscription_id': ydb_text(target_id)})
+
+@api_action('add_transaction', kind='write', resources=(TRANSACTIONS_SHEET_NAME, WALLETS_SHEET_NAME, BUDGET_SHEET_NAME))
+async def action_add_transaction(ctx):
+    sid, uid, payload = ctx.sid, ctx.uid, ctx.payload
+    service = get_sheets_service()
+    
+    amount = float(payload['amount'])
+    final_amount = -abs(amount) if payload['type'] == 'expense' else abs(amount)
+    
+    # Свежие кошельки и (для расхода) бюджет — одним чтением; лист транзакций не нужен
+    wallets, extras = await get_wallet_index(service, sid, [f"'{BUDGET_SHEET_NAME}'!A:B"] if final_amount < 0 else [], fresh=True)
+    
+    batch = SheetWriteBatch(sid)
+    wallet_uuid = payload.get('wallet_uuid') or wallets.default_uuid
+    wallets.queue_deltas(batch, [(wallet_uuid, final_amount)])
+    
+    d_str = payload.get('date')
+    formatted_date = (datetime.strptime(d_str, '%Y-%m-%d').strftime('%d.%m.%Y') + datetime.now(MOSCOW_TIMEZONE).strftime(' %H:%M:%S')) if d_str else datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y %H:%M:%S')
+    
+    row = [formatted_date, final_amount, payload['category'], "Расход" if final_amount < 0 else "Доход", payload.get('comment', ''), ctx.user_name, str(uuid.uuid4()), wallet_uuid if wallet_uuid else ""]
+    batch.append(TRANSACTIONS_SHEET_NAME, [row])
+    await batch.commit(service)
+    
+    now = datetime.now(MOSCOW_TIMEZONE)
+    month_now = now.year * 12 + now.month - 1
+    if final_amount < 0 and parse_tx_timestamp(formatted_date)[1] == month_now:
+        # Отсев по индексу — только если он уже есть и свежий (с этой записью); иначе проверку решит воркер
+        idx = TX_INDEXES.get(sid) if transaction_index_fresh(sid) else None
+        await queue_budget_checks(sid, uid, [payload['category']], month_now, extras[0], idx)
+
+@api_action('delete_transaction', kind='write', resources=(TRANSACTIONS_SHEET_NAME, WALLETS_SHEET_NAME))
+async def action_delete_transaction(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    (pos, old, wallets), sheet_id = await asyncio.gather(
+        locate_transaction(service, sid, payload['id']),
+        get_sheet_id(service, sid, TRANSACTIONS_SHEET_NAME),
+    )
+    
+    if pos != -1:
+        batch = SheetWriteBatch(sid)
+        wallets.queue_deltas(batch, [(old.wallet, -old.amount)])
+        
+        await asyncio.gather(
+            batch.commit(service),
+            sheets_execute(service.spreadsheets().batchUpdate(spreadsheetId=sid, body={"requests": [
+                {"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": pos + 1, "endIndex": pos + 2}}},
+                MONTH_PARTITIONS_DELETE]})),
+        )
+        index_after_delete(sid, pos, old.tx_id)
+        mark_snapshot_pending(sid)
+
+@api_action('edit_transaction', kind='write', resources=(TRANSACTIONS_SHEET_NAME, WALLETS_SHEET_NAME))
+async def action_edit_transaction(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    pos, rec, wallets = await locate_transaction(service, sid, payload['id'])
+    if pos == -1: return
+    row = pos + 2
+    old_wallet_uuid = rec.wallet or None
+    
+    new_amount = -abs(float(payload['amount'])) if payload['type'] == 'expense' else abs(float(payload['amount']))
+    new_wallet_uuid = payload.get('wallet_uuid') or old_wallet_uuid or wallets.default_uuid
+    
+    batch = SheetWriteBatch(sid)
+    wallets.queue_deltas(batch, [(old_wallet_uuid, -rec.amount), (new_wallet_uuid, new_amount)])
+    
+    d_str = payload.get('date')
+    fd = (datetime.strptime(d_str, '%Y-%m-%d').strftime('%d.%m.%Y') + datetime.now(MOSCOW_TIMEZONE).strftime(' %H:%M:%S')) if d_str else None
+    
+    range_upd = f"'{TRANSACTIONS_SHEET_NAME}'!A{row}:E{row}" if fd else f"'{TRANSACTIONS_SHEET_NAME}'!B{row}:E{row}"
+    vals = [[fd, new_amount, payload['category'], "Расход" if new_amount < 0 else "Доход", payload.get('comment', '')]] if fd else [[new_amount, payload['category'], "Расход" if new_amount < 0 else "Доход", payload.get('comment', '')]]
+    batch.update(range_upd, vals)
+    batch.update(f"'{TRANSACTIONS_SHEET_NAME}'!H{row}", [[new_wallet_uuid]])
+    await batch.commit(service)
+    
+    if fd:
+        old_month, rec.date = rec.month, fd
+        if parse_tx_timestamp(fd)[1] != old_month: await invalidate_month_partitions(service, sid)
+    rec.amount, rec.category, rec.type, rec.comment = vals[0][-4:]
+    rec.wallet = new_wallet_uuid or ""
+    index_after_update(sid, pos, rec.encode())
+    mark_snapshot_pending(sid)
+
+@api_action('bulk_import', kind='write', resources=(TRANSACTIONS_SHEET_NAME, WALLETS_SHEET_NAME, BUDGET_SHEET_NAME))
+async def action_bulk_import(ctx):
+    """Импорт выписки: CSV/JSON lines -> добавления по IMPORT_CHUNK_ROWS строк.
+
+    Балансы кошельков меняются одной записью в конце (или на уже записанные строки,
+    если импорт оборвался), лимиты бюджета проверяются один раз по категориям.
+    Строки с ID, который уже есть в таблице, пропускаются — выписку можно догрузить повторно.
+    """
+    sid, uid, payload = ctx.sid, ctx.uid, ctx.payload
+    service = get_sheets_service()
+    data, fmt = payload.get('data'), payload.get('format')
+    if not isinstance(data, str) or not data.strip(): raise ApiError(400, 'Empty import')
+    if fmt not in (None, 'csv', 'jsonl'): raise ApiError(400, 'Unknown format')
+    
+    start = time.time()
+    idx, (b_rows, w_rows) = await get_transaction_index(service, sid, [f"'{BUDGET_SHEET_NAME}'!A:B", WALLETS_RANGE])
+    wallets = wallet_index_from_rows(sid, w_rows)
+    now = datetime.now(MOSCOW_TIMEZONE)
+    month_now = now.year * 12 + now.month - 1
+    defaults = {'wallet': payload.get('wallet_uuid') or wallets.default_uuid or '', 'category': payload.get('category') or '',
+                'date': now.strftime(TX_DATE_FORMAT), 'author': ctx.user_name}
+    
+    chunk, chunk_deltas, deltas = [], {}, {}
+    imported, skipped, errors, seen, alert_categories, dates = 0, 0, [], set(), set(), {}
+    
+    def fail(n, e):
+        nonlocal skipped
+        skipped += 1
+        if len(errors) < IMPORT_MAX_ERRORS: errors.append({'line': n, 'error': str(e)})
+    
+    async def flush(final):
+        nonlocal imported
+        batch = SheetWriteBatch(sid)
+        if chunk: batch.append(TRANSACTIONS_SHEET_NAME, chunk)
+        if final:
+            total = dict(deltas)
+            for w, d in chunk_deltas.items(): total[w] = total.get(w, 0.0) + d
+            # Импорт мог идти долго: балансы перечитываются прямо перед записью
+            if total: (await get_wallet_index(service, sid, fresh=True))[0].queue_deltas(batch, list(total.items()))
+        await batch.commit(service)
+        imported += len(chunk)
+        for w, d in chunk_deltas.items(): deltas[w] = deltas.get(w, 0.0) + d
+        chunk.clear(); chunk_deltas.clear()
+    
+    try:
+        for n, rec in iter_import_records(data, fmt):
+            if isinstance(rec, Exception):
+                fail(n, rec)
+                continue
+            try: row = import_row(rec, wallets, defaults, dates)
+            except (ValueError, TypeError) as e:
+                fail(n, e)
+                continue
+            if row[6] in seen or idx.find(row[6]) != -1:
+                fail(n, f"duplicate id {row[6]}")
+                continue
+            if imported + len(chunk) >= IMPORT_MAX_ROWS: raise ApiError(413, f'Import is limited to {IMPORT_MAX_ROWS} rows')
+            seen.add(row[6])
+            chunk.append(row)
+            if row[7]: chunk_deltas[row[7]] = chunk_deltas.get(row[7], 0.0) + row[1]
+            if row[1] < 0 and parse_tx_timestamp(row[0])[1] == month_now: alert_categories.add(row[2])
+            if len(chunk) >= IMPORT_CHUNK_ROWS: await flush(False)
+        await flush(True)
+    except Exception as e:
+        # Уже добавленные строки остаются в таблице — доводим до них балансы
+        print(f"[ERROR] bulk_import stopped after {imported} rows: {e}")
+        if imported:
+            chunk.clear(); chunk_deltas.clear()
+            await flush(True)
+            clear_user_cache(sid)
+        if isinstance(e, ApiError) and not imported: raise
+        if isinstance(e, ValueError): raise ApiError(400, str(e))
+        raise ApiError(getattr(e, 'status_code', 502), json.dumps({'imported': imported, 'skipped': skipped, 'errors': errors, 'error': str(e)}, ensure_ascii=False))
+    
+    elapsed = time.time() - start
+    rate = imported / elapsed if elapsed > 0 else 0.0
+    print(f"[PERF] bulk_import: {imported} rows ({skipped} skipped) in {elapsed:.3f} sec, {rate:.0f} rows/sec")
+    
+    await queue_budget_checks(sid, uid, alert_categories, month_now, b_rows, TX_INDEXES.get(sid) if TX_INDEXES.get(sid) is idx else None)
+    return {'imported': imported, 'skipped': skipped, 'errors': errors, 'rows_per_sec': round(rate, 1)}
+
+@api_action('export_transactions', resources=(TRANSACTIONS_SHEET_NAME,))
+async def action_export_transactions(ctx):
+    payload = ctx.payload
+    fmt = payload.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'): raise ApiError(400, 'Unknown format')
+    month_key = int(payload['year']) * 12 + int(payload['month']) - 1 if payload.get('month') and payload.get('year') else None
+    
+    # Страница — EXPORT_PAGE_ROWS строк листа с cursor за одно чтение; клиент склеивает
+    # страницы, пока next_cursor не станет None
+    service = get_sheets_service()
+    cursor = max(int(payload.get('cursor') or 2), 2)
+    (rows,), row_count = await asyncio.gather(
+        sheets_batch_get(service, ctx.sid, [f"'{TRANSACTIONS_SHEET_NAME}'!A{cursor}:H{cursor + EXPORT_PAGE_ROWS - 1}"]),
+        get_sheet_row_count(service, ctx.sid, TRANSACTIONS_SHEET_NAME))
+    parts = [export_csv_line(EXPORT_FIELDS)] if fmt == 'csv' and cursor == 2 else []
+    size, n, next_cursor = 0, 0, cursor + EXPORT_PAGE_ROWS if cursor + EXPORT_PAGE_ROWS <= row_count else None
+    for i, r in enumerate(rows):
+        rec = export_record(r, month_key, payload.get('wallet_uuid'))
+        if rec is None: continue
+        line = export_line(rec, fmt)
+        size += len(json.dumps(line))  # Как строка займет в теле ответа
+        if size > EXPORT_PAGE_BYTES and n:
+            next_cursor = cursor + i
+            break
+        parts.append(line); n += 1
+    return {'format': fmt, 'rows': n, 'content': ''.join(parts), 'next_cursor': next_cursor}
+
+@api_action('get_wallets', cache_ttl=30, vary_payload=False, etag=True, resources=(WALLETS_SHEET_NAME, DEBTS_SHEET_NAME))
+async def action_get_wallets(ctx):
+    sid = ctx.sid
+    service = get_sheets_service()
+    
+    try:
+        res = await sheets_execute(service.spreadsheets().values().batchGet(spreadsheetId=sid, ranges=[f"'{WALLETS_SHEET_NAME}'!A2:E", f"'{DEBTS_SHEET_NAME}'!A2:E"]))
+        w_rows = res['valueRanges'][0].get('values', [])
+        d_rows = res['valueRanges'][1].get('values', [])
+        wallet_index_from_rows(sid, w_rows)
+    except: w_rows = []; d_rows = []
+    
+    wallets = []
+    total_cash = 0.0
+    
+    for r in w_rows:
+        if len(r) < 5: continue
+        try:
+            bal = parse_amount(r[1])
+            wallets.append({"name": r[0], "balance": bal, "type": r[2], "is_default": r[3].upper() == 'TRUE', "uuid": r[4]})
+            total_cash += bal
+        except: continue 
+    
+    total_owed_me = 0.0; total_i_owe = 0.0
+    for r in d_rows:
+        if len(r) < 5: continue
+        try:
+            amt = parse_amount(r[2])
+            if r[1] == 'credit': total_i_owe += amt
+            elif r[1] == 'debit': total_owed_me += amt
+        except: continue
+    
+    result = {"wallets": wallets, "net_worth": total_cash + total_owed_me - total_i_owe}
+    return result
+
+@api_action('manage_wallet', kind='write', resources=(WALLETS_SHEET_NAME,))
+async def action_manage_wallet(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    if payload.get('type') == 'add':
+        is_default = payload.get('is_default', False)
+        rows = (await sheets_execute(service.spreadsheets().values().get(spreadsheetId=sid, range=WALLETS_RANGE))).get('values', [])
+        batch = SheetWriteBatch(sid)
+        if not rows: is_default = True
+        if is_default:
+            for i, r in enumerate(rows):
+                if len(r) > 3 and r[3].upper() == 'TRUE':
+                    batch.update(f"'{WALLETS_SHEET_NAME}'!D{i+2}", [['FALSE']])
+        new_row = [payload.get('name'), float(payload.get('balance', 0)), payload.get('wallet_type', 'bank_account'), str(is_default).upper(), str(uuid.uuid4())]
+        batch.append(WALLETS_SHEET_NAME, [new_row])
+        await batch.commit(service)
+
+@api_action('reconcile_wallet', kind='write', resources=(WALLETS_SHEET_NAME, TRANSACTIONS_SHEET_NAME))
+async def action_reconcile_wallet(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    w_uuid = payload['wallet_uuid']; actual = float(payload['actual_balance'])
+    # Сверка сравнивает с тем, что в таблице сейчас, а не с кэшем
+    wallets, _ = await get_wallet_index(service, sid, fresh=True)
+    current_bal = wallets.balance(w_uuid)
+    
+    if current_bal is not None:
+        diff = actual - current_bal
+        if abs(diff) > 0.01:
+            batch = SheetWriteBatch(sid)
+            wallets.set_balance(batch, w_uuid, actual)
+            row = [datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y %H:%M:%S'), diff, "Корректировка", "Доход" if diff > 0 else "Расход", "Сверка баланса", ctx.user_name, str(uuid.uuid4()), w_uuid]
+            batch.append(TRANSACTIONS_SHEET_NAME, [row])
+            await batch.commit(service)
+
+@api_action('transfer_between_wallets', kind='write', resources=(WALLETS_SHEET_NAME, TRANSACTIONS_SHEET_NAME))
+async def action_transfer_between_wallets(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    
+    from_uuid = payload['from_wallet']; to_uuid = payload['to_wallet']; amt = abs(float(payload['amount']))
+    d_str = payload.get('date'); fd = (datetime.strptime(d_str, '%Y-%m-%d').strftime('%d.%m.%Y') + datetime.now(MOSCOW_TIMEZONE).strftime(' %H:%M:%S')) if d_str else datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y %H:%M:%S')
+    
+    wallets, _ = await get_wallet_index(service, sid, fresh=True)
+    batch = SheetWriteBatch(sid)
+    wallets.queue_deltas(batch, [(from_uuid, -amt), (to_uuid, amt)])
+    
+    row_out = [fd, -amt, "Перевод", "Перевод", f"{payload.get('comment', 'Перевод')} (исход.)", ctx.user_name, str(uuid.uuid4()), from_uuid]
+    row_in = [fd, amt, "Перевод", "Перевод", f"{payload.get('comment', 'Перевод')} (вход.)", ctx.user_name, str(uuid.uuid4()), to_uuid]
+    batch.append(TRANSACTIONS_SHEET_NAME, [row_out, row_in])
+    await batch.commit(service)
+
+@api_action('manage_debt', kind='write', resources=(DEBTS_SHEET_NAME, WALLETS_SHEET_NAME, TRANSACTIONS_SHEET_NAME))
+async def action_manage_debt(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    print(f"[LOG] manage_debt payload: {payload}")
+    service = get_sheets_service()
+    op_type = payload.get('type')
+    
+    if op_type == 'add':
+        min_pay = float(payload.get('min_payment', 0))
+        row = [payload['name'], payload['debt_type'], float(payload['amount']), float(payload['rate']), str(uuid.uuid4()), min_pay]
+        await sheets_execute(service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [row]}))
+    
+    elif op_type == 'repay':
+        print("[LOG] Repaying debt...")
+        wallets, (rows,) = await get_wallet_index(service, sid, [f"'{DEBTS_SHEET_NAME}'!A2:F"], fresh=True)
+        print(f"[LOG] Fetched {len(rows)} debt rows")
+        
+        target_id = str(payload.get('id')).strip()
+        payment = float(payload['amount'])
+        print(f"[LOG] Target ID: {target_id}, Payment: {payment}")
+        
+        idx = -1
+        for i, r in enumerate(rows):
+            if len(r) > 4:
+                print(f"[LOG] Checking row {i}: ID={r[4]}")
+                if r[4].strip() == target_id:
+                    idx = i
+                    break
+        
+        print(f"[LOG] Index found: {idx}")
+        if idx != -1:
+            raw_amount = rows[idx][2]
+            print(f"[LOG] Raw amount in sheet: {raw_amount}")
+            # --- SAFE PARSING ---
+            current_debt = parse_amount(raw_amount)
+            new_debt = max(0, current_debt - payment)
+            print(f"[LOG] Updating debt to: {new_debt}")
+            
+            batch = SheetWriteBatch(sid)
+            batch.update(f"'{DEBTS_SHEET_NAME}'!C{idx+2}", [[new_debt]])
+            
+            is_expense = (rows[idx][1] == 'credit')
+            amt = -abs(payment) if is_expense else abs(payment)
+            
+            # --- FIX: ALWAYS FIND A WALLET ---
+            def_wallet = wallets.default_uuid
+            print(f"[LOG] Default wallet: {def_wallet}")
+            wallets.queue_deltas(batch, [(def_wallet, amt)])
+            
+            trans_row = [datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y %H:%M:%S'), amt, "Кредиты" if is_expense else "Долги", "Расход" if is_expense else "Доход", f"Погашение: {rows[idx][0]}", ctx.user_name, str(uuid.uuid4()), def_wallet if def_wallet else ""]
+            batch.append(TRANSACTIONS_SHEET_NAME, [trans_row])
+            await batch.commit(service)
+        else:
+            print("[LOG] Debt ID not found in rows")
+            
+    elif op_type == 'forgive':
+        rows = (await sheets_execute(service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!A2:E"))).get('values', [])
+        target_id = str(payload['id']).strip()
+        idx = next((i for i, r in enumerate(rows) if len(r)>4 and r[4].strip() == target_id), -1)
+        if idx != -1: await sheets_execute(service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!C{idx+2}", valueInputOption='USER_ENTERED', body={'values': [[0]]}))
+    
+    elif op_type == 'delete':
+        rows = (await sheets_execute(service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!E:E"))).get('values', [])
+        idx = next((i for i, r in enumerate(rows) if r and r[0].strip() == str(payload['id']).strip()), -1)
+        if idx != -1:
+            sheet_id = await get_sheet_id(service, sid, DEBTS_SHEET_NAME)
+            await sheets_execute(service.spreadsheets().batchUpdate(spreadsheetId=sid, body={"requests": [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": idx, "endIndex": idx + 1}}}]}))
+
+@api_action('get_debts', cache_ttl=CACHE_TTL, vary_payload=False, etag=True, resources=(DEBTS_SHEET_NAME, WALLETS_SHEET_NAME, BUDGET_SHEET_NAME))
+async def action_get_debts(ctx):
+    sid = ctx.sid
+    service = get_sheets_service()
+    
+    # Fetch Debts, Wallets, and Settings in one batch
+    try:
+        res = await sheets_execute(service.spreadsheets().values().batchGet(spreadsheetId=sid, ranges=[f"'{DEBTS_SHEET_NAME}'!A2:F", f"'{WALLETS_SHEET_NAME}'!A2:B", f"'{BUDGET_SHEET_NAME}'!D2:E"]))
+        d_rows = res['valueRanges'][0].get('values', [])
+        w_rows = res['valueRanges'][1].get('values', [])
+        s_rows = res['valueRanges'][2].get('values', [])
+    except: await setup_sheet(sid, refresh=True); d_rows=[]; w_rows=[]; s_rows=[]
+
+    # Parse Settings
+    settings = {r[0]: r[1] for r in s_rows if len(r) >= 2}
+    emergency_goal = float(settings.get('emergency_fund_goal', 0))
+
+    # Parse Wallets (sum positive balances only)
+    total_cash = 0.0
+    for r in w_rows:
+        if len(r) >= 2:
+            try:
+                bal = parse_amount(r[1])
+                if bal > 0: total_cash += bal
+            except: pass
+
+    debts_list = []; total_min_payment_needed = 0; total_owed_me = 0.0
+
+    for r in d_rows:
+        if len(r) < 5: continue
+        try:
+            d_obj = decode_debt_row(r)
+            min_p = d_obj['min_payment']
+            if d_obj['amount'] > 0:
+                debts_list.append(d_obj)
+                if r[1] == 'credit': total_min_payment_needed += min_p
+                else: total_owed_me += d_obj['amount']
+        except: continue
+
+    # Initialize Strategist with Safety Net logic
+    strategist = DebtStrategist(debts_list, extra_monthly_payment=0, current_savings=total_cash, emergency_goal=emergency_goal)
+    s_avalanche, s_snowball = strategist.simulate_many([('avalanche', 0, 0), ('snowball', 0, 0)])
+
+    credits = [d for d in debts_list if d['type'] == 'credit']
+    credits.sort(key=lambda x: x['rate'], reverse=True)
+    target_id = credits[0]['id'] if credits else None
+    total_owe = sum(d['amount'] for d in credits)
+    daily_pain = sum(d['amount'] * (d['rate'] / 100 / 365) for d in credits)
+
+    result = {
+        "items": debts_list,
+        "total_owe": total_owe,
+        "total_owed_me": total_owed_me,
+        "total_min_payment": total_min_payment_needed,
+        "daily_pain": round(daily_pain, 2),
+        "target_debt_id": target_id,
+        "emergency_fund": {"current": total_cash, "goal": emergency_goal},
+        "analytics": {"avalanche": s_avalanche, "snowball": s_snowball, "freedom_date": s_avalanche['freedom_date']}
+    }
+    return result
+
+@api_action('get_history', cache_ttl=CACHE_TTL, etag=True, resources=(TRANSACTIONS_SHEET_NAME,))
+async def action_get_history(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    service = get_sheets_service()
+    offset = int(payload.get('offset', 0)); limit = 20
+    rm = int(payload.get('month')) if payload.get('month') else None
+    ry = int(payload.get('year')) if payload.get('year') else None
+    # Клиенты с курсором передают ключ cursor (пустой на первой странице) и получают next_cursor
+    keyset = 'cursor' in payload
+    try: after = decode_history_cursor(payload['cursor']) if payload.get('cursor') else None
+    except ValueError: raise ApiError(400, 'Bad cursor')
+    idx, _ = await get_transactions(service, sid, rm, ry)
+    positions, next_key = idx.page(rm, ry, after=after, offset=0 if keyset else offset, limit=limit)
+    hist = [idx.history_item(i) for i in positions]
+    if keyset: return {"items": hist, "next_cursor": encode_history_cursor(next_key)}
+    return hist
+
+@api_action('get_summary', cache_ttl=30, etag=True, resources=(TRANSACTIONS_SHEET_NAME, BUDGET_SHEET_NAME, WALLETS_SHEET_NAME, 'ydb'))
+async def action_get_summary(ctx):
+    sid, oid, payload = ctx.sid, ctx.oid, ctx.payload
+    service = get_sheets_service()
+    budget_range = f"'{BUDGET_SHEET_NAME}'!A2:B"
+    rm = int(payload.get('month')) if payload.get('month') else None
+    ry = int(payload.get('year')) if payload.get('year') else None
+
+    async def load_index():
+        try: return await get_transactions(service, sid, rm, ry, [budget_range])
+        except: 
+            await setup_sheet(sid, refresh=True)
+            return await get_transactions(service, sid, rm, ry, [budget_range])
+
+    # Транзакции+бюджет и категории читаются параллельно; подписки списывает timer_handler
+    (idx, (b_rows,)), cats = await asyncio.gather(load_index(), get_categories(oid))
+
+    limits = {} 
+    for r in b_rows:
+        if len(r) >= 2:
+            try: limits[r[0]] = parse_amount(r[1])
+            except: continue
+
+    cat_map = {(c['name'], c['type']): c['id'] for c in cats}
+
+    # Итоги и разбивка — из свертки индекса, без прохода по строкам
+    bal, inc, exp, stats = idx.period_totals(rm, ry, "Без категории")
+
+    breakdown = []
+    for (c_name, c_type), amount in stats.items():
+        limit_val = limits.get(c_name, 0) if c_type == 'expense' else 0
+        breakdown.append({'category': c_name, 'amount': amount, 'limit': limit_val, 'id': cat_map.get((c_name, c_type)), 'type': c_type})
+
+    breakdown.sort(key=lambda x: abs(x['amount']), reverse=True)
+    first_page, next_key = idx.page(rm, ry, limit=20)
+    hist = [idx.history_item(i, "Без категории") for i in first_page]
+    
+    analytics = {"daily_avg": 0, "monthly_forecast": 0}
+    now = datetime.now(MOSCOW_TIMEZONE)
+    if (rm is None and ry is None) or (rm == now.month and ry == now.year):
+        day_of_month = now.day; _, days_in_month = calendar.monthrange(now.year, now.month)
+        daily_avg = abs(exp) / day_of_month if day_of_month > 0 else 0
+        analytics = {"daily_avg": int(daily_avg), "monthly_forecast": int(daily_avg * days_in_month)}
+
+    res_data = {"balance": bal, "income": inc, "expense": exp, "breakdown": breakdown, "history": hist, "has_more": next_key is not None, "next_cursor": encode_history_cursor(next_key), "analytics": analytics}
+    return res_data
+
+async def load_credit_portfolio(service, sid):
+    """Кредиты из листа долгов: (debts_list, total_debt). Кэшируется до записи в таблицу."""
+    cache_key = get_cache_key(sid, 'credit_portfolio', {})
+    cached = get_from_cache(cache_key)
+    if cached is not None: return cached['debts'], cached['total']
+
+    try:
+        resp = await sheets_execute(service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!A2:F"))
+        rows = resp.get('values', [])
+    except: rows = []
+
+    debts_list = []
+    total_debt = 0.0
+    for r in rows:
+        if len(r) < 5: continue
+        try:
+            d_obj = decode_debt_row(r)
+            if d_obj['amount'] > 0 and d_obj['type'] == 'credit': 
+                debts_list.append(d_obj)
+                total_debt += d_obj['amount']
+        except: continue
+    save_to_cache(cache_key, {'debts': debts_list, 'total': total_debt})
+    return debts_list, total_debt
+
+@api_action('calculate_expense_impact', resources=(DEBTS_SHEET_NAME,))
+async def action_calculate_expense_impact(ctx):
+    sid, payload = ctx.sid, ctx.payload
+    amount_to_check = float(payload.get('amount', 0))
+    if amount_to_check <= 0:
+        return {'days_delayed': 0, 'interest_cost': 0, 'percentage': 0, 'total_debt': 0}
+
+    debts_list, total_debt = await load_credit_portfolio(get_sheets_service(), sid)
+    point = expense_impact_points(debts_list, total_debt, [amount_to_check])[0]
+    return {
+        'days_delayed': point['days_delayed'],
+        'interest_cost': point['interest_cost'],
+        'percentage': point['percentage'],
+        'total_debt': total_debt
+    }
+
+IMPACT_CURVE_MAX_POINTS = 100
+
+@api_action('get_expense_impact_curve', cache_ttl=CACHE_TTL, resources=(DEBTS_SHEET_NAME,))
+async def action_get_expense_impact_curve(ctx):
+    """Вся кривая влияния трат за один запрос: UI интерполирует между точками сам.
+
+    payload: либо amounts — список сумм, либо max_amount и steps (по умолчанию 20).
+    fingerprint меняется вместе с портфелем — по нему клиент понимает, что кривую пора перезапросить.
+    """
+    sid, payload = ctx.sid, ctx.payload
+    if payload.get('amounts'):
+        amounts = sorted({float(a) for a in payload['amounts'] if float(a) > 0})
+    else:
+        max_amount = float(payload.get('max_amount', 0))
+        steps = max(1, min(int(payload.get('steps', 20)), IMPACT_CURVE_MAX_POINTS))
+        amounts = [round(max_amount * i / steps, 2) for i in range(1, steps + 1)] if max_amount > 0 else []
+    amounts = amounts[:IMPACT_CURVE_MAX_POINTS]
+
+    debts_list, total_debt = await load_credit_portfolio(get_sheets_service(), sid)
+    return {
+        'total_debt': total_debt,
+        'fingerprint': portfolio_fingerprint(DebtStrategist(debts_list)),
+        'points': expense_impact_points(debts_list, total_debt, amounts) if amounts else []
+    }
+
+@api_action('get_family_members', resources=('ydb',))
+async def action_get_family_members(ctx):
+    oid, uid = ctx.oid, ctx.uid
+    res = await ydb_query('get_family', {'$owner_id': oid})
+    members = []
+    
+    if res and res[0].rows:
+        for row in res[0].rows:
+            mid = int(row.telegram_id)
+            members.append({"id": mid, "name": ydb_str(row.first_name), "is_owner": mid == oid})
+    
+    result = {"members": members, "is_requester_owner": uid == oid}
+    return result
+
+@api_action('kick_member', kind='write', resources=('ydb',))
+async def action_kick_member(ctx):
+    oid, uid, payload = ctx.oid, ctx.uid, ctx.payload
+    if uid != oid: raise ApiError(403, 'Not owner')
+    
+    target_id = int(payload['id'])
+    await ydb_query('delete_user', {'$telegram_id': target_id})
+    invalidate_principal(target_id)
+
+BATCH_MAX_ACTIONS = 10
+
+@api_action('batch')
+async def action_batch(ctx):
+    """Несколько читающих действий за один вызов: авторизация и пользователь общие,
+    под-действия выполняются параллельно, их чтения из Sheets объединяются (ReadCoalescer).
+
+    payload: {'actions': [{'action': имя, 'payload': {...}, 'key': ключ (по умолчанию имя)}]}
+    Ответ: {'results': {ключ: данные}, 'errors': {ключ: {'status', 'error'}}}.
+    """
+    items = ctx.payload.get('actions')
+    if not isinstance(items, list) or not items: raise ApiError(400, 'Empty batch')
+    if len(items) > BATCH_MAX_ACTIONS: raise ApiError(400, f'Too many actions in batch (max {BATCH_MAX_ACTIONS})')
+    subs = {}
+    for item in items:
+        name = item.get('action'); key = item.get('key') or name
+        spec = ACTIONS.get(name)
+        # Записи не пускаем: порядок относительно параллельных чтений не определен
+        if spec is None or spec.kind != 'read' or spec is ACTIONS['batch']: raise ApiError(400, f'Action not allowed in batch: {name}')
+        if key in subs: raise ApiError(400, f'Duplicate batch key: {key}')
+        subs[key] = (spec, ActionContext(name, ctx.uid, ctx.user_name, item.get('payload') or {}, ctx.sid, ctx.oid))
+
+    if any(spec.etag for spec, _ in subs.values()):
+        revision = await current_revision(ctx.sid)
+        for spec, sub in subs.values():
+            if spec.etag: sub.revision = revision
+    coalescer = ReadCoalescer(len(subs))
+
+    async def run(key, spec, sub):
+        start = time.time()
+        try:
+            result, from_cache = await dispatch_action(spec, sub)
+            record_action_stats(spec.name, time.time() - start, cache_hit=from_cache)
+            return key, result, None
+        except ApiError as e:
+            record_action_stats(spec.name, time.time() - start, error=e.status_code >= 500)
+            return key, None, {'status': e.status_code, 'error': e.body}
+        except Exception as e:
+            print(f"[ERROR] Batch action {key}: {e}")
+            traceback.print_exc()
+            record_action_stats(spec.name, time.time() - start, error=True)
+            return key, None, {'status': 500, 'error': str(e)}
+        finally: coalescer.finish()
+
+    token = SHEETS_COALESCER.set(coalescer)
+    try: done = await asyncio.gather(*(run(key, spec, sub) for key, (spec, sub) in subs.items()))
+    finally:
+        coalescer.closed = True
+        SHEETS_COALESCER.reset(token)
+    print(f"[PERF] Batch of {len(subs)} actions: {coalescer.reads} reads merged into {coalescer.flushes} batchGet")
+    return {'results': {key: result for key, result, err in done if err is None},
+            'errors': {key: err for key, _, err in done if err is not None}}
+
 # --- MAIN API HANDLER ---
 
+def parse_webapp_init_data(token, init_data):
+    """Проверяет подпись initData веб-приложения Telegram и возвращает dict пользователя.
+
+    Тот же алгоритм, что aiogram.utils.web_app.safe_parse_webapp_init_data, но без
+    импорта aiogram. ValueError, если подпись не сошлась или данных нет.
+    """
+    if not token or not init_data: raise ValueError("no init data")
+    fields = dict(parse_qsl(init_data, strict_parsing=True))
+    received = fields.pop('hash', '')
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest(), received):
+        raise ValueError("invalid init data signature")
+    return json.loads(fields['user'])
+
+def prewarm():
+    """Загружает библиотеки и создает клиенты заранее. Драйвер YDB сюда не входит:
+    он привязан к event loop и поднимается в первом запросе."""
+    load_ydb(); load_numpy()
+    get_sheets_service()
+    get_bot(); get_dispatcher()
+
+def startup_report():
+    return {'mode': STARTUP_MODE, 'stages': {k: round(v, 4) for k, v in STARTUP_TIMINGS.items()}}
+
+def log_startup_once():
+    global _STARTUP_REPORTED
+    if _STARTUP_REPORTED: return
+    _STARTUP_REPORTED = True
+    print("[PERF] Startup: " + ", ".join(f"{k} {v * 1000:.0f} ms" for k, v in STARTUP_TIMINGS.items()))
+
 async def handler(event, context):
     print(f"[LOG] Raw event received: {event}")
     method = event.get("httpMethod")
     print(f"[LOG] >>> NEW REQUEST. Method: {method}")
     cors = {
         'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Headers': 'Content-Type',
-        'Access-Control-Allow-Methods': 'POST, GET, OPTIONS'
+        'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+        'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
+        'Access-Control-Expose-Headers': 'ETag'
     }
 
     if not method:
+        if is_timer_event(event): return await timer_handler(event, context)
         return {
             "statusCode": 200,
             "body": "ok",
@@ -542,752 +3368,88 @@ async def handler(event, context):
         
         if 'update_id' in body:
             print("[LOG] Processing Telegram Update")
-            await dp.feed_update(bot=bot, update=types.Update.model_validate(body, context={"bot": bot}))
+            from aiogram import types
+            tg_bot = get_bot()
+            await get_dispatcher().feed_update(bot=tg_bot, update=types.Update.model_validate(body, context={"bot": tg_bot}))
             return {'statusCode': 200, 'body': 'ok'}
 
         if 'action' in body:
             action = body['action']
             print(f"[LOG] Processing Action: {action}")
-            try: init_data = safe_parse_webapp_init_data(BOT_TOKEN, body.get('initData'))
+            try: tg_user = parse_webapp_init_data(BOT_TOKEN, body.get('initData'))
             except Exception as e: 
                 print(f"[ERROR] Auth failed: {e}")
                 return {'statusCode': 401, 'headers': cors, 'body': 'Auth Error'}
             
-            uid = init_data.user.id
+            uid = int(tg_user['id'])
             payload = body.get('payload', {})
             print(f"[LOG] User: {uid}, Payload: {json.dumps(payload, ensure_ascii=False)}")
-            
-            if action == 'check_user':
-                u = get_user_data(uid)
-                if u: save_user_data(uid, u['spreadsheet_id'], u['owner_id'], init_data.user.first_name)
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps({'is_registered': bool(u), 'user_id': uid})}
-            
-            user_data = get_user_data(uid)
-            if not user_data: 
-                print("[LOG] User not found in DB")
-                return {'statusCode': 403, 'headers': cors, 'body': 'User not found'}
-            
-            sid = user_data['spreadsheet_id']
-            oid = int(user_data['owner_id'])
-            print(f"[LOG] Spreadsheet ID: {sid}, Owner ID: {oid}")
-            
-            pool = get_ydb_pool()
-            
-            if action == 'update_structure':
-                await setup_sheet(sid)
-                clear_user_cache(sid)
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-            
-            if action == 'get_categories':
-                start = time.time()
-                cache_key = get_cache_key(sid, 'get_categories', {})
-                cached = get_from_cache(cache_key)
-                if cached:
-                    print(f"[PERF] get_categories took {time.time() - start:.3f} sec (cache)")
-                    return {'statusCode': 200, 'headers': cors, 'body': json.dumps(cached)}
-                
-                query = f"SELECT category_id, category_name, category_type FROM `categories` WHERE telegram_id = {oid};"
-                
-                def callee(session):
-                    return session.transaction().execute(query, commit_tx=True)
-                
-                res = pool.retry_operation_sync(callee)
-                cats = []
-                
-                if res and res[0].rows:
-                    for row in res[0].rows:
-                        try:
-                            cn = row.category_name.decode('utf-8') if isinstance(row.category_name, bytes) else row.category_name
-                            ct = row.category_type.decode('utf-8') if isinstance(row.category_type, bytes) else row.category_type
-                            ci = row.category_id.decode('utf-8') if isinstance(row.category_id, bytes) else row.category_id
-                        except:
-                            cn, ct, ci = row.category_name, row.category_type, row.category_id
-                        cats.append({"id": ci, "name": cn, "type": ct})
-                
-                save_to_cache(cache_key, cats, ttl=300)
-                print(f"[PERF] get_categories took {time.time() - start:.3f} sec")
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps(cats)}
-
-            if action == 'add_category':
-                query = f"""
-                    UPSERT INTO `categories` (telegram_id, category_id, category_name, category_type)
-                    VALUES ({oid}, "{str(uuid.uuid4())}", "{get_safe_str(payload['name'])}", "{get_safe_str(payload['type'])}");
-                """
-                execute_query(query)
-                clear_user_cache(sid)
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-            
-            if action == 'edit_category':
-                query = f"""
-                    UPDATE `categories` SET category_name = "{get_safe_str(payload['new_name'])}"
-                    WHERE telegram_id = {oid} AND category_id = "{get_safe_str(payload['id'])}";
-                """
-                execute_query(query)
-                clear_user_cache(sid)
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-            
-            if action == 'delete_category':
-                query = f"DELETE FROM `categories` WHERE telegram_id = {oid} AND category_id = \"{get_safe_str(payload['id'])}\";"
-                execute_query(query)
-                clear_user_cache(sid)
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
 
-            if action == 'get_category_stats':
-                cache_key = get_cache_key(sid, 'get_category_stats', payload)
-                cached = get_from_cache(cache_key)
-                if cached: return {'statusCode': 200, 'headers': cors, 'body': json.dumps(cached)}
-                
-                service = get_sheets_service()
-                
-                try:
-                    resp = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'!A2:C").execute()
-                    rows = resp.get('values', [])
-                except: rows = []
-                
-                cat_name = payload['category']
-                monthly_spent = {}
-                
-                for r in rows:
-                    if len(r) < 3 or r[2] != cat_name: continue
-                    try:
-                        dt = datetime.strptime(r[0], '%d.%m.%Y %H:%M:%S')
-                        amt = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', '').replace('₽', ''))
-                        if amt < 0:
-                            key = f"{dt.year}-{dt.month:02d}"
-                            monthly_spent[key] = monthly_spent.get(key, 0) + abs(amt)
-                    except: continue
-                
-                history = []
-                sorted_keys = sorted(monthly_spent.keys(), reverse=True)
-                
-                for k in sorted_keys[:3]:
-                    year, month = map(int, k.split('-'))
-                    label = datetime(year, month, 1).strftime('%B %Y')
-                    history.append({"label": label, "amount": monthly_spent[k]})
-                
-                result = {"history": history}
-                save_to_cache(cache_key, result)
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps(result)}
-
-            if action == 'set_budget':
-                service = get_sheets_service()
-                
-                try:
-                    resp = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!A2:C").execute()
-                    rows = resp.get('values', [])
-                except: rows = []
-                
-                cat_name = payload['category_name']
-                limit_val = float(payload['limit'])
-                found_idx = -1
-                
-                for i, r in enumerate(rows):
-                    if len(r) >= 1 and r[0] == cat_name:
-                        found_idx = i
-                        break
-                
-                if found_idx != -1:
-                    service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!B{found_idx+2}:C{found_idx+2}", valueInputOption='USER_ENTERED', body={'values': [[limit_val, datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y')]]}).execute()
-                else:
-                    new_row = [cat_name, limit_val, datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y')]
-                    service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [new_row]}).execute()
-                
-                clear_user_cache(sid)
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-
-            if action == 'get_settings':
-                service = get_sheets_service()
-                
-                try:
-                    resp = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!D2:E").execute()
-                    rows = resp.get('values', [])
-                except: rows = []
-                
-                settings = {}
-                for r in rows:
-                    if len(r) >= 2:
-                        settings[r[0]] = r[1]
-                
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps(settings)}
-
-            if action == 'set_setting':
-                service = get_sheets_service()
-                
-                try:
-                    resp = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!D2:E").execute()
-                    rows = resp.get('values', [])
-                except: rows = []
-                
-                key = payload['key']
-                value = payload['value']
-                found_idx = -1
-                
-                for i, r in enumerate(rows):
-                    if len(r) >= 1 and r[0] == key:
-                        found_idx = i
-                        break
-                
-                if found_idx != -1:
-                    service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!E{found_idx+2}", valueInputOption='USER_ENTERED', body={'values': [[value]]}).execute()
-                else:
-                    new_row = [[], [], [], key, value]
-                    service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{BUDGET_SHEET_NAME}'!A", valueInputOption='USER_ENTERED', body={'values': [new_row]}).execute()
-                
-                clear_user_cache(sid)
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-
-            if action == 'get_subscriptions':
-                cache_key = get_cache_key(sid, 'get_subscriptions', {})
-                cached = get_from_cache(cache_key)
-                if cached: return {'statusCode': 200, 'headers': cors, 'body': json.dumps(cached)}
-                
-                service = get_sheets_service()
-                
-                try:
-                    resp = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{SUBSCRIPTIONS_SHEET_NAME}'!A2:F").execute()
-                    rows = resp.get('values', [])
-                except: rows = []
-                
-                subs = []
-                for r in rows:
-                    if len(r) < 6: continue
-                    subs.append({"name": r[0], "amount": float(r[1]), "category": r[2], "day": int(r[3]), "last_paid": r[4], "id": r[5]})
-                
-                save_to_cache(cache_key, subs)
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps(subs)}
-
-            if action == 'add_subscription':
-                service = get_sheets_service()
-                
-                new_row = [payload['name'], float(payload['amount']), payload['category'], int(payload['day']), "-", str(uuid.uuid4())]
-                service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{SUBSCRIPTIONS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [new_row]}).execute()
-                clear_user_cache(sid)
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-
-            if action == 'delete_subscription':
-                service = get_sheets_service()
-                
-                rows = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{SUBSCRIPTIONS_SHEET_NAME}'!F:F").execute().get('values', [])
-                target_id = str(payload['id']).strip()
-                idx = next((i for i, r in enumerate(rows) if r and r[0].strip() == target_id), -1)
-                
-                if idx != -1:
-                    sheet_meta = service.spreadsheets().get(spreadsheetId=sid).execute()
-                    sheet_id = next(s['properties']['sheetId'] for s in sheet_meta['sheets'] if s['properties']['title'] == SUBSCRIPTIONS_SHEET_NAME)
-                    service.spreadsheets().batchUpdate(spreadsheetId=sid, body={"requests": [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": idx, "endIndex": idx + 1}}}]}).execute()
-                    clear_user_cache(sid)
-                
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-
-            if action == 'add_transaction':
-                service = get_sheets_service()
-                
-                amount = float(payload['amount'])
-                final_amount = -abs(amount) if payload['type'] == 'expense' else abs(amount)
-                
-                wallet_uuid = payload.get('wallet_uuid') or get_default_wallet_uuid(service, sid)
-                if wallet_uuid:
-                    update_wallet_balance(service, sid, wallet_uuid, final_amount)
-                
-                d_str = payload.get('date')
-                formatted_date = (datetime.strptime(d_str, '%Y-%m-%d').strftime('%d.%m.%Y') + datetime.now(MOSCOW_TIMEZONE).strftime(' %H:%M:%S')) if d_str else datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y %H:%M:%S')
-                
-                row = [formatted_date, final_amount, payload['category'], "Расход" if final_amount < 0 else "Доход", payload.get('comment', ''), init_data.user.first_name, str(uuid.uuid4()), wallet_uuid if wallet_uuid else ""]
-                service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [row]}).execute()
-                
-                if final_amount < 0:
-                    await check_budget_and_notify(service, sid, payload['category'], uid, abs(final_amount))
-                
-                clear_user_cache(sid)
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-            
-            if action == 'delete_transaction':
-                service = get_sheets_service()
-                
-                rows = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'!G:G").execute().get('values', [])
-                target_id = str(payload['id']).strip()
-                idx = next((i for i, r in enumerate(rows) if r and r[0].strip() == target_id), -1)
-                
-                if idx != -1:
-                    rows_full = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'!A{idx+2}:H{idx+2}").execute().get('values', [[]])[0]
-                    if len(rows_full) >= 8:
-                        old_amount = float(rows_full[1])
-                        old_wallet_uuid = rows_full[7]
-                        if old_wallet_uuid:
-                            update_wallet_balance(service, sid, old_wallet_uuid, -old_amount)
-                    
-                    sheet_meta = service.spreadsheets().get(spreadsheetId=sid).execute()
-                    sheet_id = next(s['properties']['sheetId'] for s in sheet_meta['sheets'] if s['properties']['title'] == TRANSACTIONS_SHEET_NAME)
-                    service.spreadsheets().batchUpdate(spreadsheetId=sid, body={"requests": [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": idx, "endIndex": idx + 1}}}]}).execute()
-                    clear_user_cache(sid)
-                
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-
-            if action == 'edit_transaction':
-                service = get_sheets_service()
-                
-                rows = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'!G:G").execute().get('values', [])
-                target_id = str(payload['id']).strip()
-                idx = -1
-                old_amount = 0.0
-                old_wallet_uuid = None
-                
-                for i, r in enumerate(rows):
-                    if len(r) >= 1 and r[0].strip() == target_id:
-                        idx = i
-                        full_row = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'!A{idx+2}:H{idx+2}").execute().get('values', [[]])[0]
-                        try:
-                            old_amount = float(str(full_row[1]).replace(',', '.').replace(' ', '').replace('\xa0', ''))
-                            if len(full_row) >= 8: old_wallet_uuid = full_row[7]
-                        except: pass
-                        break
-                
-                if idx != -1:
-                    new_amount = -abs(float(payload['amount'])) if payload['type'] == 'expense' else abs(float(payload['amount']))
-                    new_wallet_uuid = payload.get('wallet_uuid') or old_wallet_uuid or get_default_wallet_uuid(service, sid)
-                    
-                    if old_wallet_uuid: update_wallet_balance(service, sid, old_wallet_uuid, -old_amount)
-                    if new_wallet_uuid: update_wallet_balance(service, sid, new_wallet_uuid, new_amount)
-                    
-                    d_str = payload.get('date')
-                    fd = (datetime.strptime(d_str, '%Y-%m-%d').strftime('%d.%m.%Y') + datetime.now(MOSCOW_TIMEZONE).strftime(' %H:%M:%S')) if d_str else None
-                    
-                    range_upd = f"'{TRANSACTIONS_SHEET_NAME}'!A{idx+2}:E{idx+2}" if fd else f"'{TRANSACTIONS_SHEET_NAME}'!B{idx+2}:E{idx+2}"
-                    vals = [[fd, new_amount, payload['category'], "Расход" if new_amount < 0 else "Доход", payload.get('comment', '')]] if fd else [[new_amount, payload['category'], "Расход" if new_amount < 0 else "Доход", payload.get('comment', '')]]
-                    service.spreadsheets().values().update(spreadsheetId=sid, range=range_upd, valueInputOption='USER_ENTERED', body={'values': vals}).execute()
-                    service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'!H{idx+2}", valueInputOption='USER_ENTERED', body={'values': [[new_wallet_uuid]]}).execute()
-                    clear_user_cache(sid)
-                
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-
-            if action == 'get_wallets':
-                start = time.time()
-                cache_key = get_cache_key(sid, 'get_wallets', {})
-                cached = get_from_cache(cache_key)
-                if cached:
-                    print(f"[PERF] get_wallets took {time.time() - start:.3f} sec (cache)")
-                    return {'statusCode': 200, 'headers': cors, 'body': json.dumps(cached)}
-
-                service = get_sheets_service()
-                
-                try:
-                    res = service.spreadsheets().values().batchGet(spreadsheetId=sid, ranges=[f"'{WALLETS_SHEET_NAME}'!A2:E", f"'{DEBTS_SHEET_NAME}'!A2:E"]).execute()
-                    w_rows = res['valueRanges'][0].get('values', [])
-                    d_rows = res['valueRanges'][1].get('values', [])
-                except: w_rows = []; d_rows = []
-                
-                wallets = []
-                total_cash = 0.0
-                
-                for r in w_rows:
-                    if len(r) < 5: continue
-                    try:
-                        bal = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', ''))
-                        wallets.append({"name": r[0], "balance": bal, "type": r[2], "is_default": r[3].upper() == 'TRUE', "uuid": r[4]})
-                        total_cash += bal
-                    except: continue 
-                
-                total_owed_me = 0.0; total_i_owe = 0.0
-                for r in d_rows:
-                    if len(r) < 5: continue
-                    try:
-                        amt = float(str(r[2]).replace(',', '.').replace(' ', '').replace('\xa0', ''))
-                        if r[1] == 'credit': total_i_owe += amt
-                        elif r[1] == 'debit': total_owed_me += amt
-                    except: continue
-                
-                result = {"wallets": wallets, "net_worth": total_cash + total_owed_me - total_i_owe}
-                save_to_cache(cache_key, result, ttl=30)
-                print(f"[PERF] get_wallets took {time.time() - start:.3f} sec")
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps(result)}
-
-            if action == 'manage_wallet':
-                service = get_sheets_service()
-                
-                if payload.get('type') == 'add':
-                    is_default = payload.get('is_default', False)
-                    rows = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{WALLETS_SHEET_NAME}'!A2:E").execute().get('values', [])
-                    if not rows: is_default = True
-                    if is_default:
-                        for i, r in enumerate(rows):
-                            if len(r) > 3 and r[3].upper() == 'TRUE':
-                                service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{WALLETS_SHEET_NAME}'!D{i+2}", valueInputOption='USER_ENTERED', body={'values': [['FALSE']]}).execute()
-                    new_row = [payload.get('name'), float(payload.get('balance', 0)), payload.get('wallet_type', 'bank_account'), str(is_default).upper(), str(uuid.uuid4())]
-                    service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{WALLETS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [new_row]}).execute()
-                    clear_user_cache(sid)
-                
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-
-            if action == 'reconcile_wallet':
-                service = get_sheets_service()
-                
-                w_uuid = payload['wallet_uuid']; actual = float(payload['actual_balance'])
-                rows = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{WALLETS_SHEET_NAME}'!A2:E").execute().get('values', [])
-                idx = -1; current_bal = 0.0
-                
-                for i, r in enumerate(rows):
-                    if len(r) >= 5 and r[4] == w_uuid:
-                        idx = i
-                        try: current_bal = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', ''))
-                        except: current_bal = 0.0
-                        break
-                
-                if idx != -1:
-                    diff = actual - current_bal
-                    if abs(diff) > 0.01:
-                        service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{WALLETS_SHEET_NAME}'!B{idx+2}", valueInputOption='USER_ENTERED', body={'values': [[actual]]}).execute()
-                        row = [datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y %H:%M:%S'), diff, "Корректировка", "Доход" if diff > 0 else "Расход", "Сверка баланса", init_data.user.first_name, str(uuid.uuid4()), w_uuid]
-                        service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [row]}).execute()
-                        clear_user_cache(sid)
-                
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-
-            if action == 'transfer_between_wallets':
-                service = get_sheets_service()
-                
-                from_uuid = payload['from_wallet']; to_uuid = payload['to_wallet']; amt = abs(float(payload['amount']))
-                d_str = payload.get('date'); fd = (datetime.strptime(d_str, '%Y-%m-%d').strftime('%d.%m.%Y') + datetime.now(MOSCOW_TIMEZONE).strftime(' %H:%M:%S')) if d_str else datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y %H:%M:%S')
-                
-                update_wallet_balance(service, sid, from_uuid, -amt)
-                update_wallet_balance(service, sid, to_uuid, amt)
-                
-                row_out = [fd, -amt, "Перевод", "Перевод", f"{payload.get('comment', 'Перевод')} (исход.)", init_data.user.first_name, str(uuid.uuid4()), from_uuid]
-                row_in = [fd, amt, "Перевод", "Перевод", f"{payload.get('comment', 'Перевод')} (вход.)", init_data.user.first_name, str(uuid.uuid4()), to_uuid]
-                service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [row_out, row_in]}).execute()
-                clear_user_cache(sid)
-                
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-
-            if action == 'manage_debt':
-                print(f"[LOG] manage_debt payload: {payload}")
-                service = get_sheets_service()
-                op_type = payload.get('type')
-                
-                if op_type == 'add':
-                    min_pay = float(payload.get('min_payment', 0))
-                    row = [payload['name'], payload['debt_type'], float(payload['amount']), float(payload['rate']), str(uuid.uuid4()), min_pay]
-                    service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [row]}).execute()
-                    clear_user_cache(sid)
-                
-                elif op_type == 'repay':
-                    print("[LOG] Repaying debt...")
-                    rows = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!A2:F").execute().get('values', [])
-                    print(f"[LOG] Fetched {len(rows)} debt rows")
-                    
-                    target_id = str(payload.get('id')).strip()
-                    payment = float(payload['amount'])
-                    print(f"[LOG] Target ID: {target_id}, Payment: {payment}")
-                    
-                    idx = -1
-                    for i, r in enumerate(rows):
-                        if len(r) > 4:
-                            print(f"[LOG] Checking row {i}: ID={r[4]}")
-                            if r[4].strip() == target_id:
-                                idx = i
-                                break
-                    
-                    print(f"[LOG] Index found: {idx}")
-                    if idx != -1:
-                        raw_amount = rows[idx][2]
-                        print(f"[LOG] Raw amount in sheet: {raw_amount}")
-                        # --- SAFE PARSING ---
-                        current_debt = float(str(raw_amount).replace(',', '.').replace(' ', '').replace('\xa0', '').replace('₽', ''))
-                        new_debt = max(0, current_debt - payment)
-                        print(f"[LOG] Updating debt to: {new_debt}")
-                        
-                        service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!C{idx+2}", valueInputOption='USER_ENTERED', body={'values': [[new_debt]]}).execute()
-                        
-                        is_expense = (rows[idx][1] == 'credit')
-                        amt = -abs(payment) if is_expense else abs(payment)
-                        
-                        # --- FIX: ALWAYS FIND A WALLET ---
-                        def_wallet = get_default_wallet_uuid(service, sid)
-                        print(f"[LOG] Default wallet: {def_wallet}")
-                        if def_wallet: update_wallet_balance(service, sid, def_wallet, amt)
-                        
-                        trans_row = [datetime.now(MOSCOW_TIMEZONE).strftime('%d.%m.%Y %H:%M:%S'), amt, "Кредиты" if is_expense else "Долги", "Расход" if is_expense else "Доход", f"Погашение: {rows[idx][0]}", init_data.user.first_name, str(uuid.uuid4()), def_wallet if def_wallet else ""]
-                        service.spreadsheets().values().append(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'", valueInputOption='USER_ENTERED', body={'values': [trans_row]}).execute()
-                        clear_user_cache(sid)
-                    else:
-                        print("[LOG] Debt ID not found in rows")
-                        
-                elif op_type == 'forgive':
-                    rows = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!A2:E").execute().get('values', [])
-                    target_id = str(payload['id']).strip()
-                    idx = next((i for i, r in enumerate(rows) if len(r)>4 and r[4].strip() == target_id), -1)
-                    if idx != -1: service.spreadsheets().values().update(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!C{idx+2}", valueInputOption='USER_ENTERED', body={'values': [[0]]}).execute()
-                    clear_user_cache(sid)
-                
-                elif op_type == 'delete':
-                    rows = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!E:E").execute().get('values', [])
-                    idx = next((i for i, r in enumerate(rows) if r and r[0].strip() == str(payload['id']).strip()), -1)
-                    if idx != -1:
-                        sheet_meta = service.spreadsheets().get(spreadsheetId=sid).execute()
-                        sheet_id = next(s['properties']['sheetId'] for s in sheet_meta['sheets'] if s['properties']['title'] == DEBTS_SHEET_NAME)
-                        service.spreadsheets().batchUpdate(spreadsheetId=sid, body={"requests": [{"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": idx, "endIndex": idx + 1}}}]}).execute()
-                        clear_user_cache(sid)
-                
+            spec = ACTIONS.get(action)
+            if spec is None:
+                print(f"[LOG] Unknown action: {action}")
                 return {'statusCode': 200, 'headers': cors, 'body': '{}'}
 
-            # --- GET DEBTS (UPDATED v3.7 with Emergency Logic) ---
-            if action == 'get_debts':
-                cache_key = get_cache_key(sid, 'get_debts', {})
-                cached = get_from_cache(cache_key)
-                if cached: return {'statusCode': 200, 'headers': cors, 'body': json.dumps(cached)}
-
-                service = get_sheets_service()
-                
-                # Fetch Debts, Wallets, and Settings in one batch
-                try:
-                    res = service.spreadsheets().values().batchGet(spreadsheetId=sid, ranges=[f"'{DEBTS_SHEET_NAME}'!A2:F", f"'{WALLETS_SHEET_NAME}'!A2:B", f"'{BUDGET_SHEET_NAME}'!D2:E"]).execute()
-                    d_rows = res['valueRanges'][0].get('values', [])
-                    w_rows = res['valueRanges'][1].get('values', [])
-                    s_rows = res['valueRanges'][2].get('values', [])
-                except: await setup_sheet(sid); d_rows=[]; w_rows=[]; s_rows=[]
-
-                # Parse Settings
-                settings = {r[0]: r[1] for r in s_rows if len(r) >= 2}
-                emergency_goal = float(settings.get('emergency_fund_goal', 0))
-
-                # Parse Wallets (sum positive balances only)
-                total_cash = 0.0
-                for r in w_rows:
-                    if len(r) >= 2:
-                        try:
-                            bal = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', ''))
-                            if bal > 0: total_cash += bal
-                        except: pass
-
-                debts_list = []; total_min_payment_needed = 0; total_owed_me = 0.0
-
-                for r in d_rows:
-                    if len(r) < 5: continue
-                    try:
-                        min_p = float(str(r[5]).replace(',', '.')) if len(r) > 5 and r[5] else 0.0
-                        # --- SAFE PARSING ---
-                        amt = float(str(r[2]).replace(',', '.').replace(' ', '').replace('\xa0', '').replace('₽', ''))
-                        
-                        d_obj = {"id": r[4], "name": r[0], "type": r[1], "amount": amt, "rate": float(r[3]), "min_payment": min_p}
-                        if d_obj['amount'] > 0:
-                            debts_list.append(d_obj)
-                            if r[1] == 'credit': total_min_payment_needed += min_p
-                            else: total_owed_me += d_obj['amount']
-                    except: continue
-
-                # Initialize Strategist with Safety Net logic
-                strategist = DebtStrategist(debts_list, extra_monthly_payment=0, current_savings=total_cash, emergency_goal=emergency_goal)
-                s_avalanche = strategist.simulate_payoff('avalanche')
-                s_snowball = strategist.simulate_payoff('snowball')
-
-                credits = [d for d in debts_list if d['type'] == 'credit']
-                credits.sort(key=lambda x: x['rate'], reverse=True)
-                target_id = credits[0]['id'] if credits else None
-                total_owe = sum(d['amount'] for d in credits)
-                daily_pain = sum(d['amount'] * (d['rate'] / 100 / 365) for d in credits)
-
-                result = {
-                    "items": debts_list,
-                    "total_owe": total_owe,
-                    "total_owed_me": total_owed_me,
-                    "total_min_payment": total_min_payment_needed,
-                    "daily_pain": round(daily_pain, 2),
-                    "target_debt_id": target_id,
-                    "emergency_fund": {"current": total_cash, "goal": emergency_goal},
-                    "analytics": {"avalanche": s_avalanche, "snowball": s_snowball, "freedom_date": s_avalanche['freedom_date']}
-                }
-                save_to_cache(cache_key, result)
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps(result)}
-
-            if action == 'get_history':
-                cache_key = get_cache_key(sid, 'get_history', payload)
-                cached = get_from_cache(cache_key)
-                if cached: return {'statusCode': 200, 'headers': cors, 'body': json.dumps(cached)}
-                service = get_sheets_service()
-                offset = int(payload.get('offset', 0)); limit = 20
-                rows = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{TRANSACTIONS_SHEET_NAME}'!A2:G").execute().get('values', [])
-                hist = []
-                rm = int(payload.get('month')) if payload.get('month') else None
-                ry = int(payload.get('year')) if payload.get('year') else None
-                for r in rows:
-                    if len(r) < 2: continue
-                    try: dt = datetime.strptime(r[0], '%d.%m.%Y %H:%M:%S')
-                    except: continue
-                    if rm and ry and (dt.month != rm or dt.year != ry): continue
-                    try: amt = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', '').replace('₽', ''))
-                    except: continue
-                    hist.append({"id": r[6] if len(r)>6 else None, "date": r[0], "amount": amt, "category": r[2] if len(r)>2 else "", "comment": r[4] if len(r)>4 else "", "author": r[5] if len(r)>5 else ""})
-                hist.sort(key=lambda x: datetime.strptime(x['date'], '%d.%m.%Y %H:%M:%S'), reverse=True)
-                chunk = hist[offset : offset + limit]
-                save_to_cache(cache_key, chunk)
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps(chunk)}
-
-            if action == 'get_summary':
-                start = time.time()
-                cache_key = get_cache_key(sid, 'get_summary', payload)
-                cached = get_from_cache(cache_key)
-                if cached:
-                    print(f"[PERF] get_summary took {time.time() - start:.3f} sec (cache)")
-                    return {'statusCode': 200, 'headers': cors, 'body': json.dumps(cached)}
-
-                service = get_sheets_service()
-                today_str = datetime.now(MOSCOW_TIMEZONE).date().isoformat()
-                sub_run_key = f"{sid}:subscriptions_last_run"
-                last_run = get_from_cache(sub_run_key)
-                has_sub_updates = False
-                if last_run != today_str:
-                    has_sub_updates = await process_subscriptions(service, sid)
-                    save_to_cache(sub_run_key, today_str, ttl=86400)
-                if has_sub_updates:
-                    print("[LOG] Subscriptions updated during summary calculation")
-                
-                ranges = [f"'{TRANSACTIONS_SHEET_NAME}'!A2:G", f"'{BUDGET_SHEET_NAME}'!A2:B"]
-                try: resp = service.spreadsheets().values().batchGet(spreadsheetId=sid, ranges=ranges).execute()
-                except: await setup_sheet(sid); resp = service.spreadsheets().values().batchGet(spreadsheetId=sid, ranges=ranges).execute()
-
-                t_rows = resp.get('valueRanges', [])[0].get('values', []) if resp.get('valueRanges') else []
-                b_rows = resp.get('valueRanges', [None, None])[1].get('values', []) if len(resp.get('valueRanges', [])) > 1 and resp.get('valueRanges')[1] else []
-                
-                limits = {} 
-                for r in b_rows:
-                    if len(r) >= 2:
-                        try: limits[r[0]] = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', ''))
-                        except: continue
-
-                cat_q = f"SELECT category_id, category_name, category_type FROM `categories` WHERE telegram_id = {int(oid)};"
-                cat_res = pool.retry_operation_sync(lambda s: s.transaction().execute(cat_q, commit_tx=True))
-                cat_map = {} 
-                if cat_res and cat_res[0].rows:
-                    for r in cat_res[0].rows:
-                        try: cn, ct, ci = r.category_name.decode('utf-8') if isinstance(r.category_name, bytes) else r.category_name, r.category_type.decode('utf-8') if isinstance(r.category_type, bytes) else r.category_type, r.category_id.decode('utf-8') if isinstance(r.category_id, bytes) else r.category_id
-                        except: cn, ct, ci = r.category_name, r.category_type, r.category_id
-                        cat_map[(cn, ct)] = ci
-
-                rm = int(payload.get('month')) if payload.get('month') else None
-                ry = int(payload.get('year')) if payload.get('year') else None
-
-                bal, inc, exp = 0.0, 0.0, 0.0
-                stats = {}; hist = []
-                
-                for r in t_rows:
-                    if len(r) < 2: continue
-                    try: dt = datetime.strptime(r[0], '%d.%m.%Y %H:%M:%S')
-                    except: continue
-                    if rm and ry and (dt.month != rm or dt.year != ry): continue
-                    try: amt = float(str(r[1]).replace(',', '.').replace(' ', '').replace('\xa0', '').replace('₽', ''))
-                    except: continue
-                    bal += amt
-                    cat_name = r[2] if len(r) > 2 and r[2] != "" else "Без категории"
-                    is_transfer = (len(r)>3 and r[3] == "Перевод") or cat_name == "Перевод" or cat_name == "Корректировка"
-                    
-                    if not is_transfer:
-                        t_type = "income" if amt > 0 else "expense"
-                        if amt > 0: inc += amt
-                        else: exp += amt
-                        stats_key = (cat_name, t_type)
-                        stats[stats_key] = stats.get(stats_key, 0.0) + amt
-                    
-                    hist.append({"id": r[6] if len(r)>6 else None, "date": r[0], "amount": amt, "category": cat_name, "comment": r[4] if len(r)>4 else "", "author": r[5] if len(r)>5 else ""})
-
-                breakdown = []
-                for (c_name, c_type), amount in stats.items():
-                    limit_val = limits.get(c_name, 0) if c_type == 'expense' else 0
-                    breakdown.append({'category': c_name, 'amount': amount, 'limit': limit_val, 'id': cat_map.get((c_name, c_type)), 'type': c_type})
-
-                breakdown.sort(key=lambda x: abs(x['amount']), reverse=True)
-                hist.sort(key=lambda x: datetime.strptime(x['date'], '%d.%m.%Y %H:%M:%S'), reverse=True)
-                
-                analytics = {"daily_avg": 0, "monthly_forecast": 0}
-                now = datetime.now(MOSCOW_TIMEZONE)
-                if (rm is None and ry is None) or (rm == now.month and ry == now.year):
-                    day_of_month = now.day; _, days_in_month = calendar.monthrange(now.year, now.month)
-                    daily_avg = abs(exp) / day_of_month if day_of_month > 0 else 0
-                    analytics = {"daily_avg": int(daily_avg), "monthly_forecast": int(daily_avg * days_in_month)}
-
-                res_data = {"balance": bal, "income": inc, "expense": exp, "breakdown": breakdown, "history": hist[:20], "has_more": len(hist) > 20, "analytics": analytics}
-                save_to_cache(cache_key, res_data, ttl=30)
-                print(f"[PERF] get_summary took {time.time() - start:.3f} sec")
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps(res_data)}
-
-            # --- CALCULATE EXPENSE IMPACT (v3.5) ---
-            if action == 'calculate_expense_impact':
-                amount_to_check = float(payload.get('amount', 0))
-                if amount_to_check <= 0:
-                    return {'statusCode': 200, 'headers': cors, 'body': json.dumps({'days_delayed': 0, 'interest_cost': 0, 'percentage': 0, 'total_debt': 0})}
-
-                service = get_sheets_service()
-                
-                # 1. Fetch current debts
-                try:
-                    resp = service.spreadsheets().values().get(spreadsheetId=sid, range=f"'{DEBTS_SHEET_NAME}'!A2:F").execute()
-                    rows = resp.get('values', [])
-                except: rows = []
-
-                debts_list = []
-                total_debt = 0.0
-                for r in rows:
-                    if len(r) < 5: continue
-                    try:
-                        min_p = float(str(r[5]).replace(',', '.')) if len(r) > 5 and r[5] else 0.0
-                        d_obj = {"id": r[4], "name": r[0], "type": r[1], "amount": float(r[2]), "rate": float(r[3]), "min_payment": min_p}
-                        if d_obj['amount'] > 0 and d_obj['type'] == 'credit': 
-                            debts_list.append(d_obj)
-                            total_debt += d_obj['amount']
-                    except: continue
-
-                # 2. Calculate Percentage
-                percentage_of_total = (amount_to_check / total_debt * 100) if total_debt > 0 else 0
-
-                # 3. Simulate Scenarios
-                # При симуляции влияния мы не учитываем подушку, чтобы просто показать разницу во времени
-                strategist = DebtStrategist(debts_list)
-                # A: Baseline (Status Quo)
-                base_scenario = strategist.simulate_payoff('avalanche', one_time_payment=0)
-                # B: Invested (If we put this money into debt instead of spending)
-                invest_scenario = strategist.simulate_payoff('avalanche', one_time_payment=amount_to_check)
-                
-                # 4. Difference
-                months_diff = base_scenario['months_to_free'] - invest_scenario['months_to_free']
-                interest_diff = base_scenario['total_interest'] - invest_scenario['total_interest']
-                days_delayed = months_diff * 30
-                
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps({
-                    'days_delayed': days_delayed,
-                    'interest_cost': round(interest_diff, 2),
-                    'percentage': round(percentage_of_total, 1),
-                    'total_debt': total_debt
-                })}
-
-            if action == 'get_family_members':
-                query = f"SELECT telegram_id, first_name FROM `users` WHERE owner_id = {oid};"
-                
-                def callee(session):
-                    return session.transaction().execute(query, commit_tx=True)
-                
-                res = pool.retry_operation_sync(callee)
-                members = []
-                
-                if res and res[0].rows:
-                    for row in res[0].rows:
-                        mid = int(row.telegram_id)
-                        fname = row.first_name.decode('utf-8') if isinstance(row.first_name, bytes) else row.first_name
-                        members.append({"id": mid, "name": fname, "is_owner": mid == oid})
-                
-                result = {"members": members, "is_requester_owner": uid == oid}
-                return {'statusCode': 200, 'headers': cors, 'body': json.dumps(result)}
+            ctx = ActionContext(action, uid, tg_user.get('first_name', ''), payload)
+            sheets_calls = [0]; SHEETS_CALLS.set(sheets_calls)
+            start = time.time()
+            try:
+                if spec.requires_user:
+                    user_data = await get_user_data(uid, fresh=spec.kind == 'write')
+                    if not user_data: 
+                        print("[LOG] User not found in DB")
+                        raise ApiError(403, 'User not found')
+                    ctx.sid = user_data['spreadsheet_id']
+                    ctx.oid = int(user_data['owner_id'])
+                    print(f"[LOG] Spreadsheet ID: {ctx.sid}, Owner ID: {ctx.oid}")
+
+                if spec.etag and ctx.sid: ctx.revision = await current_revision(ctx.sid)
+                etag = action_etag(spec, ctx) if spec.etag else None
+                if etag_matches(event, etag):
+                    elapsed = time.time() - start
+                    record_action_stats(action, elapsed, cache_hit=True, sheets_calls=sheets_calls[0])
+                    log_stats_periodically()
+                    print(f"[PERF] {action} not modified ({etag}) in {elapsed:.3f} sec")
+                    return {'statusCode': 304, 'headers': dict(cors, ETag=etag), 'body': ''}
+
+                result, from_cache = await dispatch_action(spec, ctx)
+            except ApiError as e:
+                record_action_stats(action, time.time() - start, error=e.status_code >= 500, sheets_calls=sheets_calls[0])
+                log_stats_periodically()
+                return {'statusCode': e.status_code, 'headers': cors, 'body': e.body}
+            except Exception:
+                record_action_stats(action, time.time() - start, error=True, sheets_calls=sheets_calls[0])
+                log_stats_periodically()
+                raise
+
+            elapsed = time.time() - start
+            record_action_stats(action, elapsed, cache_hit=from_cache, sheets_calls=sheets_calls[0])
+            print(f"[PERF] {action} took {elapsed:.3f} sec, sheets calls: {sheets_calls[0]}{' (cache)' if from_cache else ''}")
+            log_stats_periodically()
+            log_startup_once()
+            return json_response(event, cors, json.dumps(result) if result is not None else '{}', etag)
+
+        return {'statusCode': 200, 'headers': cors, 'body': '{}'}
 
-            if action == 'kick_member':
-                if uid != oid: return {'statusCode': 403, 'headers': cors, 'body': 'Not owner'}
-                
-                target_id = int(payload['id'])
-                query = f"DELETE FROM `users` WHERE telegram_id = {target_id};"
-                execute_query(query)
-                clear_user_cache(sid)
-                
-                return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-            
-            return {'statusCode': 200, 'headers': cors, 'body': '{}'}
-            
     except Exception as e:
         print(f"[ERROR] CRITICAL: {e}")
         traceback.print_exc()
-        return {'statusCode': 500, 'headers': cors, 'body': json.dumps({'error': str(e)})}
\ No newline at end of file
+        return {'statusCode': 500, 'headers': cors, 'body': json.dumps({'error': str(e)})}
+
+STARTUP_TIMINGS['module'] = time.perf_counter() - STARTUP_T0
+if STARTUP_MODE == 'prewarm':
+    try: prewarm()
+    except Exception as e: print(f"[ERROR] Prewarm: {e}")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['bench-debts']: benchmark_debt_engines()
+    elif sys.argv[1:2] == ['startup-profile']:
+        # python -X importtime main.py startup-profile — подробная разбивка по модулям
+        if STARTUP_MODE != 'prewarm': prewarm()
+        print(json.dumps(startup_report(), indent=2))
+    elif sys.argv[1:2] == ['bench-codec']: benchmark_row_codec()
+    elif sys.argv[1:2] == ['export-tx'] and len(sys.argv) > 2:
+        # python main.py export-tx <spreadsheet_id> [csv|jsonl] [YYYY-MM] [wallet_uuid] > out
+        args = sys.argv[2:] + [None] * 3
+        month_key = int(args[2][:4]) * 12 + int(args[2][5:7]) - 1 if args[2] else None
+        asyncio.run(export_to_stream(args[0], sys.stdout, args[1] or 'csv', month_key, args[3]))
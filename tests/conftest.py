@@ -0,0 +1,6 @@
+import os
+import sys
+
+os.environ.setdefault("SNAPSHOT_STORE", "off")
+os.environ.setdefault("BOT_TOKEN", "123:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,58 @@
+"""DebtScenarioEngine (NumPy) обязан давать ровно то же, что DebtStrategist.simulate_payoff."""
+import random
+
+import pytest
+
+import main
+
+pytest.importorskip("numpy")
+main.load_numpy()
+
+SCENARIOS = [('avalanche', 0, 0), ('snowball', 0, 0), ('none', 0, 0), ('avalanche', 0, 50000), ('snowball', 5000, 0), ('avalanche', 3000, 20000)]
+
+
+def debt(i, amount, rate, min_payment):
+    return {"id": str(i), "name": f"d{i}", "type": "credit", "amount": amount, "rate": rate, "min_payment": min_payment}
+
+
+def random_debts(rnd, size, zero_rate=False, zero_min=False):
+    return [debt(i, round(rnd.uniform(1000, 500000), 2), 0 if zero_rate and i % 2 == 0 else round(rnd.uniform(0, 40), 1),
+                 0 if zero_min and i % 3 == 0 else round(rnd.uniform(500, 20000), 2)) for i in range(size)]
+
+
+def assert_same(strategist):
+    expected = [strategist.simulate_payoff(s, o, extra_monthly_payment=e) for s, e, o in SCENARIOS]
+    assert main.DebtScenarioEngine(strategist).run(SCENARIOS) == expected
+
+
+@pytest.mark.parametrize("size", [1, 3, 10, 25])
+def test_random_portfolios(size):
+    rnd = random.Random(size)
+    assert_same(main.DebtStrategist(random_debts(rnd, size)))
+
+
+@pytest.mark.parametrize("savings", [0, 40000, 100000, 150000])
+def test_emergency_fund(savings):
+    rnd = random.Random(7)
+    assert_same(main.DebtStrategist(random_debts(rnd, 8), extra_monthly_payment=2000, current_savings=savings, emergency_goal=100000))
+
+
+def test_zero_rate():
+    rnd = random.Random(11)
+    assert_same(main.DebtStrategist(random_debts(rnd, 10, zero_rate=True), current_savings=10000, emergency_goal=50000))
+    assert_same(main.DebtStrategist([debt(0, 12000, 0, 1000), debt(1, 3000, 0, 500)]))
+
+
+def test_zero_min_payment():
+    rnd = random.Random(13)
+    assert_same(main.DebtStrategist(random_debts(rnd, 10, zero_min=True), extra_monthly_payment=1000))
+    # Без минимальных платежей и свободных денег долг не гасится никогда — оба упираются в 360 месяцев
+    assert_same(main.DebtStrategist([debt(0, 10000, 12, 0), debt(1, 5000, 0, 0)]))
+
+
+def test_small_portfolios_stay_on_the_loop(monkeypatch):
+    def numpy_engine(self, scenarios): raise AssertionError("NumPy engine used below MIN_CELLS")
+    monkeypatch.setattr(main.DebtScenarioEngine, 'run', numpy_engine)
+    # get_debts: до 20 долгов x 4 сценария
+    strategist = main.DebtStrategist(random_debts(random.Random(1), 20))
+    assert len(strategist.simulate_many(SCENARIOS[:4])) == 4
@@ -0,0 +1,144 @@
+"""Чтения в обход полного индекса: карта месяцев (get_month_view) и объединение чтений batch (ReadCoalescer).
+
+Используется таблица в памяти из test_write_roundtrips; для ReadCoalescer вместо
+подмены sheets_execute работает настоящий — с запросами FakeSheets в пуле потоков.
+"""
+import asyncio
+from collections import Counter
+
+import pytest
+
+import main
+from test_write_roundtrips import REAL_SHEETS_EXECUTE, SID, TX, WALLETS, book, run_action  # noqa: F401 (фикстура)
+
+JAN, FEB, MAR = (2026 * 12 + m for m in range(3))
+
+
+def tx_row(month, day, tx_id, amount=-10):
+    return [f"{day:02d}.{month:02d}.2026 12:00:00", amount, "Кафе", "Расход", "", "Тест", tx_id, "w1"]
+
+
+@pytest.fixture
+def months_book(book, monkeypatch):
+    """Январь, февраль и март отрезками вперемешку; карта месяцев сохраняется начиная с 0 строк."""
+    rows = book.sheets[TX]
+    del rows[1:]
+    for n, month in enumerate([1] * 4 + [2] * 3 + [1] * 2 + [3] * 3 + [2] * 2):
+        rows.append(tx_row(month, 1 + n, f"m{month}-{n}"))
+    monkeypatch.setattr(main, 'TX_PARTITIONS_MIN_ROWS', 0)
+    return book
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def build_and_save_partitions(book):
+    async def go():
+        await main.get_transaction_index(book.service, SID)
+        await main.drain_background_tasks()
+    run(go())
+    assert main.TX_PARTITIONS_KEY in book.metadata
+
+
+def cold_container():
+    for state in (main.TX_INDEXES, main.TX_PARTITIONS, main.TX_PARTITIONS_SAVED): state.clear()
+
+
+def read_month(book, month_key):
+    """(tx_id строк месяца, обращения к Sheets, был ли это индекс-вид) для get_transactions холодного контейнера."""
+    start = len(book.calls)
+    idx, _ = run(main.get_transactions(book.service, SID, month_key % 12 + 1, month_key // 12))
+    ids = sorted(idx.tx_ids[i] for i in range(len(idx)) if idx.valid[i] and idx.months[i] == month_key)
+    return ids, Counter(book.calls[start:]), main.TX_INDEXES.get(SID) is not idx
+
+
+def test_month_view_reads_only_month_runs_and_tail(months_book):
+    build_and_save_partitions(months_book)
+    cold_container()
+    months_book.sheets[TX].append(tx_row(2, 20, "tail-feb"))  # Дописано другим контейнером после сохранения карты
+
+    ids, calls, is_view = read_month(months_book, FEB)
+    assert is_view
+    assert calls == Counter({'developerMetadata.search': 1, 'values.batchGet': 1})
+    assert ids == sorted(["m2-4", "m2-5", "m2-6", "m2-12", "m2-13", "tail-feb"])
+    assert SID not in main.TX_INDEXES  # Вид не кэшируется как индекс
+
+
+def test_month_view_falls_back_when_rows_shifted(months_book):
+    build_and_save_partitions(months_book)
+    cold_container()
+    del months_book.sheets[TX][3]  # Ручное удаление строки в январском отрезке: февраль съехал на строку
+
+    ids, calls, is_view = read_month(months_book, FEB)
+    assert not is_view
+    assert calls['values.batchGet'] == 2  # Отрезки месяца, затем весь лист
+    assert ids == sorted(["m2-4", "m2-5", "m2-6", "m2-12", "m2-13"])
+
+
+def test_month_view_falls_back_without_metadata(months_book):
+    ids, calls, is_view = read_month(months_book, MAR)
+    assert not is_view
+    assert (calls['developerMetadata.search'], calls['values.batchGet']) == (1, 1)  # Поиск карты, затем весь лист
+    assert ids == ["m3-10", "m3-11", "m3-9"]
+
+
+def test_delete_from_app_drops_saved_partitions(months_book):
+    build_and_save_partitions(months_book)
+    run_action(months_book, 'delete_transaction', {'id': 'm1-0'})
+    assert main.TX_PARTITIONS_KEY not in months_book.metadata
+
+    cold_container()
+    ids, _, is_view = read_month(months_book, FEB)
+    assert not is_view
+    assert ids == sorted(["m2-4", "m2-5", "m2-6", "m2-12", "m2-13"])
+
+
+@pytest.fixture
+def pooled_book(book, monkeypatch):
+    """Настоящий sheets_execute (с ReadCoalescer и пулом потоков) поверх FakeSheets."""
+    monkeypatch.setattr(main, 'sheets_execute', REAL_SHEETS_EXECUTE)
+    monkeypatch.setattr(main, '_thread_http', lambda: None)
+    return book
+
+
+def test_coalescer_merges_reads_and_splits_results(pooled_book):
+    service = pooled_book.service
+    wallets, tx_head, tx_tail = f"'{WALLETS}'!A2:E", f"'{TX}'!A2:H2", f"'{TX}'!A3:H"
+
+    async def go():
+        coalescer = main.ReadCoalescer(3)
+        main.SHEETS_COALESCER.set(coalescer)
+
+        async def sub(coro):
+            try: return await coro
+            finally: coalescer.finish()
+        return await asyncio.gather(
+            sub(main.sheets_batch_get(service, SID, [tx_tail, wallets])),
+            sub(main.sheets_execute(service.spreadsheets().values().get(spreadsheetId=SID, range=tx_head))),
+            sub(main.sheets_batch_get(service, SID, [wallets, tx_head]))), coalescer
+
+    (first, single, second), coalescer = run(go())
+    assert pooled_book.calls == ['values.batchGet']
+    assert (coalescer.reads, coalescer.flushes) == (3, 1)
+    assert first == [pooled_book.read(tx_tail), pooled_book.read(wallets)]
+    assert single == {'range': tx_head, 'values': pooled_book.read(tx_head)}
+    assert second == [pooled_book.read(wallets), pooled_book.read(tx_head)]
+
+
+def test_batch_action_matches_separate_actions(pooled_book):
+    actions = [{'action': 'get_wallets'}, {'action': 'get_history', 'payload': {'limit': 2}}, {'action': 'get_subscriptions'}]
+    separate = {}
+    for item in actions:
+        ctx = main.ActionContext(item['action'], 1, 'Тест', item.get('payload', {}), sid=SID, oid=1)
+        separate[item['action']] = run(main.dispatch_action(main.ACTIONS[item['action']], ctx))[0]
+        main.RAM_CACHE.invalidate(SID); main.TX_INDEXES.clear()
+    reads_separately = pooled_book.calls.count('values.batchGet') + pooled_book.calls.count('values.get')
+
+    start = len(pooled_book.calls)
+    ctx = main.ActionContext('batch', 1, 'Тест', {'actions': actions}, sid=SID, oid=1)
+    result = run(main.dispatch_action(main.ACTIONS['batch'], ctx))[0]
+    calls = Counter(pooled_book.calls[start:])
+    assert calls['values.batchGet'] + calls['values.get'] < reads_separately
+    assert result['errors'] == {}
+    assert result['results'] == separate
@@ -0,0 +1,98 @@
+"""Снимки индекса транзакций: формат dumps/loads, загрузка с дочитыванием хвоста и откат на полную сборку."""
+import asyncio
+from collections import Counter
+
+import pytest
+
+import main
+from test_write_roundtrips import REVISION, SID, TX, book  # noqa: F401 (фикстура)
+
+COLUMNS = ('valid', 'ts', 'months', 'amounts', 'category_ids', 'wallet_ids', 'author_ids', 'dates', 'types', 'comments', 'tx_ids', 'strings')
+
+
+@pytest.fixture
+def store(book, tmp_path, monkeypatch):
+    store = main.FileSnapshotStore(str(tmp_path))
+    monkeypatch.setattr(main, 'SNAPSHOT_STORE', store)
+    return store
+
+
+def run(coro):
+    async def go():
+        try: return await coro
+        finally: await main.drain_background_tasks()
+    return asyncio.run(go())
+
+
+def load_index(book):
+    """Индекс холодного контейнера и обращения к Sheets за время его получения."""
+    main.TX_INDEXES.clear()
+    start = len(book.calls)
+    idx, _ = run(main.get_transaction_index(book.service, SID))
+    return idx, Counter(book.calls[start:])
+
+
+def saved(store):
+    found = run(store.load(SID))
+    return None if found is None else main.TransactionIndex.loads(SID, found[1])
+
+
+def test_dumps_loads_round_trip():
+    rows = [["01.01.2026 10:00:00", "-1 234,50", "Кафе", "Расход", "обед", "Аня", "a", "w1"],
+            ["не дата", "-5", "Кафе", "Расход", "", "Аня", "broken", "w1"],
+            ["02.01.2026 11:30:00", 50000, "Зарплата", "Доход", "", "Петя", "b", "w2"],
+            ["03.02.2026 09:15:00", -300, "Перевод", "Расход", "на карту", "Петя", "c", ""]]
+    idx = main.TransactionIndex.build(SID, rows)
+    back = main.TransactionIndex.loads(SID, idx.dumps())
+    assert len(back) == len(idx) == 4
+    for name in COLUMNS: assert list(getattr(back, name)) == list(getattr(idx, name)), name
+    assert back.rollups == idx.rollups
+    assert back.verified_at == idx.verified_at
+    assert back.month_spent("Кафе", 2026 * 12) == idx.month_spent("Кафе", 2026 * 12)
+
+
+def test_loads_rejects_other_version(monkeypatch):
+    blob = main.TransactionIndex.build(SID, [["01.01.2026 10:00:00", -1, "Кафе", "Расход", "", "", "a", ""]]).dumps()
+    monkeypatch.setattr(main.TransactionIndex, 'SNAPSHOT_VERSION', main.TransactionIndex.SNAPSHOT_VERSION + 1)
+    with pytest.raises(ValueError): main.TransactionIndex.loads(SID, blob)
+
+
+def test_restore_reads_only_the_tail(book, store):
+    load_index(book)
+    assert saved(store) is not None
+    book.sheets[TX].append(["05.01.2026 10:00:00", -7, "Кафе", "Расход", "", "Тест", "t4", "w1"])
+
+    idx, calls = load_index(book)
+    assert calls == Counter({'values.batchGet': 1})
+    assert idx.tx_ids == ['t1', 't2', 't3', 't4']
+
+
+@pytest.mark.parametrize("change", ["edit_anchor", "delete_middle"])
+def test_anchor_mismatch_rebuilds_from_sheet(book, store, change):
+    load_index(book)
+    rows = book.sheets[TX]
+    if change == "edit_anchor": rows[3][6] = "t3-edited"  # Последняя строка снимка поправлена вручную
+    else: del rows[2]                                    # Удаление выше якоря сдвигает его на строку
+
+    idx, calls = load_index(book)
+    assert calls == Counter({'values.batchGet': 2})  # Якорь с хвостом, затем лист целиком
+    assert idx.tx_ids == [r[6] for r in rows[1:]]
+    assert saved(store).tx_ids == idx.tx_ids
+
+
+def edit(book, amount):
+    ctx = main.ActionContext('edit_transaction', 1, 'Тест', {'id': 't2', 'amount': amount, 'type': 'expense', 'category': 'Кафе'}, sid=SID, oid=1)
+    run(main.dispatch_action(main.ACTIONS['edit_transaction'], ctx))
+
+
+def test_edit_saves_snapshot_only_when_revision_in_sync(book, store):
+    load_index(book)
+    edit(book, 40)  # Первая запись после старта: ревизия не известна, старый снимок удаляется
+    assert saved(store) is None
+
+    edit(book, 50)  # Ревизия выросла ровно на эту запись
+    assert saved(store).amounts[1] == -50
+
+    REVISION[0] += 1  # Другой контейнер писал в таблицу
+    edit(book, 60)
+    assert saved(store) is None
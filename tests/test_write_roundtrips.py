@@ -0,0 +1,286 @@
+"""Число обращений к Sheets API у пишущих действий.
+
+sheets_execute подменяется счетчиком поверх таблицы в памяти: каждое действие должно
+укладываться в одно чтение и одну пакетную запись (values.batchUpdate + append).
+"""
+import asyncio
+import re
+from collections import Counter
+from urllib.parse import quote, urlencode
+
+import pytest
+
+import main
+
+TX, WALLETS, DEBTS, BUDGET = main.TRANSACTIONS_SHEET_NAME, main.WALLETS_SHEET_NAME, main.DEBTS_SHEET_NAME, main.BUDGET_SHEET_NAME
+SID = 'S'
+SHEETS_URL = 'https://sheets.googleapis.com/v4/spreadsheets/'
+REAL_SHEETS_EXECUTE = main.sheets_execute
+
+
+def col_number(letters):
+    n = 0
+    for ch in letters: n = n * 26 + ord(ch) - 64
+    return n
+
+
+class Request:
+    """Как HttpRequest клиента: methodId и uri нужны ReadCoalescer, execute — пулу потоков."""
+
+    def __init__(self, book, kind, run, uri=''):
+        self.book = book
+        self.kind = kind
+        self.run = run
+        self.methodId = 'sheets.spreadsheets.' + kind
+        self.uri = uri
+        self.headers = {}
+
+    def execute(self, http=None):
+        self.book.calls.append(self.kind)
+        return self.run()
+
+
+class FakeSheets:
+    """Листы таблицы в памяти (строка 1 — заголовок) и журнал выполненных запросов."""
+
+    def __init__(self):
+        self.sheets = {title: [list(header)] for title, header in main.SHEET_HEADERS.items()}
+        self.sheet_ids = {title: 100 + i for i, title in enumerate(self.sheets)}
+        self.metadata = {}  # developer metadata: ключ -> значение
+        self.calls = []
+
+    # --- A1-диапазоны ---
+
+    def parse(self, rng):
+        title, _, ref = rng.partition('!')
+        title = title.strip("'")
+        if not ref: return title, 1, 1, 26, None
+        first, _, last = ref.partition(':')
+        m1 = re.match(r'^([A-Z]*)(\d*)$', first)
+        m2 = re.match(r'^([A-Z]*)(\d*)$', last or first)
+        c1 = col_number(m1[1]) if m1[1] else 1
+        c2 = col_number(m2[1]) if m2[1] else 26
+        r1 = int(m1[2]) if m1[2] else 1
+        r2 = int(m2[2]) if m2[2] else None
+        return title, c1, r1, c2, r2
+
+    def read(self, rng):
+        title, c1, r1, c2, r2 = self.parse(rng)
+        out = []
+        for row in self.sheets[title][r1 - 1:r2]:
+            values = ['' if v is None else v for v in row[c1 - 1:c2]]
+            while values and values[-1] == '': values.pop()
+            out.append(values)
+        while out and not out[-1]: out.pop()
+        return out
+
+    def write(self, rng, values):
+        title, c1, r1, _, _ = self.parse(rng)
+        rows = self.sheets[title]
+        for i, new in enumerate(values):
+            while len(rows) < r1 + i: rows.append([])
+            row = rows[r1 - 1 + i]
+            for j, v in enumerate(new):
+                while len(row) < c1 + j: row.append('')
+                row[c1 - 1 + j] = v
+
+    def append(self, rng, values):
+        title = self.parse(rng)[0]
+        start = len(self.sheets[title]) + 1
+        self.sheets[title].extend(list(r) for r in values)
+        return {'updates': {'updatedRange': f"'{title}'!A{start}:H{start + len(values) - 1}"}}
+
+    def cell(self, title, row, column):
+        return self.sheets[title][row - 1][col_number(column) - 1]
+
+    # --- подмены ---
+
+    async def execute(self, request):
+        return request.execute()
+
+    def batch_update(self, body):
+        for r in body['requests']:
+            if 'deleteDeveloperMetadata' in r:
+                self.metadata.pop(r['deleteDeveloperMetadata']['dataFilter']['developerMetadataLookup']['metadataKey'], None)
+            elif 'createDeveloperMetadata' in r:
+                meta = r['createDeveloperMetadata']['developerMetadata']
+                self.metadata[meta['metadataKey']] = meta['metadataValue']
+            elif 'deleteDimension' in r:
+                rng = r['deleteDimension']['range']
+                title = next(t for t, i in self.sheet_ids.items() if i == rng['sheetId'])
+                del self.sheets[title][rng['startIndex']:rng['endIndex']]
+        return {'replies': [{} for _ in body['requests']]}
+
+    @property
+    def service(self):
+        book = self
+
+        class Values:
+            def get(self, spreadsheetId, range, **kw):
+                return Request(book, 'values.get', lambda: {'range': range, 'values': book.read(range)},
+                               f"{SHEETS_URL}{spreadsheetId}/values/{quote(range, safe='')}?alt=json")
+
+            def batchGet(self, spreadsheetId, ranges, **kw):
+                return Request(book, 'values.batchGet', lambda: {'valueRanges': [{'range': r, 'values': book.read(r)} for r in ranges]},
+                               f"{SHEETS_URL}{spreadsheetId}/values:batchGet?{urlencode([('ranges', r) for r in ranges] + [('alt', 'json')])}")
+
+            def update(self, spreadsheetId, range, body, **kw):
+                return Request(book, 'values.update', lambda: book.write(range, body['values']) or {})
+
+            def append(self, spreadsheetId, range, body, **kw):
+                return Request(book, 'values.append', lambda: book.append(range, body['values']))
+
+            def batchUpdate(self, spreadsheetId, body, **kw):
+                return Request(book, 'values.batchUpdate', lambda: [book.write(d['range'], d['values']) for d in body['data']] and {})
+
+        class DeveloperMetadata:
+            def search(self, spreadsheetId, body, **kw):
+                keys = [f['developerMetadataLookup']['metadataKey'] for f in body['dataFilters']]
+                return Request(book, 'developerMetadata.search', lambda: {'matchedDeveloperMetadata': [
+                    {'developerMetadata': {'metadataKey': k, 'metadataValue': book.metadata[k]}} for k in keys if k in book.metadata]})
+
+        class Spreadsheets:
+            def values(self): return Values()
+
+            def developerMetadata(self): return DeveloperMetadata()
+
+            def get(self, spreadsheetId, ranges=None, **kw):
+                if ranges: return Request(book, 'spreadsheets.get', lambda: {'sheets': [
+                    {'properties': {'gridProperties': {'rowCount': len(book.sheets[book.parse(r)[0]])}}} for r in ranges]})
+                return Request(book, 'spreadsheets.get', lambda: {
+                    'sheets': [{'properties': {'title': t, 'sheetId': i}} for t, i in book.sheet_ids.items()],
+                    'developerMetadata': [{'metadataKey': main.SHEET_SCHEMA_KEY, 'metadataValue': str(main.SHEET_SCHEMA_VERSION)}]})
+
+            def batchUpdate(self, spreadsheetId, body, **kw):
+                return Request(book, 'spreadsheets.batchUpdate', lambda: book.batch_update(body))
+
+        class Service:
+            def spreadsheets(self): return Spreadsheets()
+
+        return Service()
+
+
+class Row:
+    def __init__(self, **fields): self.__dict__.update(fields)
+
+
+class ResultSet:
+    def __init__(self, rows): self.rows = rows
+
+
+REVISION = [0]  # sheet_revisions для SID
+
+
+async def fake_ydb_query(name, params=None):
+    if name == 'bump_revision':
+        REVISION[0] += 1
+        return [ResultSet([Row(revision=REVISION[0])])]
+    if name == 'get_revision': return [ResultSet([Row(revision=REVISION[0])])]
+    return [ResultSet([])]
+
+
+@pytest.fixture
+def book(monkeypatch):
+    book = FakeSheets()
+    book.sheets[WALLETS] += [["Карта", 1000, "bank_account", "TRUE", "w1"], ["Наличные", 200, "cash", "FALSE", "w2"]]
+    book.sheets[TX] += [["01.01.2026 10:00:00", -100, "Кафе", "Расход", "", "Тест", f"t{i}", "w1"] for i in range(1, 4)]
+    book.sheets[DEBTS] += [["Ипотека", "credit", 5000, 10, "d1", 100]]
+    book.sheets[BUDGET] += [["Кафе", 1000]]
+    for state in (main.TX_INDEXES, main.TX_INDEX_BUILDS, main.TX_PARTITIONS, main.TX_PARTITIONS_SAVED, main.WALLET_INDEXES,
+                  main.WALLET_LOCKS, main.SHEET_SCHEMAS, main.SHEET_WRITERS, main.REVISIONS):
+        state.clear()
+    REVISION[0] = 0
+    monkeypatch.setattr(main, 'RAM_CACHE', main.RamCache(main.CACHE_MAX_ENTRIES, main.CACHE_MAX_BYTES))
+    monkeypatch.setattr(main, 'SNAPSHOT_STORE', None)
+    monkeypatch.setattr(main, 'get_sheets_service', lambda: book.service)
+    monkeypatch.setattr(main, 'sheets_execute', book.execute)
+    monkeypatch.setattr(main, 'ydb_query', fake_ydb_query)
+    return book
+
+
+def run_action(book, name, payload):
+    """Выполняет действие так же, как handler, и возвращает обращения к Sheets за это время."""
+    start = len(book.calls)
+    ctx = main.ActionContext(name, 1, 'Тест', payload, sid=SID, oid=1)
+    asyncio.run(main.dispatch_action(main.ACTIONS[name], ctx))
+    return Counter(book.calls[start:])
+
+
+ONE_READ_ONE_WRITE = Counter({'values.batchGet': 1, 'values.batchUpdate': 1, 'values.append': 1})
+
+
+def test_add_transaction_expense(book):
+    calls = run_action(book, 'add_transaction', {'amount': 50, 'type': 'expense', 'category': 'Кафе', 'wallet_uuid': 'w2'})
+    assert calls == ONE_READ_ONE_WRITE
+    assert book.cell(WALLETS, 3, 'B') == 150
+    assert book.sheets[TX][-1][1] == -50
+
+
+def test_add_transaction_income(book):
+    calls = run_action(book, 'add_transaction', {'amount': 70, 'type': 'income', 'category': 'Зарплата'})
+    assert calls == ONE_READ_ONE_WRITE
+    assert book.cell(WALLETS, 2, 'B') == 1070
+
+
+def test_transfer_between_wallets(book):
+    calls = run_action(book, 'transfer_between_wallets', {'from_wallet': 'w1', 'to_wallet': 'w2', 'amount': 300})
+    assert calls == ONE_READ_ONE_WRITE
+    assert (book.cell(WALLETS, 2, 'B'), book.cell(WALLETS, 3, 'B')) == (700, 500)
+    assert [r[1] for r in book.sheets[TX][-2:]] == [-300, 300]
+
+
+def test_manage_debt_repay(book):
+    calls = run_action(book, 'manage_debt', {'type': 'repay', 'id': 'd1', 'amount': 100})
+    assert calls == ONE_READ_ONE_WRITE
+    assert book.cell(DEBTS, 2, 'C') == 4900
+    assert book.cell(WALLETS, 2, 'B') == 900
+
+
+def test_edit_transaction(book):
+    calls = run_action(book, 'edit_transaction', {'id': 't2', 'amount': 40, 'type': 'expense', 'category': 'Кафе'})
+    assert calls == Counter({'values.batchGet': 1, 'values.batchUpdate': 1})
+    assert book.sheets[TX][2][1] == -40
+    assert book.cell(WALLETS, 2, 'B') == 1060
+
+    # С теплым индексом строка все равно сверяется тем же batchGet, что и кошельки
+    calls = run_action(book, 'edit_transaction', {'id': 't2', 'amount': 10, 'type': 'expense', 'category': 'Кафе'})
+    assert calls == Counter({'values.batchGet': 1, 'values.batchUpdate': 1})
+    assert book.cell(WALLETS, 2, 'B') == 1090
+
+
+def test_delete_transaction(book):
+    calls = run_action(book, 'delete_transaction', {'id': 't1'})
+    # spreadsheets.get — только первый раз, за sheetId листа
+    assert calls == Counter({'values.batchGet': 1, 'spreadsheets.get': 1, 'values.batchUpdate': 1, 'spreadsheets.batchUpdate': 1})
+    assert [r[6] for r in book.sheets[TX][1:]] == ['t2', 't3']
+    assert book.cell(WALLETS, 2, 'B') == 1100
+
+    calls = run_action(book, 'delete_transaction', {'id': 't3'})
+    assert calls == Counter({'values.batchGet': 1, 'values.batchUpdate': 1, 'spreadsheets.batchUpdate': 1})
+    assert [r[6] for r in book.sheets[TX][1:]] == ['t2']
+
+
+def test_concurrent_writes_keep_every_delta(book):
+    async def go():
+        await asyncio.gather(*(main.dispatch_action(main.ACTIONS['add_transaction'], main.ActionContext(
+            'add_transaction', 1, 'Тест', {'amount': a, 'type': 'income', 'category': 'X'}, sid=SID, oid=1)) for a in (1, 10, 100)))
+    asyncio.run(go())
+    assert book.cell(WALLETS, 2, 'B') == 1111
+    assert len(book.sheets[TX]) == 1 + 3 + 3
+
+
+def test_revision_baseline_after_cold_start(book):
+    edit = {'id': 't2', 'amount': 40, 'type': 'expense', 'category': 'Кафе'}
+    # Первая запись контейнера: ревизия еще не известна, результат записи не сбрасывается
+    run_action(book, 'edit_transaction', edit)
+    assert main.REVISIONS[SID][1] == 1
+    assert SID in main.TX_INDEXES and SID in main.WALLET_INDEXES
+
+    run_action(book, 'edit_transaction', edit)
+    assert main.REVISIONS[SID][1] == 2 and SID in main.TX_INDEXES
+
+    # Между записями писал другой контейнер: локальное состояние сбрасывается
+    REVISION[0] += 1
+    run_action(book, 'edit_transaction', edit)
+    assert main.REVISIONS[SID][1] == 4
+    assert SID not in main.TX_INDEXES and SID not in main.WALLET_INDEXES